@@ -0,0 +1,10 @@
+"""
+FaceFusion Handler 离线基准测试
+================================
+在本地直接驱动 handler()，无需 RunPod 端点与 GPU:
+- 本地 HTTP 服务器提供输入文件 (支持 Range / ETag)
+- 本地 S3 兼容服务器替代 R2 (R2Storage)，或直接使用 LocalStorage (--storage local)
+- 常驻 Worker 使用 stub 后端，按帧模拟处理耗时
+
+Usage: python -m benchmarks.run --help
+"""
@@ -0,0 +1,94 @@
+"""
+对比两次基准测试结果
+按场景和阶段比较 p50 / p95，超过阈值的变慢记为回归
+
+Usage: python -m benchmarks.compare baseline.json current.json [--threshold 0.2]
+"""
+
+import argparse
+import json
+import sys
+
+# 过短的阶段抖动大，不参与回归判断 (秒)
+MIN_COMPARABLE_SECONDS = 0.05
+
+
+def load_results(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(baseline: dict, current: dict, threshold: float = 0.2) -> dict:
+    """
+    返回 {"rows": [...], "regressions": [...]}
+    每行: scenario, stage, metric, baseline, current, change (相对变化)
+    """
+    rows = []
+    regressions = []
+    for name, scenario in current.get("scenarios", {}).items():
+        base_scenario = baseline.get("scenarios", {}).get(name)
+        if base_scenario is None:
+            continue
+
+        for stage, stats in scenario["stages"].items():
+            base_stats = base_scenario["stages"].get(stage)
+            if base_stats is None:
+                continue
+            for metric in ("p50", "p95"):
+                base_value, value = base_stats[metric], stats[metric]
+                change = (value - base_value) / base_value if base_value > 0 else 0.0
+                row = {
+                    "scenario": name,
+                    "stage": stage,
+                    "metric": metric,
+                    "baseline": base_value,
+                    "current": value,
+                    "change": round(change, 3),
+                }
+                rows.append(row)
+                if change > threshold and max(base_value, value) >= MIN_COMPARABLE_SECONDS:
+                    regressions.append(row)
+
+        # 吞吐下降同样视为回归
+        base_throughput = base_scenario.get("throughput_jobs_per_s", 0)
+        throughput = scenario.get("throughput_jobs_per_s", 0)
+        if base_throughput > 0:
+            change = (base_throughput - throughput) / base_throughput
+            row = {
+                "scenario": name,
+                "stage": "throughput",
+                "metric": "jobs_per_s",
+                "baseline": base_throughput,
+                "current": throughput,
+                "change": round(-change, 3),
+            }
+            rows.append(row)
+            if change > threshold:
+                regressions.append(row)
+
+    return {"rows": rows, "regressions": regressions}
+
+
+def print_comparison(comparison: dict) -> None:
+    print(f"{'scenario':<36} {'stage':<18} {'metric':<10} {'baseline':>10} {'current':>10} {'change':>8}")
+    for row in comparison["rows"]:
+        flag = "  <-- regression" if row in comparison["regressions"] else ""
+        print(f"{row['scenario']:<36} {row['stage']:<18} {row['metric']:<10} "
+              f"{row['baseline']:>10.3f} {row['current']:>10.3f} {row['change']:>+8.1%}{flag}")
+    print(f"\n{len(comparison['regressions'])} regression(s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative slowdown treated as regression")
+    args = parser.parse_args()
+
+    comparison = compare_results(load_results(args.baseline), load_results(args.current), args.threshold)
+    print_comparison(comparison)
+    sys.exit(1 if comparison["regressions"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+FaceFusion Handler 离线基准测试
+================================
+按场景矩阵 (输入类型 x 文件大小 x 缓存模式 x 并发度) 驱动 handler()，
+汇总每个阶段耗时的 p50 / p95 与吞吐，结果写入 JSON，可与上一次结果对比。
+
+缓存模式:
+    off    - 关闭输入缓存与结果缓存
+    input  - 仅输入缓存
+    full   - 输入缓存 + 结果缓存
+
+存储后端:
+    s3     - 本地 S3 兼容服务器 (走完整的 HTTP 签名上传/下载路径)
+    local  - LocalStorage 本地目录 (排除网络开销)
+
+Usage:
+    python -m benchmarks.run --kinds image,video --sizes-mb 1,64 --cache off,full --concurrency 1,4
+    python -m benchmarks.run --storage local
+    python -m benchmarks.run --output current.json --baseline baseline.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmarks.compare import compare_results, print_comparison
+from benchmarks.servers import InputServer, S3Server
+from stats import percentile
+
+CACHE_MODES = ("off", "input", "full")
+STORAGE_BACKENDS = ("s3", "local")
+SOURCE_SIZE = 200 * 1024  # 源人脸图片大小
+WRITE_CHUNK_SIZE = 1024 * 1024
+# 生成的输入文件头: JPEG SOI 标记 / MP4 ftyp box
+FILE_SIGNATURES = {
+    ".jpg": b"\xff\xd8\xff\xe0\x00\x10JFIF\x00",
+    ".mp4": b"\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isommp41",
+}
+
+
+def parse_list(value: str, cast=str) -> list:
+    return [cast(item.strip()) for item in value.split(",") if item.strip()]
+
+
+def write_random_file(path: str, size: int, signature: bytes = b"") -> None:
+    """随机内容，以 signature 开头 (预检按文件头识别类型，纯随机字节可能被误判为网页/JSON 而拒绝)"""
+    with open(path, "wb") as f:
+        f.write(signature[:size])
+        remaining = size - min(len(signature), size)
+        while remaining > 0:
+            chunk = min(WRITE_CHUNK_SIZE, remaining)
+            f.write(os.urandom(chunk))
+            remaining -= chunk
+
+
+def configure_environment(args, workdir: str, s3_url: str) -> None:
+    """handler 在导入时读取配置，必须在 import handler 之前设置"""
+    os.environ.update({
+        "R2_ENDPOINT": s3_url,
+        "R2_ACCOUNT_ID": "benchmark",
+        "R2_ACCESS_KEY_ID": "benchmark",
+        "R2_SECRET_ACCESS_KEY": "benchmark",
+        "R2_BUCKET": "benchmark",
+        "FACEFUSION_WORKER": "1",
+        "FACEFUSION_WORKER_BACKEND": "stub",
+        "FACEFUSION_WORKER_SOCKET": os.path.join(workdir, "worker.sock"),
+        "FACEFUSION_STUB_FRAME_COST": str(args.frame_cost),
+        "FACEFUSION_STUB_VIDEO_FRAMES": str(args.video_frames),
+        "INPUT_CACHE_DIR": os.path.join(workdir, "cache"),
+        "STORAGE_BACKEND": "local" if args.storage == "local" else "r2",
+        "STORAGE_LOCAL_DIR": os.path.join(workdir, "storage"),
+    })
+    # 进度推送只在 RunPod 环境中发出
+    os.environ.pop("RUNPOD_WEBHOOK_POST_OUTPUT", None)
+
+
+def build_scenarios(args) -> list:
+    scenarios = []
+    for kind in parse_list(args.kinds):
+        for size_mb in parse_list(args.sizes_mb, float):
+            for cache in parse_list(args.cache):
+                if cache not in CACHE_MODES:
+                    raise ValueError(f"Unknown cache mode: {cache}")
+                for concurrency in parse_list(args.concurrency, int):
+                    scenarios.append({
+                        "name": f"{kind}_{size_mb:g}mb_cache-{cache}_c{concurrency}",
+                        "kind": kind,
+                        "size_mb": size_mb,
+                        "cache": cache,
+                        "concurrency": concurrency,
+                    })
+    return scenarios
+
+
+def prepare_inputs(input_dir: str, scenarios: list) -> dict:
+    """生成随机内容的输入文件 (stub 后端不解码)，返回 {(kind, size_mb): 文件名}"""
+    write_random_file(os.path.join(input_dir, "source.jpg"), SOURCE_SIZE, FILE_SIGNATURES[".jpg"])
+    targets = {}
+    for scenario in scenarios:
+        key = (scenario["kind"], scenario["size_mb"])
+        if key in targets:
+            continue
+        ext = ".jpg" if scenario["kind"] == "image" else ".mp4"
+        filename = f"target_{scenario['kind']}_{scenario['size_mb']:g}mb{ext}"
+        write_random_file(os.path.join(input_dir, filename), int(scenario["size_mb"] * 1024 * 1024), FILE_SIGNATURES[ext])
+        targets[key] = filename
+    return targets
+
+
+def configure_caches(handler, scenario: dict, workdir: str) -> None:
+    """每个场景使用独立的缓存目录，互不影响"""
+    cache_dir = os.path.join(workdir, "cache", scenario["name"])
+    handler.input_cache = handler.InputCache(cache_dir) if scenario["cache"] != "off" else None
+    handler.RESULT_CACHE_ENABLED = scenario["cache"] == "full"
+
+
+async def run_concurrent(handler, jobs: list, concurrency: int) -> list:
+    """并发模式: 与 RunPod 一样同时保持 concurrency 个任务在途"""
+    pipeline = handler.JobPipeline()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(job):
+        async with semaphore:
+            return await pipeline.run(job)
+
+    return await asyncio.gather(*(run_one(job) for job in jobs))
+
+
+def run_scenario(handler, scenario: dict, jobs: list) -> tuple:
+    """返回 (响应列表, 总耗时)"""
+    start_time = time.time()
+    if scenario["concurrency"] > 1:
+        responses = asyncio.run(run_concurrent(handler, jobs, scenario["concurrency"]))
+    else:
+        responses = [handler.handler(job) for job in jobs]
+    return responses, time.time() - start_time
+
+
+def summarize_scenario(scenario: dict, responses: list, wall_seconds: float) -> dict:
+    """按阶段汇总 p50 / p95 / mean，以及吞吐与缓存命中"""
+    succeeded = [r for r in responses if r.get("status") == "success"]
+    stage_values = {}
+    stage_rates = {}
+    for response in succeeded:
+        for stage, record in response.get("timings", {}).items():
+            stage_values.setdefault(stage, []).append(record["seconds"])
+            for rate in ("mb_per_s", "fps"):
+                if rate in record:
+                    stage_rates.setdefault(stage, {}).setdefault(rate, []).append(record[rate])
+
+    stages = {}
+    for stage, values in stage_values.items():
+        stages[stage] = {
+            "count": len(values),
+            "p50": round(percentile(values, 50), 4),
+            "p95": round(percentile(values, 95), 4),
+            "mean": round(sum(values) / len(values), 4),
+        }
+        for rate, rate_values in stage_rates.get(stage, {}).items():
+            stages[stage][f"{rate}_p50"] = round(percentile(rate_values, 50), 2)
+
+    input_hits = sum(1 for r in succeeded
+                     for side in ("source", "target") if r.get("input_cache", {}).get(side) == "hit")
+    return dict(scenario, **{
+        "jobs": len(responses),
+        "failed": len(responses) - len(succeeded),
+        "errors": sorted({r.get("error", "") for r in responses if r.get("status") != "success"}),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_jobs_per_s": round(len(succeeded) / wall_seconds, 3) if wall_seconds > 0 else 0.0,
+        "input_cache_hits": input_hits,
+        "result_cache_hits": sum(1 for r in succeeded if r.get("result_cache") == "hit"),
+        "stages": stages,
+    })
+
+
+def quiet_logs(verbose: bool):
+    """默认屏蔽 handler 与 Worker 的日志输出"""
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+
+def check_tools() -> dict:
+    """
+    handler 用 ffprobe 预检与估算工作区，视频场景还会用到 ffmpeg；
+    缺少时这些步骤走失败回退路径，耗时与正式环境不可比，开始前提示并记入结果
+    """
+    tools = {name: shutil.which(name) is not None for name in ("ffmpeg", "ffprobe")}
+    missing = [name for name, found in tools.items() if not found]
+    if missing:
+        print(f"Warning: {', '.join(missing)} not found on PATH; preflight and workspace probes will use their fallbacks",
+              file=sys.stderr)
+    return tools
+
+
+def get_git_commit() -> str:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10)
+        return result.stdout.strip()
+    except Exception:
+        return ""
+
+
+def print_summary(results: dict) -> None:
+    for name, scenario in results["scenarios"].items():
+        print(f"\n{name}: {scenario['jobs']} jobs, {scenario['failed']} failed, "
+              f"{scenario['throughput_jobs_per_s']} jobs/s, "
+              f"cache hits input={scenario['input_cache_hits']} result={scenario['result_cache_hits']}")
+        for error in scenario["errors"]:
+            print(f"  error: {error}")
+        for stage, stats in scenario["stages"].items():
+            rates = "  ".join(f"{k}={v}" for k, v in stats.items() if k.endswith("_p50") and k != "p50")
+            print(f"  {stage:<18} p50={stats['p50']:.3f}s  p95={stats['p95']:.3f}s  {rates}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the FaceFusion handler")
+    parser.add_argument("--kinds", default="image,video", help="Target kinds: image, video")
+    parser.add_argument("--sizes-mb", default="1,48", help="Target file sizes in MB")
+    parser.add_argument("--cache", default="off,full", help=f"Cache modes: {', '.join(CACHE_MODES)}")
+    parser.add_argument("--concurrency", default="1,4", help="Handler concurrency levels")
+    parser.add_argument("--jobs", type=int, default=8, help="Jobs per scenario")
+    parser.add_argument("--frame-cost", type=float, default=0.01, help="Simulated seconds per frame")
+    parser.add_argument("--video-frames", type=int, default=60, help="Simulated frames per video")
+    parser.add_argument("--storage", default="s3", choices=STORAGE_BACKENDS, help="Storage backend for results")
+    parser.add_argument("--output", default="benchmark_results.json", help="Result JSON path")
+    parser.add_argument("--baseline", help="Previous result JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative slowdown treated as regression")
+    parser.add_argument("--verbose", action="store_true", help="Show handler logs")
+    args = parser.parse_args()
+
+    scenarios = build_scenarios(args)
+    tools = check_tools()
+    with tempfile.TemporaryDirectory(prefix="facefusion_bench_") as workdir:
+        input_dir = os.path.join(workdir, "inputs")
+        os.makedirs(input_dir)
+        targets = prepare_inputs(input_dir, scenarios)
+
+        input_server = InputServer(input_dir).start()
+        s3_server = S3Server().start()
+        configure_environment(args, workdir, s3_server.url)
+
+        import handler
+        handler.TEMP_DIR = os.path.join(workdir, "jobs")
+
+        results = {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "config": {
+                "jobs": args.jobs,
+                "frame_cost": args.frame_cost,
+                "video_frames": args.video_frames,
+                "storage": args.storage,
+                "tools": tools,
+            },
+            "scenarios": {},
+        }
+
+        try:
+            with quiet_logs(args.verbose):
+                handler.boot()
+            for scenario in scenarios:
+                print(f"Running {scenario['name']} ...", flush=True)
+                configure_caches(handler, scenario, workdir)
+                s3_server.httpd.objects.clear()
+                shutil.rmtree(os.path.join(workdir, "storage"), ignore_errors=True)
+                target_url = f"{input_server.url}/{targets[(scenario['kind'], scenario['size_mb'])]}"
+                jobs = [{
+                    "id": f"{scenario['name']}_{i}",
+                    "input": {"source_url": f"{input_server.url}/source.jpg", "target_url": target_url},
+                } for i in range(args.jobs)]
+
+                with quiet_logs(args.verbose):
+                    responses, wall_seconds = run_scenario(handler, scenario, jobs)
+                results["scenarios"][scenario["name"]] = summarize_scenario(scenario, responses, wall_seconds)
+        finally:
+            if handler.facefusion_worker is not None:
+                handler.facefusion_worker.stop()
+            input_server.stop()
+            s3_server.stop()
+
+    print_summary(results)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        comparison = compare_results(baseline, results, args.threshold)
+        print()
+        print_comparison(comparison)
+        if comparison["regressions"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+基准测试用的本地服务器
+- InputServer: 静态文件服务器，支持 HEAD / Range / ETag
+- S3Server: 最小的 S3 兼容对象存储 (PUT / GET (Range) / HEAD / DELETE / 分片上传)，不校验签名
+"""
+
+import hashlib
+import os
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class InputRequestHandler(BaseHTTPRequestHandler):
+    """提供 root_dir 下的文件"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _file_path(self) -> str:
+        name = unquote(urlparse(self.path).path).lstrip("/")
+        return os.path.join(self.server.root_dir, os.path.basename(name))
+
+    def _send_headers(self, status: int, size: int, path: str, extra: dict = None) -> None:
+        stat = os.stat(path)
+        self.send_response(status)
+        self.send_header("Content-Length", str(size))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{stat.st_ino:x}-{stat.st_size:x}-{int(stat.st_mtime):x}"')
+        self.send_header("Content-Type", "application/octet-stream")
+        for key, value in (extra or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+
+    def do_HEAD(self):
+        path = self._file_path()
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self._send_headers(200, os.path.getsize(path), path)
+
+    def do_GET(self):
+        path = self._file_path()
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = 200
+        extra = {}
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+            status = 206
+            extra["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+        self._send_headers(status, end - start + 1, path, extra)
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(COPY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+class S3RequestHandler(BaseHTTPRequestHandler):
+    """路径形如 /{bucket}/{key}，对象保存在内存中"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _key(self) -> str:
+        return unquote(urlparse(self.path).path)
+
+    def _query(self) -> dict:
+        return {k: v[0] for k, v in parse_qs(urlparse(self.path).query, keep_blank_values=True).items()}
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _respond(self, status: int, body: bytes = b"", headers: dict = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        data = self.server.objects.get(self._key())
+        if data is None:
+            self._respond(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{hashlib.md5(data).hexdigest()}"')
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.server.objects.get(self._key())
+        if data is None:
+            self._respond(404, b"<Error><Code>NoSuchKey</Code></Error>")
+            return
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+            self._respond(206, data[start:end + 1], {"Content-Range": f"bytes {start}-{end}/{len(data)}"})
+            return
+        self._respond(200, data)
+
+    def do_PUT(self):
+        key = self._key()
+        query = self._query()
+        body = self._read_body()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+
+        if "uploadId" in query:
+            upload = self.server.uploads.get(query["uploadId"])
+            if upload is None or upload["key"] != key:
+                self._respond(404, b"<Error><Code>NoSuchUpload</Code></Error>")
+                return
+            upload["parts"][int(query["partNumber"])] = body
+        else:
+            self.server.objects[key] = body
+        self._respond(200, headers={"ETag": etag})
+
+    def do_POST(self):
+        key = self._key()
+        query = self._query()
+        body = self._read_body()
+
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = {"key": key, "parts": {}}
+            xml = f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+            self._respond(200, xml.encode("utf-8"))
+            return
+
+        if "uploadId" in query:
+            upload = self.server.uploads.pop(query["uploadId"], None)
+            if upload is None:
+                self._respond(404, b"<Error><Code>NoSuchUpload</Code></Error>")
+                return
+            numbers = [int(n) for n in re.findall(rb"<PartNumber>(\d+)</PartNumber>", body)]
+            self.server.objects[key] = b"".join(upload["parts"][n] for n in numbers)
+            self._respond(200, b"<CompleteMultipartUploadResult></CompleteMultipartUploadResult>")
+            return
+
+        self._respond(400)
+
+    def do_DELETE(self):
+        query = self._query()
+        if "uploadId" in query:
+            self.server.uploads.pop(query["uploadId"], None)
+        else:
+            self.server.objects.pop(self._key(), None)
+        self._respond(204)
+
+
+class LocalServer:
+    """在后台线程中运行的 HTTP 服务器"""
+
+    def __init__(self, handler_class, **attributes):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        self.httpd.daemon_threads = True
+        for name, value in attributes.items():
+            setattr(self.httpd, name, value)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self) -> "LocalServer":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def InputServer(root_dir: str) -> LocalServer:
+    """输入文件服务器"""
+    return LocalServer(InputRequestHandler, root_dir=root_dir)
+
+
+def S3Server() -> LocalServer:
+    """S3 兼容对象存储"""
+    return LocalServer(S3RequestHandler, objects={}, uploads={})
@@ -6,22 +6,311 @@ FaceFusion RunPod 客户端示例
 
 import runpod
 import time
+import asyncio
 import base64
+import hashlib
+import hmac
+import json
 import os
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from xml.etree import ElementTree
+
+import aiohttp
+import requests
+
+from stats import percentile
+from storage import R2_KEY_SCHEME, create_session, presign_url
+
+# 批量任务 (swap_faces_batch)
+BATCH_WINDOW = 32                      # 同时在途 (已提交、未完成) 的任务数
+POLL_INITIAL = 2.0                     # 状态查询初始间隔 (秒)
+POLL_FACTOR = 1.6                      # 每次未完成后间隔的增长倍数
+POLL_MAX = 30.0                        # 查询间隔上限
+POLL_FIRST_RATIO = 0.8                 # 首次查询在已完成任务中位耗时的该比例处
+REQUEST_RETRIES = 3                    # RunPod API 请求失败 (网络错误、429、5xx) 重试次数
+DOWNLOAD_CONCURRENCY = 8               # 同时进行的下载请求数 (按分片计)
+DOWNLOAD_PART_SIZE = 8 * 1024 * 1024   # Range 分片大小
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+FINAL_STATUSES = ("COMPLETED", "FAILED", "CANCELLED", "TIMED_OUT")
+
+# 本地文件直传 R2 (R2Uploader)
+UPLOAD_PREFIX = "facefusion/input"
+UPLOAD_MULTIPART_THRESHOLD = 64 * 1024 * 1024  # 超过此大小使用分片上传
+UPLOAD_PART_SIZE = 16 * 1024 * 1024            # 分片大小 (S3 要求至少 5MB)
+UPLOAD_CONCURRENCY = 8                         # 并发上传的分片数
+UPLOAD_RETRIES = 3
+
+
+def batch_stats(results: list) -> dict:
+    """批量结果统计: 成功/失败数与每个任务耗时 (提交到完成) 的百分位"""
+    latencies = [r["latency"] for r in results if r.get("latency") is not None]
+    stats = {
+        "jobs": len(results),
+        "succeeded": sum(1 for r in results if r.get("status") == "success"),
+        "failed": sum(1 for r in results if r.get("status") != "success"),
+    }
+    if latencies:
+        stats["latency"] = {
+            "p50": round(percentile(latencies, 50), 2),
+            "p90": round(percentile(latencies, 90), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "mean": round(sum(latencies) / len(latencies), 2),
+            "max": round(max(latencies), 2),
+        }
+    # RunPod 返回的排队时间与执行时间 (轮询模式才有)
+    for key in ("delay_time", "execution_time"):
+        values = [r[key] for r in results if r.get(key) is not None]
+        if values:
+            stats[key] = {"p50": round(percentile(values, 50), 2), "p90": round(percentile(values, 90), 2)}
+    return stats
+
+
+class CallbackReceiver:
+    """
+    本地回调接收器: 接收 handler 推送到 webhook_url 的任务结果，代替轮询 run.status()
+
+    Args:
+        public_url: handler 能访问到的回调地址 (例如经过反向代理/隧道的 https 地址)
+        host, port: 本地监听地址
+        secret: 与 endpoint 的 WEBHOOK_SECRET 相同时校验签名
+        max_skew: 允许的签名时间戳偏差 (秒)
+    """
+
+    def __init__(self, public_url: str, host: str = "0.0.0.0", port: int = 8080, secret: str = "", max_skew: int = 300):
+        self.url = public_url
+        self.secret = secret
+        self.max_skew = max_skew
+        self.results = {}
+        self.waiters = {}
+        self.condition = threading.Condition()
+
+        receiver = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if not receiver.verify(body, self.headers.get("X-FaceFusion-Timestamp", ""),
+                                       self.headers.get("X-FaceFusion-Signature", "")):
+                    self.send_response(401)
+                    self.end_headers()
+                    return
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                receiver.deliver(payload)
+                self.send_response(204)
+                self.end_headers()
+
+        self.server = ThreadingHTTPServer((host, port), RequestHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def verify(self, body: bytes, timestamp: str, signature: str) -> bool:
+        """校验 HMAC-SHA256("{timestamp}.{body}") 签名 (未设置 secret 时不校验)"""
+        if not self.secret:
+            return True
+        if not timestamp.isdigit() or abs(time.time() - int(timestamp)) > self.max_skew:
+            return False
+        expected = "sha256=" + hmac.new(self.secret.encode("utf-8"), timestamp.encode("utf-8") + b"." + body,
+                                        hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature)
+
+    def deliver(self, payload: dict) -> None:
+        with self.condition:
+            # 重试可能导致重复投递，保留第一次
+            job_id = payload.get("id")
+            self.results.setdefault(job_id, payload.get("output", {}))
+            self.condition.notify_all()
+            if job_id in self.waiters:
+                loop, future = self.waiters.pop(job_id)
+                loop.call_soon_threadsafe(self._resolve, future, self.results.pop(job_id))
+
+    @staticmethod
+    def _resolve(future, result) -> None:
+        if not future.done():
+            future.set_result(result)
+
+    def future(self, job_id: str, loop) -> "asyncio.Future":
+        """异步等待某个任务的回调: 返回在 loop 中完成的 Future"""
+        future = loop.create_future()
+        with self.condition:
+            if job_id in self.results:
+                future.set_result(self.results.pop(job_id))
+            else:
+                self.waiters[job_id] = (loop, future)
+        return future
+
+    def discard(self, job_id: str) -> None:
+        """不再等待某个任务 (超时/取消)"""
+        with self.condition:
+            self.waiters.pop(job_id, None)
+
+    def wait(self, job_id: str, timeout: float) -> dict:
+        """等待某个任务的回调，超时返回 None"""
+        with self.condition:
+            self.condition.wait_for(lambda: job_id in self.results, timeout)
+            return self.results.pop(job_id, None)
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def is_local_file(value: str) -> bool:
+    """输入是本地文件 (而不是 URL 或 r2:// 对象键)"""
+    return "://" not in value and not value.startswith("data:") and os.path.isfile(value)
+
+
+class R2Uploader:
+    """
+    本地文件直传 R2: 用预签名 PUT URL 上传 (大文件分片并行)，返回 handler 可直接读取的 r2:// 对象键
+
+    对象键按内容 SHA-256 生成，已存在的对象不重复上传；同一文件在一个 Uploader 中只上传一次
+    (批量任务共用同一张源脸时尤其有用)。凭证默认读取与 endpoint 相同的 R2_* 环境变量。
+    """
+
+    def __init__(self, account_id: str = None, access_key_id: str = None, secret_access_key: str = None,
+                 bucket: str = None, endpoint: str = None, prefix: str = UPLOAD_PREFIX):
+        account_id = account_id or os.environ.get("R2_ACCOUNT_ID", "")
+        self.endpoint = endpoint or os.environ.get("R2_ENDPOINT") or f"https://{account_id}.r2.cloudflarestorage.com"
+        self.access_key_id = access_key_id or os.environ.get("R2_ACCESS_KEY_ID", "")
+        self.secret_access_key = secret_access_key or os.environ.get("R2_SECRET_ACCESS_KEY", "")
+        self.bucket = bucket or os.environ.get("R2_BUCKET", "default")
+        self.prefix = prefix
+        self.session = create_session(UPLOAD_CONCURRENCY * 2)
+        self.executor = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY)
+        self.lock = threading.Lock()
+        self.uploads = {}  # (路径, 大小, mtime) -> Future[对象键]
+
+    def presign(self, method: str, object_key: str, query: dict = None) -> str:
+        return presign_url(self.endpoint, self.bucket, self.access_key_id, self.secret_access_key,
+                           method, object_key, 3600, query)
+
+    def upload(self, path: str) -> str:
+        """上传本地文件，返回 r2://{object_key}"""
+        stat = os.stat(path)
+        file_id = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            future = self.uploads.get(file_id)
+            owner = future is None
+            if owner:
+                future = self.uploads[file_id] = Future()
+
+        if owner:
+            try:
+                future.set_result(self._upload(path, stat.st_size))
+            except Exception as e:
+                with self.lock:
+                    self.uploads.pop(file_id, None)
+                future.set_exception(e)
+        return R2_KEY_SCHEME + future.result()
+
+    def _upload(self, path: str, size: int) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        object_key = f"{self.prefix}/{digest.hexdigest()}{os.path.splitext(path)[1].lower()}"
+
+        response = self.session.head(self.presign("HEAD", object_key), timeout=30)
+        if response.status_code == 200:
+            print(f"  Already uploaded: {path} -> {object_key}")
+            return object_key
+
+        start_time = time.time()
+        if size >= UPLOAD_MULTIPART_THRESHOLD:
+            self._upload_multipart(path, object_key, size)
+        else:
+            with open(path, "rb") as f:
+                self._put(self.presign("PUT", object_key), f)
+        elapsed = max(time.time() - start_time, 1e-6)
+        print(f"  Uploaded: {path} -> {object_key} ({size / (1024 * 1024):.1f} MB, "
+              f"{size / (1024 * 1024) / elapsed:.1f} MB/s)")
+        return object_key
+
+    def _put(self, url: str, data) -> str:
+        """PUT (网络错误与 5xx 重试)，返回 ETag"""
+        for attempt in range(1, UPLOAD_RETRIES + 1):
+            if hasattr(data, "seek"):
+                data.seek(0)
+            try:
+                response = self.session.put(url, data=data, timeout=600)
+                if response.status_code in (200, 201):
+                    return response.headers.get("ETag", "")
+                error = f"{response.status_code} - {response.text[:200]}"
+                if response.status_code < 500:
+                    break
+            except requests.RequestException as e:
+                error = str(e)
+            if attempt < UPLOAD_RETRIES:
+                time.sleep(2 ** attempt)
+        raise IOError(f"R2 upload failed: {error}")
+
+    def _upload_part(self, path: str, object_key: str, upload_id: str, number: int, offset: int, size: int) -> str:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(size)
+        return self._put(self.presign("PUT", object_key, {"partNumber": number, "uploadId": upload_id}), data)
+
+    def _upload_multipart(self, path: str, object_key: str, size: int) -> None:
+        """分片上传: 创建 -> 并发上传分片 -> 完成，失败时中止 (所有请求都使用预签名 URL)"""
+        response = self.session.post(self.presign("POST", object_key, {"uploads": ""}), timeout=60)
+        if response.status_code != 200:
+            raise IOError(f"R2 multipart create failed: {response.status_code} - {response.text[:200]}")
+        upload_id = next(e.text for e in ElementTree.fromstring(response.text).iter() if e.tag.endswith("UploadId"))
+
+        parts = [(number, offset, min(UPLOAD_PART_SIZE, size - offset))
+                 for number, offset in enumerate(range(0, size, UPLOAD_PART_SIZE), start=1)]
+        try:
+            futures = [self.executor.submit(self._upload_part, path, object_key, upload_id, number, offset, length)
+                       for number, offset, length in parts]
+            etags = [future.result() for future in futures]
+
+            body = "<CompleteMultipartUpload>" + "".join(
+                f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>"
+                for (number, _, _), etag in zip(parts, etags)
+            ) + "</CompleteMultipartUpload>"
+            response = self.session.post(self.presign("POST", object_key, {"uploadId": upload_id}),
+                                         data=body.encode("utf-8"), timeout=300)
+            # CompleteMultipartUpload 可能返回 200 但内容是 <Error>
+            if response.status_code != 200 or "<Error>" in response.text:
+                raise IOError(f"R2 multipart complete failed: {response.status_code} - {response.text[:200]}")
+        except Exception:
+            try:
+                self.session.delete(self.presign("DELETE", object_key, {"uploadId": upload_id}), timeout=60)
+            except requests.RequestException as e:
+                print(f"  Multipart abort failed: {e}")
+            raise
 
 
 class FaceFusionClient:
-    def __init__(self, api_key: str, endpoint_id: str):
+    def __init__(self, api_key: str, endpoint_id: str, callback: CallbackReceiver = None, uploader: R2Uploader = None):
         """
         初始化客户端
 
         Args:
             api_key: RunPod API Key
             endpoint_id: RunPod Endpoint ID
+            callback: 回调接收器，设置后任务完成时由 handler 推送结果，不再轮询状态
+            uploader: R2 直传，设置后 source_url / target_url 可以是本地文件路径
         """
         runpod.api_key = api_key
         self.endpoint = runpod.Endpoint(endpoint_id)
+        self.callback = callback
+        self.uploader = uploader
+        self.endpoint_url = f"{runpod.endpoint_url_base}/{endpoint_id}"
+        self.headers = {"Authorization": f"Bearer {api_key}"}
 
     def swap_face(
         self,
@@ -39,8 +328,8 @@ class FaceFusionClient:
         执行换脸操作
 
         Args:
-            source_url: 源脸图片 URL
-            target_url: 目标视频/图片 URL
+            source_url: 源脸图片 URL (设置了 uploader 时也可以是本地文件路径)
+            target_url: 目标视频/图片 URL (同上)
             face_swapper_model: 换脸模型
             face_enhancer_model: 增强模型
             face_enhancer_blend: 增强混合度 (0-100)
@@ -57,23 +346,75 @@ class FaceFusionClient:
         print(f"  Target: {target_url}")
         print(f"  Model: {face_swapper_model} + {face_enhancer_model}")
 
-        # 提交任务
-        run = self.endpoint.run({
-            "input": {
-                "source_url": source_url,
-                "target_url": target_url,
-                "face_swapper_model": face_swapper_model,
-                "face_enhancer_model": face_enhancer_model,
-                "face_enhancer_blend": face_enhancer_blend,
-                "pixel_boost": pixel_boost,
-                "output_video_quality": output_video_quality
-            }
+        job_input = {
+            "source_url": source_url,
+            "target_url": target_url,
+        }
+        self._upload_inputs(job_input)
+        job_input.update({
+            "face_swapper_model": face_swapper_model,
+            "face_enhancer_model": face_enhancer_model,
+            "face_enhancer_blend": face_enhancer_blend,
+            "pixel_boost": pixel_boost,
+            "output_video_quality": output_video_quality
         })
+        if self.callback:
+            job_input["webhook_url"] = self.callback.url
+
+        # 提交任务
+        run = self.endpoint.run({"input": job_input})
 
         print(f"Job ID: {run.job_id}")
         print("Processing...")
 
         # 等待结果
+        if self.callback:
+            result = self._wait_callback(run, timeout)
+        else:
+            result = self._poll(run, timeout)
+
+        # 保存结果
+        if save_to and result.get("status") == "success":
+            output_url = result.get("output_url", "")
+            if output_url.startswith("data:"):
+                # Base64 编码的数据
+                self._save_base64_file(output_url, save_to)
+                print(f"Saved to: {save_to}")
+            else:
+                # URL，需要下载
+                self._download_file(output_url, save_to)
+                print(f"Downloaded to: {save_to}")
+
+        return result
+
+    def _upload_inputs(self, job_input: dict) -> None:
+        """把 job input 中的本地文件路径并行上传到 R2，替换为 r2:// 对象键"""
+        fields = [(key, None) for key in ("source_url", "target_url") if isinstance(job_input.get(key), str)]
+        fields += [("target_urls", index) for index, value in enumerate(job_input.get("target_urls") or [])
+                   if isinstance(value, str)]
+
+        def value_of(field):
+            key, index = field
+            return job_input[key] if index is None else job_input[key][index]
+
+        local = [field for field in fields if is_local_file(value_of(field))]
+        if not local:
+            return
+        if self.uploader is None:
+            raise ValueError(f"Local file input requires an R2Uploader: {value_of(local[0])}")
+
+        if "target_urls" in job_input:
+            job_input["target_urls"] = list(job_input["target_urls"])
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+            keys = list(executor.map(lambda field: self.uploader.upload(value_of(field)), local))
+        for (key, index), object_key in zip(local, keys):
+            if index is None:
+                job_input[key] = object_key
+            else:
+                job_input[key][index] = object_key
+
+    def _poll(self, run, timeout: int) -> dict:
+        """每 5 秒轮询一次任务状态"""
         start_time = time.time()
         while True:
             status = run.status()
@@ -92,20 +433,244 @@ class FaceFusionClient:
             print(f"  Status: {status} ({elapsed}s elapsed)")
             time.sleep(5)
 
-        # 保存结果
-        if save_to and result.get("status") == "success":
-            output_url = result.get("output_url", "")
-            if output_url.startswith("data:"):
-                # Base64 编码的数据
-                self._save_base64_file(output_url, save_to)
-                print(f"Saved to: {save_to}")
-            else:
-                # URL，需要下载
-                self._download_file(output_url, save_to)
-                print(f"Downloaded to: {save_to}")
+        return result
+
+    def _wait_callback(self, run, timeout: int) -> dict:
+        """等待回调推送；超时后查询一次状态 (回调可能投递失败)"""
+        result = self.callback.wait(run.job_id, timeout)
+        if result is not None:
+            return result
+
+        status = run.status()
+        if status == "COMPLETED":
+            return run.output()
+        if status == "FAILED":
+            return {"error": "Job failed", "status": "failed"}
+        return {"error": "Timeout", "status": "timeout"}
+
+    async def swap_faces_batch(self, items: list, window: int = BATCH_WINDOW, timeout: int = 600,
+                               output_dir: str = None, **params) -> dict:
+        """
+        批量换脸 (asyncio)
+
+        Args:
+            items: 任务列表，每项是一个 job input (至少包含 source_url / target_url，
+                   设置了 uploader 时可以是本地文件路径)，可额外带 save_to 指定该结果的保存路径
+            window: 同时在途的任务数，完成一个才提交下一个
+            timeout: 单个任务从提交到完成的超时时间 (秒)
+            output_dir: 结果保存目录 (文件名为任务序号)，item 中的 save_to 优先
+            **params: 所有任务共用的参数 (如 face_swapper_model)，item 中的同名参数优先
+
+        Returns:
+            {"results": 按 items 顺序的结果列表, "stats": batch_stats()}
+        """
+        items = list(items)
+        print(f"Submitting {len(items)} jobs (window {window})...")
+        start_time = time.time()
+        results = []
+        async for result in self.iter_swap_faces(items, window, timeout, output_dir, **params):
+            results.append(result)
+            line = f"  [{len(results)}/{len(items)}] #{result['index']} {result['status']}"
+            if result.get("latency") is not None:
+                line += f" ({result['latency']:.1f}s)"
+            if result.get("error"):
+                line += f": {result['error']}"
+            print(line)
+
+        results.sort(key=lambda r: r["index"])
+        stats = batch_stats(results)
+        stats["wall_time"] = round(time.time() - start_time, 2)
+
+        print(f"Done: {stats['succeeded']}/{stats['jobs']} succeeded in {stats['wall_time']}s")
+        if "latency" in stats:
+            latency = stats["latency"]
+            print(f"  Latency: p50={latency['p50']}s p90={latency['p90']}s p99={latency['p99']}s max={latency['max']}s")
+        return {"results": results, "stats": stats}
+
+    async def iter_swap_faces(self, items: list, window: int = BATCH_WINDOW, timeout: int = 600,
+                              output_dir: str = None, **params):
+        """
+        按完成顺序逐个产出结果的异步迭代器 (参数同 swap_faces_batch)
+
+        每个结果: index, job_id, status, output, latency (提交到完成的秒数)，
+        以及 saved_to (已保存的本地路径) / error
+        """
+        items = list(items)
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        slots = asyncio.Semaphore(window)
+        downloads = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+        latencies = []
+
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_read=60)) as session:
+            async def run_item(index, item):
+                job_input = dict(params, **item)
+                save_to = job_input.pop("save_to", None)
+                result = {"index": index}
+                try:
+                    # 本地文件先上传 (在占用窗口之前，不影响在途任务数)
+                    await asyncio.to_thread(self._upload_inputs, job_input)
+                    # 只在任务运行期间占用窗口，下载不阻塞后续提交
+                    async with slots:
+                        result.update(await self._run_job(session, loop, job_input, timeout, latencies))
+                    output_url = result["output"].get("output_url") if result["status"] == "success" else None
+                    if output_url and (save_to or output_dir):
+                        if not save_to:
+                            ext = os.path.splitext(output_url.split("?", 1)[0])[1] if not output_url.startswith("data:") else ""
+                            save_to = os.path.join(output_dir, f"{index}{ext or '.mp4'}")
+                        await self._download_file_async(session, output_url, save_to, downloads)
+                        result["saved_to"] = save_to
+                except Exception as e:
+                    result.setdefault("status", "failed")
+                    result["error"] = f"{type(e).__name__}: {e}"
+                await queue.put(result)
+
+            tasks = [asyncio.create_task(run_item(index, item)) for index, item in enumerate(items)]
+            try:
+                for _ in range(len(tasks)):
+                    yield await queue.get()
+            finally:
+                # 调用方提前结束迭代时不再提交剩余任务
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run_job(self, session, loop, job_input: dict, timeout: int, latencies: list) -> dict:
+        """提交一个任务并等待完成 (回调推送或指数退避轮询)"""
+        if self.callback:
+            job_input["webhook_url"] = self.callback.url
+        submitted = time.time()
+        job = await self._api_request(session, "POST", "run", json={"input": job_input})
+        job_id = job["id"]
+        waiter = self.callback.future(job_id, loop) if self.callback else None
 
+        # 自适应首次查询: 已有完成的任务时，在其中位耗时附近才开始查询
+        # 之后从 POLL_INITIAL 开始按 POLL_FACTOR 增长
+        delay = POLL_INITIAL
+        if latencies:
+            delay = max(POLL_INITIAL, percentile(latencies, 50) * POLL_FIRST_RATIO)
+        polls = 0
+        state = {}
+        try:
+            while True:
+                wait = min(delay, submitted + timeout - time.time())
+                if wait <= 0:
+                    await self._cancel_job(session, job_id)
+                    return {"job_id": job_id, "status": "timeout", "output": {}, "error": "Timeout"}
+
+                if waiter is not None:
+                    await asyncio.wait({waiter}, timeout=wait)
+                    if waiter.done():
+                        state = {"status": "COMPLETED", "output": waiter.result()}
+                        break
+                else:
+                    await asyncio.sleep(wait)
+
+                state = await self._api_request(session, "GET", f"status/{job_id}")
+                if state.get("status") in FINAL_STATUSES:
+                    break
+                delay = min(POLL_INITIAL * POLL_FACTOR ** polls, POLL_MAX)
+                polls += 1
+        finally:
+            if waiter is not None:
+                self.callback.discard(job_id)
+                waiter.cancel()
+
+        latency = time.time() - submitted
+        result = {"job_id": job_id, "latency": round(latency, 3), "output": state.get("output") or {}}
+        if "delayTime" in state:
+            result["delay_time"] = state["delayTime"] / 1000
+        if "executionTime" in state:
+            result["execution_time"] = state["executionTime"] / 1000
+
+        if state["status"] == "COMPLETED":
+            latencies.append(latency)
+            result["status"] = result["output"].get("status", "success")
+            if result["output"].get("error"):
+                result["error"] = result["output"]["error"]
+        else:
+            result["status"] = "failed"
+            result["error"] = state.get("error") or f"Job {state['status'].lower()}"
         return result
 
+    async def _api_request(self, session, method: str, path: str, **kwargs) -> dict:
+        """RunPod API 请求，网络错误、429 与 5xx 按指数退避重试"""
+        for attempt in range(REQUEST_RETRIES + 1):
+            try:
+                async with session.request(method, f"{self.endpoint_url}/{path}", headers=self.headers,
+                                           **kwargs) as response:
+                    if response.status == 429 or response.status >= 500:
+                        raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                          status=response.status, message=response.reason)
+                    response.raise_for_status()
+                    return await response.json()
+            except aiohttp.ClientResponseError as e:
+                if e.status != 429 and e.status < 500 or attempt == REQUEST_RETRIES:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == REQUEST_RETRIES:
+                    raise
+            await asyncio.sleep(2 ** attempt)
+
+    async def _cancel_job(self, session, job_id: str) -> None:
+        """超时的任务取消掉，避免继续占用 GPU"""
+        try:
+            await self._api_request(session, "POST", f"cancel/{job_id}")
+        except Exception as e:
+            print(f"  Failed to cancel {job_id}: {e}")
+
+    async def _download_file_async(self, session, url: str, path: str, downloads: asyncio.Semaphore) -> None:
+        """
+        下载结果文件: 首个请求带 Range 探测大小 (预签名 URL 只对 GET 有效，不能用 HEAD)，
+        服务端支持 Range 时其余分片并行下载，否则整个文件流式写入
+        """
+        if url.startswith("data:"):
+            self._save_base64_file(url, path)
+            return
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        part_path = path + ".part"
+        try:
+            async with downloads:
+                async with session.get(url, headers={"Range": f"bytes=0-{DOWNLOAD_PART_SIZE - 1}"}) as response:
+                    response.raise_for_status()
+                    total = None
+                    if response.status == 206:
+                        match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+                        total = int(match.group(1)) if match else None
+                    with open(part_path, "wb") as f:
+                        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+
+            if total and total > DOWNLOAD_PART_SIZE:
+                with open(part_path, "r+b") as f:
+                    f.truncate(total)
+                await asyncio.gather(*(
+                    self._download_range(session, url, part_path, start, min(start + DOWNLOAD_PART_SIZE, total) - 1,
+                                         downloads)
+                    for start in range(DOWNLOAD_PART_SIZE, total, DOWNLOAD_PART_SIZE)
+                ))
+            os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    async def _download_range(self, session, url: str, path: str, start: int, end: int,
+                              downloads: asyncio.Semaphore) -> None:
+        """下载 [start, end] 字节写入文件对应位置"""
+        async with downloads:
+            async with session.get(url, headers={"Range": f"bytes={start}-{end}"}) as response:
+                if response.status != 206:
+                    raise IOError(f"Range request not honoured (HTTP {response.status})")
+                written = 0
+                with open(path, "r+b") as f:
+                    f.seek(start)
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        written += len(chunk)
+        if written != end - start + 1:
+            raise IOError(f"Incomplete range {start}-{end}: got {written} bytes")
+
     def _save_base64_file(self, data_url: str, path: str):
         """保存 base64 编码的文件"""
         # 格式: data:video/mp4;base64,xxx
@@ -1,13 +1,26 @@
 """
 预下载 FaceFusion 核心模型
 基于 FaceFusion 源码提取的准确模型路径
+
+- 只下载预设 (configs/*.ini) 与 handler 默认参数实际用到的模型 (见 model_manifest.py)；full 模式额外下载可选模型
+
+- 多线程并发下载，断点续传 (HTTP Range) 写入 .part 文件
+- 按 .hash 文件做 CRC32 校验 (与 FaceFusion 相同)，通过后才原子重命名
+- 已校验文件记录在 manifest.json 中
 """
 
+import json
 import os
 import sys
+import threading
+import urllib.error
 import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from model_manifest import model_repo, resolve_from_sources
+
 # 模型存放路径
 MODELS_DIR = Path("/facefusion/.assets/models")
 
@@ -18,131 +31,206 @@ def hf_url(repo: str, filename: str) -> str:
 
 
 # ============================================================
-# 核心模型（必需）- 来自 FaceFusion 源码
+# 所需模型 - 由 model_manifest 根据 configs/*.ini 与 handler.py 解析
 # ============================================================
 
-CORE_MODELS = {
-    # Face Detector (face_detector.py) - 使用 many 模式需要所有模型
-    "yoloface_8n.onnx": hf_url("models-3.0.0", "yoloface_8n.onnx"),
-    "yoloface_8n.hash": hf_url("models-3.0.0", "yoloface_8n.hash"),
-    "retinaface_10g.onnx": hf_url("models-3.0.0", "retinaface_10g.onnx"),
-    "retinaface_10g.hash": hf_url("models-3.0.0", "retinaface_10g.hash"),
-    "scrfd_2.5g.onnx": hf_url("models-3.0.0", "scrfd_2.5g.onnx"),
-    "scrfd_2.5g.hash": hf_url("models-3.0.0", "scrfd_2.5g.hash"),
-    "yunet_2023_mar.onnx": hf_url("models-3.4.0", "yunet_2023_mar.onnx"),
-    "yunet_2023_mar.hash": hf_url("models-3.4.0", "yunet_2023_mar.hash"),
-
-    # Face Landmarker (face_landmarker.py) - 使用 many 模式
-    "2dfan4.onnx": hf_url("models-3.0.0", "2dfan4.onnx"),
-    "2dfan4.hash": hf_url("models-3.0.0", "2dfan4.hash"),
-    "peppa_wutz.onnx": hf_url("models-3.0.0", "peppa_wutz.onnx"),
-    "peppa_wutz.hash": hf_url("models-3.0.0", "peppa_wutz.hash"),
-    "fan_68_5.onnx": hf_url("models-3.0.0", "fan_68_5.onnx"),
-    "fan_68_5.hash": hf_url("models-3.0.0", "fan_68_5.hash"),
-
-    # Face Recognizer (face_recognizer.py) - models-3.0.0
-    "arcface_w600k_r50.onnx": hf_url("models-3.0.0", "arcface_w600k_r50.onnx"),
-    "arcface_w600k_r50.hash": hf_url("models-3.0.0", "arcface_w600k_r50.hash"),
-
-    # Face Classifier (face_classifier.py) - models-3.0.0
-    "fairface.onnx": hf_url("models-3.0.0", "fairface.onnx"),
-    "fairface.hash": hf_url("models-3.0.0", "fairface.hash"),
-
-    # Face Parser/Masker (face_masker.py) - models-3.0.0
-    "bisenet_resnet_34.onnx": hf_url("models-3.0.0", "bisenet_resnet_34.onnx"),
-    "bisenet_resnet_34.hash": hf_url("models-3.0.0", "bisenet_resnet_34.hash"),
-
-    # Face Occluder (遮挡检测) - models-3.2.0
-    "xseg_3.onnx": hf_url("models-3.2.0", "xseg_3.onnx"),
-    "xseg_3.hash": hf_url("models-3.2.0", "xseg_3.hash"),
-
-    # Expression Restorer (表情修复) - models-3.0.0
-    "live_portrait_feature_extractor.onnx": hf_url("models-3.0.0", "live_portrait_feature_extractor.onnx"),
-    "live_portrait_feature_extractor.hash": hf_url("models-3.0.0", "live_portrait_feature_extractor.hash"),
-    "live_portrait_generator.onnx": hf_url("models-3.0.0", "live_portrait_generator.onnx"),
-    "live_portrait_generator.hash": hf_url("models-3.0.0", "live_portrait_generator.hash"),
-    "live_portrait_motion_extractor.onnx": hf_url("models-3.0.0", "live_portrait_motion_extractor.onnx"),
-    "live_portrait_motion_extractor.hash": hf_url("models-3.0.0", "live_portrait_motion_extractor.hash"),
-}
+# 构建镜像时 handler.py 与 configs/ 和本脚本放在同一目录
+SOURCE_DIR = Path(__file__).resolve().parent
 
 
-# ============================================================
-# 换脸模型 - 来自 face_swapper/core.py
-# ============================================================
-
-SWAPPER_MODELS = {
-    # InSwapper FP16 (推荐) - models-3.0.0
-    "inswapper_128_fp16.onnx": hf_url("models-3.0.0", "inswapper_128_fp16.onnx"),
-    "inswapper_128_fp16.hash": hf_url("models-3.0.0", "inswapper_128_fp16.hash"),
-}
+def required_models() -> list:
+    """预设与 handler 默认参数实际用到的模型"""
+    return resolve_from_sources(str(SOURCE_DIR / "handler.py"), str(SOURCE_DIR / "configs"))
 
 
 # ============================================================
-# 增强模型 - 来自 face_enhancer/core.py
+# 可选模型（full 模式，供任务参数切换）
 # ============================================================
 
-ENHANCER_MODELS = {
-    # GPEN BFR 512 (推荐) - models-3.0.0
-    "gpen_bfr_512.onnx": hf_url("models-3.0.0", "gpen_bfr_512.onnx"),
-    "gpen_bfr_512.hash": hf_url("models-3.0.0", "gpen_bfr_512.hash"),
-}
-
+OPTIONAL_MODELS = [
+    "gpen_bfr_1024", "gfpgan_1.4",  # 高清增强器
+    "inswapper_128",  # 全精度换脸模型
+    "xseg_1",  # Face Occluder (遮挡检测)
+    "peppa_wutz",  # Face Landmarker
+]
 
-# ============================================================
-# 可选模型（高质量/完整功能）
-# ============================================================
 
-OPTIONAL_MODELS = {
-    # 高清增强器 - models-3.0.0
-    "gpen_bfr_1024.onnx": hf_url("models-3.0.0", "gpen_bfr_1024.onnx"),
-    "gpen_bfr_1024.hash": hf_url("models-3.0.0", "gpen_bfr_1024.hash"),
-    "gfpgan_1.4.onnx": hf_url("models-3.0.0", "gfpgan_1.4.onnx"),
-    "gfpgan_1.4.hash": hf_url("models-3.0.0", "gfpgan_1.4.hash"),
-
-    # 全精度换脸模型 - models-3.0.0
-    "inswapper_128.onnx": hf_url("models-3.0.0", "inswapper_128.onnx"),
-    "inswapper_128.hash": hf_url("models-3.0.0", "inswapper_128.hash"),
-
-    # Face Occluder (遮挡检测) - models-3.1.0
-    "xseg_1.onnx": hf_url("models-3.1.0", "xseg_1.onnx"),
-    "xseg_1.hash": hf_url("models-3.1.0", "xseg_1.hash"),
-}
+def model_urls(names: list) -> dict:
+    """模型名 -> {文件名: URL} (.onnx 与 .hash)"""
+    models = {}
+    for name in names:
+        for ext in (".onnx", ".hash"):
+            models[name + ext] = hf_url(model_repo(name), name + ext)
+    return models
 
 
 # ============================================================
 # 下载函数
 # ============================================================
 
-def download_file(url: str, dest: Path) -> bool:
-    """下载文件"""
-    if dest.exists():
-        print(f"  [SKIP] {dest.name} already exists")
-        return True
+# 并发下载数
+DOWNLOAD_WORKERS = int(os.environ.get("MODEL_DOWNLOAD_WORKERS", "8"))
+# 每个模型的下载/校验尝试次数
+DOWNLOAD_RETRIES = int(os.environ.get("MODEL_DOWNLOAD_RETRIES", "3"))
+CHUNK_SIZE = 1024 * 1024
+
+# 已校验文件清单: {文件名: {"size", "mtime_ns", "crc32"}}
+MANIFEST_PATH = MODELS_DIR / "manifest.json"
+
+
+def create_hash(path: Path) -> str:
+    """与 FaceFusion hash_helper 相同的校验方式: zlib.crc32 的 8 位十六进制"""
+    crc = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+    return format(crc, "08x")
+
+
+class Manifest:
+    """记录已通过 CRC 校验的模型文件，大小与修改时间未变时不再重复校验"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            self.entries = json.loads(path.read_text())
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def is_verified(self, path: Path, expected_hash: str) -> bool:
+        entry = self.entries.get(path.name)
+        if not entry or not path.exists():
+            return False
+        stat = path.stat()
+        return (entry.get("crc32") == expected_hash
+                and entry.get("size") == stat.st_size
+                and entry.get("mtime_ns") == stat.st_mtime_ns)
+
+    def record(self, path: Path, crc: str) -> None:
+        stat = path.stat()
+        with self.lock:
+            self.entries[path.name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "crc32": crc}
+            # 每次记录都落盘 (原子替换)，构建中断后已校验的文件不必重来
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(self.entries, indent=2, sort_keys=True))
+            os.replace(tmp_path, self.path)
+
+
+def fetch(url: str, part_path: Path) -> None:
+    """下载到 .part 文件，已有部分时用 HTTP Range 续传"""
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
 
-    print(f"  [DOWNLOAD] {dest.name} from {url.split('/')[-3]}...")
     try:
-        urllib.request.urlretrieve(url, dest)
-        size_mb = dest.stat().st_size / (1024 * 1024)
-        print(f"  [OK] {dest.name} ({size_mb:.1f} MB)")
-        return True
+        response = urllib.request.urlopen(request, timeout=60)
+    except urllib.error.HTTPError as e:
+        # 416: .part 已经是完整文件 (或比远端更大)，交给校验判断
+        if e.code == 416:
+            return
+        raise
+
+    with response:
+        # 服务器不支持 Range 时返回 200，从头写入
+        mode = "ab" if offset and response.status == 206 else "wb"
+        with open(part_path, mode) as f:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+
+def fetch_hash(url: str, dest: Path) -> str:
+    """下载 .hash 文件 (已存在则直接读取)，返回期望的 CRC"""
+    if not dest.exists():
+        part_path = dest.with_name(dest.name + ".part")
+        part_path.unlink(missing_ok=True)
+        fetch(url, part_path)
+        os.replace(part_path, dest)
+    return dest.read_text().strip()
+
+
+def download_model(name: str, url: str, hash_url: str, manifest: Manifest) -> bool:
+    """下载一个 .onnx 模型并按其 .hash 校验，校验通过后原子重命名"""
+    dest = MODELS_DIR / name
+    part_path = dest.with_name(dest.name + ".part")
+
+    try:
+        expected_hash = fetch_hash(hash_url, dest.with_suffix(".hash"))
     except Exception as e:
-        print(f"  [ERROR] {dest.name}: {e}")
+        print(f"  [ERROR] {dest.with_suffix('.hash').name}: {e}")
         return False
 
+    if manifest.is_verified(dest, expected_hash):
+        print(f"  [SKIP] {name} verified")
+        return True
+
+    if dest.exists():
+        if create_hash(dest) == expected_hash:
+            manifest.record(dest, expected_hash)
+            print(f"  [SKIP] {name} already exists (hash ok)")
+            return True
+        # 可能是中断留下的截断文件，作为 .part 续传
+        print(f"  [RESUME] {name} exists but hash mismatch")
+        os.replace(dest, part_path)
+
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        resumed = part_path.stat().st_size if part_path.exists() else 0
+        print(f"  [DOWNLOAD] {name} from {url.split('/')[-3]}" + (f" (resume at {resumed / (1024 * 1024):.1f} MB)" if resumed else ""))
+        try:
+            fetch(url, part_path)
+        except Exception as e:
+            print(f"  [ERROR] {name} attempt {attempt}/{DOWNLOAD_RETRIES}: {e}")
+            continue
+
+        actual_hash = create_hash(part_path)
+        if actual_hash != expected_hash:
+            # 内容损坏，续传无法修复，删除后从头下载
+            print(f"  [ERROR] {name} hash mismatch ({actual_hash} != {expected_hash}), attempt {attempt}/{DOWNLOAD_RETRIES}")
+            part_path.unlink(missing_ok=True)
+            continue
+
+        os.replace(part_path, dest)
+        manifest.record(dest, expected_hash)
+        size_mb = dest.stat().st_size / (1024 * 1024)
+        print(f"  [OK] {name} ({size_mb:.1f} MB)")
+        return True
+
+    return False
+
+
+def collect_models(models: dict) -> list:
+    """把 {文件名: URL} 整理为 (onnx 文件名, onnx URL, hash URL)"""
+    tasks = []
+    for filename, url in models.items():
+        if filename.endswith(".onnx"):
+            hash_name = filename[:-len(".onnx")] + ".hash"
+            tasks.append((filename, url, models[hash_name]))
+    return tasks
+
+
+def download_models(groups: list) -> tuple:
+    """并发下载多组模型，返回 (成功数, 总数)"""
+    manifest = Manifest(MANIFEST_PATH)
+    tasks = []
+    for name, models in groups:
+        print(f"  {name}: {len(models) // 2} models")
+        tasks.extend(collect_models(models))
 
-def download_models(models: dict, name: str) -> int:
-    """下载一组模型"""
     print(f"\n{'='*60}")
-    print(f"  {name}")
+    print(f"  Downloading {len(tasks)} models with {DOWNLOAD_WORKERS} workers")
     print(f"{'='*60}")
 
-    success = 0
-    for filename, url in models.items():
-        dest = MODELS_DIR / filename
-        if download_file(url, dest):
-            success += 1
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        results = list(executor.map(lambda task: download_model(*task, manifest), tasks))
 
-    return success
+    return sum(results), len(tasks)
 
 
 def main():
@@ -158,29 +246,18 @@ def main():
     print(f"  Target: {MODELS_DIR}")
     print(f"{'#'*60}")
 
-    total = 0
-    success = 0
-
-    # 核心模型（必需）
-    total += len(CORE_MODELS)
-    success += download_models(CORE_MODELS, "Core Models (Required)")
-
-    # 换脸模型
-    total += len(SWAPPER_MODELS)
-    success += download_models(SWAPPER_MODELS, "Face Swapper (inswapper_128_fp16)")
-
-    # 增强模型
-    total += len(ENHANCER_MODELS)
-    success += download_models(ENHANCER_MODELS, "Face Enhancer (gpen_bfr_512)")
-
+    required = required_models()
+    groups = [("Required Models (presets + handler defaults)", model_urls(required))]
     # 可选模型（仅 full 模式）
     if scope == "full":
-        total += len(OPTIONAL_MODELS)
-        success += download_models(OPTIONAL_MODELS, "Optional Models")
+        optional = [name for name in OPTIONAL_MODELS if name not in required]
+        groups.append(("Optional Models", model_urls(optional)))
+
+    success, total = download_models(groups)
 
     # 统计
     print(f"\n{'='*60}")
-    print(f"  Download Complete: {success}/{total} files")
+    print(f"  Download Complete: {success}/{total} models")
     print(f"{'='*60}")
 
     # 计算总大小
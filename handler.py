@@ -8,11 +8,17 @@ FaceFusion RunPod Serverless Handler
     "input": {
         "source_url": "https://xxx/source_face.jpg",      # 源脸图片 URL
         "target_url": "https://xxx/target_video.mp4",     # 目标视频/图片 URL
+        "target_urls": ["https://xxx/a.jpg", ...],        # 或: 批量目标图片 (每张图片独立返回结果)
+                                                          # 以上输入也可以是 R2 对象键 r2://{key} (由 client 直传)
         "face_swapper_model": "inswapper_128_fp16",       # 可选，默认 inswapper_128_fp16
         "face_enhancer_model": "gpen_bfr_512",            # 可选，默认 gpen_bfr_512
         "face_enhancer_blend": 80,                        # 可选，默认 80
         "pixel_boost": "512x512",                         # 可选，默认 512x512 (可选 256x256, 1024x1024)
         "output_video_quality": 80,                       # 可选，默认 80
+        "output_format": "mp4",                           # 可选，hls: 边处理边上传分段，提前返回播放列表
+        "trim_start": 10, "trim_end": 25,                 # 可选，只处理该区间 (秒)
+        "trim_output": "window",                          # 可选，window: 只输出区间; splice: 拼回原视频
+        "face_scan": true,                                # 可选，预扫描人脸，无人脸的区间不处理
         "webhook_url": "https://xxx/callback"             # 可选，完成后回调
     }
 }
@@ -27,26 +33,51 @@ FaceFusion RunPod Serverless Handler
 
 import os
 import sys
+import asyncio
 import subprocess
 import time
 import tempfile
 import shutil
 import hashlib
 import hmac
+import secrets
+import threading
+import contextlib
+import json
+import re
+import collections
+import functools
+import queue
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client
 from pathlib import Path
 from datetime import datetime, timezone
-from urllib.parse import urlparse, quote
+from urllib.parse import unquote, urlparse
 import requests
 
 # RunPod handler
 import runpod
 
+from model_manifest import DETECTOR_STRATEGIES, read_ini, resolve_deployment_models
+from storage import R2_KEY_SCHEME, LocalStorage, R2Storage, create_session, download_ranged, download_stream
+
 # R2 配置 (从环境变量读取)
 R2_ACCOUNT_ID = os.environ.get("R2_ACCOUNT_ID", "")
 R2_ACCESS_KEY_ID = os.environ.get("R2_ACCESS_KEY_ID", "")
 R2_SECRET_ACCESS_KEY = os.environ.get("R2_SECRET_ACCESS_KEY", "")
 R2_BUCKET = os.environ.get("R2_BUCKET", "default")
-R2_ENDPOINT = f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com" if R2_ACCOUNT_ID else ""
+R2_ENDPOINT = os.environ.get("R2_ENDPOINT") or (f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com" if R2_ACCOUNT_ID else "")
+
+# 存储后端: r2 (R2 / S3 兼容，可通过 R2_ENDPOINT 指向本地 S3 兼容服务) | local (本地目录，测试与基准测试用)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "r2")
+STORAGE_LOCAL_DIR = os.environ.get("STORAGE_LOCAL_DIR", "/tmp/facefusion_storage")
+
+# R2 分片上传配置
+R2_MULTIPART_THRESHOLD = int(os.environ.get("R2_MULTIPART_THRESHOLD", str(64 * 1024 * 1024)))  # 超过此大小使用分片上传
+R2_PART_SIZE = int(os.environ.get("R2_PART_SIZE", str(16 * 1024 * 1024)))  # 分片大小
+R2_UPLOAD_CONCURRENCY = int(os.environ.get("R2_UPLOAD_CONCURRENCY", "8"))  # 并发上传分片数
+R2_PART_RETRIES = int(os.environ.get("R2_PART_RETRIES", "3"))  # 每个分片的重试次数
 
 # 配置
 FACEFUSION_PATH = "/facefusion"
@@ -54,6 +85,130 @@ MODELS_PATH = "/facefusion/.assets/models"
 TEMP_DIR = "/tmp/facefusion_jobs"
 CONFIGS_PATH = "/facefusion/configs"
 
+# 下载配置
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB 写缓冲
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "8"))  # 分段下载并发数
+RANGED_DOWNLOAD_MIN_SIZE = int(os.environ.get("RANGED_DOWNLOAD_MIN_SIZE", str(32 * 1024 * 1024)))  # 超过此大小才分段
+
+# 输入文件缓存 (warm worker 上跨任务复用，INPUT_CACHE=0 关闭)
+INPUT_CACHE_ENABLED = os.environ.get("INPUT_CACHE", "1") == "1"
+INPUT_CACHE_DIR = os.environ.get("INPUT_CACHE_DIR", "/tmp/facefusion_cache")
+INPUT_CACHE_MAX_BYTES = int(os.environ.get("INPUT_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))  # 10GB
+INPUT_CACHE_MAX_AGE = int(os.environ.get("INPUT_CACHE_MAX_AGE", str(24 * 3600)))  # 24小时
+
+# 结果缓存: 相同输入与参数直接返回已有结果 (RESULT_CACHE=0 关闭)
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE", "1") == "1"
+
+# 完成回调 (webhook_url): 后台线程推送，HMAC-SHA256 签名，失败按指数退避重试
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")  # 为空时不签名
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", "6"))
+WEBHOOK_BACKOFF = float(os.environ.get("WEBHOOK_BACKOFF", "2"))  # 首次重试间隔 (秒)，之后翻倍
+WEBHOOK_MAX_BACKOFF = float(os.environ.get("WEBHOOK_MAX_BACKOFF", "300"))
+WEBHOOK_TIMEOUT = float(os.environ.get("WEBHOOK_TIMEOUT", "10"))  # 后台重试的请求超时
+WEBHOOK_INLINE_TIMEOUT = float(os.environ.get("WEBHOOK_INLINE_TIMEOUT", "2"))  # 返回响应前的首次投递超时，0 表示全部在后台投递
+
+# 常驻 Worker 配置 (FACEFUSION_WORKER=0 关闭，每个任务回退为独立子进程)
+WORKER_ENABLED = os.environ.get("FACEFUSION_WORKER", "1") == "1"
+WORKER_BACKEND = os.environ.get("FACEFUSION_WORKER_BACKEND", "facefusion")  # facefusion | stub
+WORKER_SOCKET = os.environ.get("FACEFUSION_WORKER_SOCKET", "/tmp/facefusion_worker.sock")
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+WORKER_START_TIMEOUT = int(os.environ.get("FACEFUSION_WORKER_START_TIMEOUT", "300"))
+WORKER_MAX_RESTARTS = int(os.environ.get("FACEFUSION_WORKER_MAX_RESTARTS", "3"))
+WORKER_OUTPUT_SYNC_PREFIX = "[worker] output-sync "  # 与 worker.py 的 OUTPUT_SYNC_PREFIX 一致
+WORKER_OUTPUT_SYNC_TIMEOUT = 10  # 等待输出线程读完一次请求输出的最长时间 (秒)
+JOB_TIMEOUT = 3600  # 1小时超时
+
+# FaceFusion 阶段日志 (阶段名, 日志关键字)，需要 info 级别 (build_facefusion_args 保证)
+FACEFUSION_PHASES = [
+    ("extract_frames", "Extracting frames"),
+    ("merge_video", "Merging video"),
+    ("restore_audio", "Restoring audio"),
+]
+
+# 进度条描述 -> 阶段名
+PROGRESS_STAGE_PHASES = {
+    "extracting": "extract_frames",
+    "processing": "inference",
+    "merging": "merge_video",
+}
+
+# 进度与日志
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "5"))  # 进度推送最小间隔 (秒)
+LOG_TAIL_LINES = int(os.environ.get("LOG_TAIL_LINES", "200"))  # 错误报告中保留的日志行数
+PROGRESS_LOG_LEVELS = ("info", "debug")  # FaceFusion 在 warn/error 级别关闭进度条 (tqdm)
+PROGRESS_PATTERN = re.compile(r"(\d+)/(\d+) \[[^<\]]*<[^,\]]*,\s*([\d.]+)\s*(frame/s|s/frame)")
+
+# 并发流水线配置 (HANDLER_CONCURRENCY > 1 时下载/上传与其他任务的 GPU 处理重叠)
+HANDLER_CONCURRENCY = int(os.environ.get("HANDLER_CONCURRENCY", "1"))
+PIPELINE_PREFETCH = int(os.environ.get("PIPELINE_PREFETCH", "2"))  # 已下载、等待 GPU 的任务上限
+PIPELINE_DISK_BUDGET = int(os.environ.get("PIPELINE_DISK_BUDGET", str(15 * 1024 ** 3)))  # 进行中任务的磁盘预算
+PIPELINE_DISK_FACTOR = float(os.environ.get("PIPELINE_DISK_FACTOR", "4"))  # 输入大小 -> 任务磁盘占用系数
+PIPELINE_DEFAULT_INPUT_SIZE = 512 * 1024 * 1024  # 无法获取大小时按 512MB 估算
+
+# 任务工作区 (FaceFusion 临时帧与临时视频): 预估占用放得下时使用内存盘 (tmpfs)，否则使用磁盘
+WORKSPACE_RAM_DIR = os.environ.get("WORKSPACE_RAM_DIR", "/dev/shm/facefusion_jobs")  # 为空时不使用内存盘
+WORKSPACE_RAM_FRACTION = float(os.environ.get("WORKSPACE_RAM_FRACTION", "0.5"))  # 内存盘容量中可用于工作区的比例
+WORKSPACE_DISK_QUOTA = int(os.environ.get("WORKSPACE_DISK_QUOTA", str(PIPELINE_DISK_BUDGET)))  # 进行中任务的磁盘工作区总配额
+# 临时帧每像素的预估字节数: bmp 不压缩 (写入最快)，png 无损压缩
+TEMP_FRAME_BYTES_PER_PIXEL = {"bmp": 3.0, "png": 2.0}
+
+# 分段并行配置 (长视频在关键帧处切分，多个本地 Worker 同时处理)
+SEGMENT_COUNT = int(os.environ.get("SEGMENT_COUNT", "1"))  # 默认段数，1 表示不分段
+SEGMENT_WORKERS = int(os.environ.get("SEGMENT_WORKERS", "1"))  # 同时处理的本地 Worker 数 (每个都在同一 GPU 上加载整套模型)
+SEGMENT_WORKER_VRAM = int(os.environ.get("SEGMENT_WORKER_VRAM", "6144"))  # 每增加一个 Worker 需要的空闲显存 (MB)
+SEGMENT_MIN_DURATION = float(os.environ.get("SEGMENT_MIN_DURATION", "30"))  # 每段最短时长 (秒)
+
+# 渐进式输出 (output_format=hls): 分段处理完成一段即上传一段
+OUTPUT_FORMATS = ("mp4", "hls")
+HLS_SEGMENT_DURATION = float(os.environ.get("HLS_SEGMENT_DURATION", "10"))  # 分段目标时长 (秒)，实际在关键帧处切分
+HLS_AUDIO_BITRATE = os.environ.get("HLS_AUDIO_BITRATE", "128k")
+
+# 区间处理 (trim_start / trim_end，单位秒)
+# window: 只输出该区间; splice: 处理后的区间流复制拼回原视频
+TRIM_OUTPUTS = ("window", "splice")
+
+# 人脸预扫描 (face_scan): 低帧率检测人脸，没有人脸的区间流复制，不经过 FaceFusion
+FACE_SCAN_ENABLED = os.environ.get("FACE_SCAN", "0") == "1"  # 任务未指定 face_scan 时的默认值
+FACE_SCAN_FPS = float(os.environ.get("FACE_SCAN_FPS", "2"))  # 采样帧率
+FACE_SCAN_SIZE = int(os.environ.get("FACE_SCAN_SIZE", "640"))  # 采样帧长边 (像素)
+FACE_SCAN_DETECTOR = os.environ.get("FACE_SCAN_DETECTOR", "yolo_face")  # 单个轻量检测器
+FACE_SCAN_SCORE = float(os.environ.get("FACE_SCAN_SCORE", "0.35"))  # 低于处理时的阈值，宁可多处理
+FACE_SCAN_PADDING = float(os.environ.get("FACE_SCAN_PADDING", "1"))  # 人脸区间前后扩展 (秒)
+FACE_SCAN_MIN_GAP = float(os.environ.get("FACE_SCAN_MIN_GAP", "4"))  # 更短的无人脸间隔仍然处理 (秒)
+FACE_SCAN_MIN_SKIP = float(os.environ.get("FACE_SCAN_MIN_SKIP", "0.1"))  # 可跳过的比例低于此值时整段处理
+
+# 批量图片任务 (target_urls)
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "500"))  # 单个任务的图片数上限
+BATCH_DOWNLOAD_CONCURRENCY = int(os.environ.get("BATCH_DOWNLOAD_CONCURRENCY", "8"))  # 并发下载/查询数
+
+# 下载前预检 (preflight): 读取文件头与媒体信息并估算 GPU 耗时，不符合要求的任务在下载前拒绝
+PREFLIGHT_ENABLED = os.environ.get("PREFLIGHT", "1") == "1"
+PREFLIGHT_TIMEOUT = float(os.environ.get("PREFLIGHT_TIMEOUT", "10"))  # 文件头读取与 ffprobe 超时 (秒)
+PREFLIGHT_YTDLP_TIMEOUT = float(os.environ.get("PREFLIGHT_YTDLP_TIMEOUT", "30"))  # yt-dlp 元数据超时 (秒)
+PREFLIGHT_SNIFF_BYTES = 512  # 识别文件类型读取的字节数
+MAX_INPUT_SIZE = int(os.environ.get("MAX_INPUT_SIZE", "0"))  # 输入文件大小上限 (字节)，0 表示不限制 (下同)
+MAX_DURATION = float(os.environ.get("MAX_DURATION", "0"))  # 处理时长上限 (秒，区间任务按区间计)
+MAX_PIXELS = int(os.environ.get("MAX_PIXELS", "0"))  # 目标分辨率上限 (宽 x 高)
+MAX_GPU_SECONDS = float(os.environ.get("MAX_GPU_SECONDS", "0"))  # 预估 GPU 耗时上限 (秒)
+
+# 文件头特征 ([(偏移, 字节), ...], 类型, 扩展名)，按顺序匹配
+MEDIA_SIGNATURES = [
+    ([(0, b"\xff\xd8\xff")], "image", ".jpg"),
+    ([(0, b"\x89PNG\r\n\x1a\n")], "image", ".png"),
+    ([(0, b"RIFF"), (8, b"WEBP")], "image", ".webp"),
+    ([(0, b"BM")], "image", ".bmp"),
+    ([(4, b"ftypqt")], "video", ".mov"),
+    ([(4, b"ftyp")], "video", ".mp4"),
+    ([(0, b"RIFF"), (8, b"AVI ")], "video", ".avi"),
+    ([(0, b"\x1a\x45\xdf\xa3")], "video", ".mkv"),  # Matroska / WebM
+]
+
+# 图片扩展名
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+# 只对视频输出有效的参数 (图片目标不传)
+VIDEO_ONLY_OPTIONS = {"output_video_quality", "output_video_preset", "output_audio_encoder", "trim_frame_start", "trim_frame_end"}
+
 # 预制配置
 PRESET_CONFIGS = {
     "fast": "video_fast.ini",
@@ -61,6 +216,65 @@ PRESET_CONFIGS = {
     "serverless": "serverless.ini"
 }
 
+# 本地开发时预设文件位于仓库 configs/ 目录
+LOCAL_CONFIGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs")
+
+# 参数名 -> FaceFusion 命令行选项
+FACEFUSION_OPTIONS = {
+    "processors": "--processors",
+    "face_swapper_model": "--face-swapper-model",
+    "pixel_boost": "--face-swapper-pixel-boost",
+    "face_swapper_weight": "--face-swapper-weight",
+    "face_enhancer_model": "--face-enhancer-model",
+    "face_enhancer_blend": "--face-enhancer-blend",
+    "expression_restorer_model": "--expression-restorer-model",
+    "expression_restorer_factor": "--expression-restorer-factor",
+    "face_selector_mode": "--face-selector-mode",
+    "face_detector_model": "--face-detector-model",
+    "face_detector_score": "--face-detector-score",
+    "face_landmarker_model": "--face-landmarker-model",
+    "face_mask_types": "--face-mask-types",
+    "face_mask_blur": "--face-mask-blur",
+    "face_occluder_model": "--face-occluder-model",
+    "output_image_quality": "--output-image-quality",
+    "output_video_quality": "--output-video-quality",
+    "output_video_preset": "--output-video-preset",
+    "output_audio_encoder": "--output-audio-encoder",
+    "execution_providers": "--execution-providers",
+    "execution_thread_count": "--execution-thread-count",
+    "video_memory_strategy": "--video-memory-strategy",
+    "log_level": "--log-level",
+}
+
+# 处理阶段计算的选项 (不接受任务直接传入): trim_start / trim_end 换算的帧区间，任务工作区
+RUNTIME_OPTIONS = {
+    "trim_frame_start": "--trim-frame-start",
+    "trim_frame_end": "--trim-frame-end",
+    "temp_path": "--temp-path",
+    "temp_frame_format": "--temp-frame-format",
+}
+
+# 旧版检测器名 -> FaceFusion 3.x 的名称 (3.x 的 argparse 不接受旧名)
+FACE_DETECTOR_ALIASES = {"yoloface": "yolo_face"}
+
+# 以空格分隔的多值参数
+MULTI_VALUE_OPTIONS = {"processors", "face_mask_types"}
+
+# auto 预设: 从高质量到高速的档位，按预估耗时选择能满足时间预算的最高档
+# frame_cost 为 1080p 下每帧的粗略 GPU 耗时 (秒)
+AUTO_TIERS = [
+    {"name": "quality", "frame_cost": 0.25, "params": {
+        "processors": "face_swapper face_enhancer expression_restorer", "pixel_boost": "512x512",
+        "face_detector_model": "retinaface", "expression_restorer_model": "live_portrait"}},
+    {"name": "balanced", "frame_cost": 0.12, "params": {
+        "processors": "face_swapper face_enhancer", "pixel_boost": "512x512", "face_detector_model": "yolo_face"}},
+    {"name": "fast", "frame_cost": 0.07, "params": {
+        "processors": "face_swapper face_enhancer", "pixel_boost": "256x256", "face_detector_model": "yolo_face"}},
+    {"name": "fastest", "frame_cost": 0.035, "params": {
+        "processors": "face_swapper", "pixel_boost": "256x256", "face_detector_model": "yolo_face"}},
+]
+AUTO_TIME_BUDGET = float(os.environ.get("AUTO_TIME_BUDGET", "600"))  # auto 预设默认时间预算 (秒)
+
 # 默认参数
 DEFAULT_PARAMS = {
     "face_swapper_model": "inswapper_128_fp16",
@@ -70,9 +284,15 @@ DEFAULT_PARAMS = {
     "output_video_quality": 80,
     "output_audio_encoder": "aac",
     "execution_providers": "cuda",
+    "face_occluder_model": "xseg_3",  # 镜像内预置的遮挡模型
+    "face_landmarker_model": "2dfan4",
+    "face_detector_strategy": "fallback",  # single | many | fallback (找不到人脸时用全部检测器重试)
     "preset": "serverless",  # 默认使用 serverless 配置
 }
 
+# FaceFusion 找不到人脸时的日志 (detector fallback 的触发条件)
+NO_FACE_PATTERN = re.compile(r"no (source |target )?faces? (detected|found)", re.IGNORECASE)
+
 # yt-dlp 支持的网站域名模式
 YTDLP_SUPPORTED_DOMAINS = [
     # 主流视频平台
@@ -86,6 +306,57 @@ YTDLP_SUPPORTED_DOMAINS = [
 ]
 
 
+class JobTrace:
+    """
+    记录任务各阶段的耗时与吞吐
+    每个阶段: seconds，以及可选的 bytes / mb_per_s / frames / fps
+    同名阶段 (如分段处理) 会累加
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **metrics):
+        """阶段计时上下文，可在 with 块内向 yield 的 dict 写入 bytes/frames 等指标"""
+        record = dict(metrics)
+        start_time = time.time()
+        try:
+            yield record
+        finally:
+            self.add(name, time.time() - start_time, **record)
+
+    def add(self, name: str, seconds: float, **metrics) -> None:
+        """直接记录一个阶段的耗时与指标"""
+        record = dict(metrics, seconds=seconds)
+        with self.lock:
+            stage = self.stages.setdefault(name, {"seconds": 0.0})
+            for key, value in record.items():
+                if key in ("seconds", "bytes", "frames") and isinstance(value, (int, float)):
+                    stage[key] = stage.get(key, 0) + value
+                else:
+                    stage[key] = value
+
+            seconds = stage["seconds"]
+            if stage.get("bytes") and seconds > 0:
+                stage["mb_per_s"] = round(stage["bytes"] / (1024 * 1024) / seconds, 2)
+            if stage.get("frames") and seconds > 0:
+                stage["fps"] = round(stage["frames"] / seconds, 2)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {name: {k: round(v, 3) if isinstance(v, float) else v for k, v in stage.items()}
+                    for name, stage in self.stages.items()}
+
+
+def trace_stage(trace: JobTrace, name: str, **metrics):
+    """trace 为空时返回不记录的上下文"""
+    if trace is None:
+        return contextlib.nullcontext(dict(metrics))
+    return trace.stage(name, **metrics)
+
+
 def is_ytdlp_url(url: str) -> bool:
     """检查 URL 是否需要 yt-dlp 下载"""
     try:
@@ -104,8 +375,11 @@ def is_ytdlp_url(url: str) -> bool:
         return False
 
 
-def download_with_ytdlp(url: str, dest_path: str) -> str:
-    """使用 yt-dlp 下载视频"""
+def download_with_ytdlp(url: str, dest_path: str, section: tuple = None) -> str:
+    """
+    使用 yt-dlp 下载视频
+    section: (开始秒, 结束秒或 None)，只下载该区间并在切点强制关键帧 (片段从开始秒精确起始)
+    """
     import subprocess
 
     print(f"Downloading with yt-dlp: {url}")
@@ -121,8 +395,11 @@ def download_with_ytdlp(url: str, dest_path: str) -> str:
         "--no-playlist",              # 不下载播放列表
         "-o", os.path.join(dest_dir, f"{dest_name}.%(ext)s"),
         "--no-warnings",
-        url
     ]
+    if section:
+        start, end = section
+        cmd += ["--download-sections", f"*{start:g}-{'inf' if end is None else f'{end:g}'}", "--force-keyframes-at-cuts"]
+    cmd.append(url)
 
     print(f"Running: {' '.join(cmd)}")
     result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
@@ -151,366 +428,2723 @@ def download_with_ytdlp(url: str, dest_path: str) -> str:
     return downloaded_file
 
 
-def download_file(url: str, dest_path: str) -> str:
-    """下载文件到指定路径（自动检测是否使用 yt-dlp）"""
+def probe_http(url: str) -> dict:
+    """HEAD 请求获取文件大小、是否支持 Range 以及缓存校验头 (ETag/Last-Modified)"""
+    probe = {"size": 0, "accept_ranges": False, "etag": "", "last_modified": ""}
+    try:
+        response = http_session.head(url, allow_redirects=True, timeout=30)
+    except requests.RequestException as e:
+        print(f"  HEAD failed ({e}), using single stream")
+        return probe
 
-    # 检查是否需要 yt-dlp
-    if is_ytdlp_url(url):
-        return download_with_ytdlp(url, dest_path)
+    if response.status_code != 200:
+        return probe
 
-    # 普通 HTTP 下载
-    print(f"Downloading: {url}")
-    response = requests.get(url, stream=True, timeout=300)
-    response.raise_for_status()
+    probe["size"] = int(response.headers.get("Content-Length") or 0)
+    probe["accept_ranges"] = response.headers.get("Accept-Ranges", "").lower() == "bytes" and probe["size"] > 0
+    probe["etag"] = response.headers.get("ETag", "")
+    probe["last_modified"] = response.headers.get("Last-Modified", "")
+    return probe
 
-    with open(dest_path, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
 
-    print(f"Downloaded to: {dest_path}")
-    return dest_path
+def download_file(url: str, dest_path: str, probe: dict = None, trace: JobTrace = None, stage: str = "download") -> str:
+    """下载文件到指定路径（自动检测是否使用 yt-dlp）"""
+    with trace_stage(trace, stage) as record:
+        # 检查是否需要 yt-dlp
+        if is_ytdlp_url(url):
+            record["method"] = "ytdlp"
+            dest_path = download_with_ytdlp(url, dest_path)
+            record["bytes"] = os.path.getsize(dest_path)
+            return dest_path
+
+        print(f"Downloading: {url}")
+        if probe is None:
+            probe = probe_input(url)
+
+        # 对象存储中的输入 (r2://): 由存储客户端读取 (同区域，不经过公网中转)
+        if is_r2_key(url):
+            record["method"] = object_storage.get(url[len(R2_KEY_SCHEME):], dest_path, probe["size"])
+            print(f"Downloaded to: {dest_path}")
+            record["bytes"] = os.path.getsize(dest_path)
+            return dest_path
+
+        # 普通 HTTP 下载: 大文件且支持 Range 时分段并发，否则单连接
+        if probe["accept_ranges"] and probe["size"] >= RANGED_DOWNLOAD_MIN_SIZE:
+            try:
+                download_ranged(http_session, url, dest_path, probe["size"], DOWNLOAD_CONNECTIONS)
+                print(f"Downloaded to: {dest_path}")
+                record["method"] = "ranged"
+                record["bytes"] = os.path.getsize(dest_path)
+                return dest_path
+            except Exception as e:
+                print(f"  Ranged download failed ({e}), falling back to single stream")
+
+        download_stream(http_session, url, dest_path)
+        print(f"Downloaded to: {dest_path}")
+        record["method"] = "stream"
+        record["bytes"] = os.path.getsize(dest_path)
+        return dest_path
+
+
+def get_ytdlp_video_id(url: str) -> str:
+    """获取 yt-dlp 的 extractor:id，用作缓存键 (不下载视频)"""
+    cmd = ["yt-dlp", "--no-playlist", "--no-warnings", "--skip-download", "--print", "%(extractor)s:%(id)s", url]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+    except Exception as e:
+        print(f"  yt-dlp id lookup failed: {e}")
+        return ""
+    if result.returncode != 0:
+        return ""
+    lines = result.stdout.strip().splitlines()
+    return lines[0] if lines else ""
 
 
-def _sign(key, msg):
-    """HMAC-SHA256 签名"""
-    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+def hash_file(path: str) -> str:
+    """计算文件 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def _get_signature_key(key, date_stamp, region, service):
-    """生成 AWS S3 签名密钥"""
-    k_date = _sign(('AWS4' + key).encode('utf-8'), date_stamp)
-    k_region = _sign(k_date, region)
-    k_service = _sign(k_region, service)
-    k_signing = _sign(k_service, 'aws4_request')
-    return k_signing
+def link_or_copy(src: str, dest: str) -> None:
+    """优先硬链接，跨文件系统时回退为复制"""
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
 
 
-def upload_to_r2(file_path: str, object_key: str) -> str:
-    """上传文件到 R2 并返回预签名 URL"""
-    if not R2_ACCOUNT_ID or not R2_ACCESS_KEY_ID or not R2_SECRET_ACCESS_KEY:
-        raise ValueError("R2 credentials not configured. Set R2_ACCOUNT_ID, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY environment variables.")
+class InputCache:
+    """
+    按内容寻址的输入文件缓存
+    - 缓存键: URL + 校验头 (ETag/Last-Modified) 或 yt-dlp 视频 ID
+    - 对象按内容 SHA-256 存放在 objects/ 下，通过硬链接放入任务目录
+    - 按总大小 (LRU) 和最长闲置时间淘汰
+    """
 
-    print(f"Uploading to R2: {object_key}")
-    file_size = os.path.getsize(file_path)
-    print(f"  File size: {file_size / (1024 * 1024):.1f} MB")
+    def __init__(self, cache_dir: str = INPUT_CACHE_DIR, max_bytes: int = INPUT_CACHE_MAX_BYTES, max_age: int = INPUT_CACHE_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    def _load_index(self) -> dict:
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self) -> None:
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _object_path(self, entry: dict) -> str:
+        return os.path.join(self.objects_dir, entry["hash"] + entry["ext"])
+
+    def make_key(self, url: str, probe: dict = None) -> str:
+        """生成缓存键，没有可靠校验信息时返回空字符串 (不缓存)"""
+        if is_ytdlp_url(url):
+            video_id = get_ytdlp_video_id(url)
+            return f"ytdlp:{video_id}" if video_id else ""
+
+        probe = probe or {}
+        if not probe.get("etag") and not probe.get("last_modified"):
+            return ""
+        raw = f"{url}|{probe.get('etag', '')}|{probe.get('last_modified', '')}"
+        return "http:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, dest_path: str) -> tuple:
+        """命中时把缓存对象链接到任务目录，返回 (路径, 内容哈希)，未命中返回空字符串"""
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None or not os.path.exists(self._object_path(entry)):
+                self.misses += 1
+                return "", ""
+
+            # 保留缓存对象的实际扩展名 (yt-dlp 可能不是 .mp4)
+            dest_path = os.path.splitext(dest_path)[0] + entry["ext"]
+            link_or_copy(self._object_path(entry), dest_path)
+            entry["last_used"] = time.time()
+            self._save_index()
+            self.hits += 1
+            return dest_path, entry["hash"]
+
+    def put(self, key: str, path: str) -> str:
+        """把刚下载的文件加入缓存，返回内容哈希"""
+        content_hash = hash_file(path)
+        entry = {
+            "hash": content_hash,
+            "ext": os.path.splitext(path)[1].lower(),
+            "size": os.path.getsize(path),
+            "last_used": time.time(),
+        }
+        with self.lock:
+            object_path = self._object_path(entry)
+            if not os.path.exists(object_path):
+                link_or_copy(path, object_path)
+            self.index[key] = entry
+            self._evict()
+            self._save_index()
+        return content_hash
+
+    def _evict(self) -> None:
+        """删除过期条目，再按 LRU 删除直到总大小低于上限"""
+        now = time.time()
+        for key in [k for k, e in self.index.items() if now - e["last_used"] > self.max_age]:
+            del self.index[key]
+
+        # 同一内容可能被多个键引用，按对象统计大小
+        objects = {}
+        for entry in self.index.values():
+            name = entry["hash"] + entry["ext"]
+            objects[name] = max(objects.get(name, 0), entry["last_used"])
+        sizes = {name: os.path.getsize(os.path.join(self.objects_dir, name))
+                 for name in objects if os.path.exists(os.path.join(self.objects_dir, name))}
+        total = sum(sizes.values())
+
+        for name in sorted(objects, key=objects.get):
+            if total <= self.max_bytes:
+                break
+            total -= sizes.get(name, 0)
+            del objects[name]
+            self.index = {k: e for k, e in self.index.items() if e["hash"] + e["ext"] != name}
+
+        # 删除不再被引用的对象文件
+        for name in os.listdir(self.objects_dir):
+            if name not in objects:
+                os.remove(os.path.join(self.objects_dir, name))
+
+    def stats(self) -> dict:
+        with self.lock:
+            size = sum(os.path.getsize(os.path.join(self.objects_dir, name)) for name in os.listdir(self.objects_dir))
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.index),
+                "size_mb": round(size / (1024 * 1024), 1),
+            }
+
+
+# 全局输入缓存实例
+input_cache = InputCache() if INPUT_CACHE_ENABLED else None
+
+
+def get_path_size(path: str) -> int:
+    """文件或目录 (递归) 的大小"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for name in file_names:
+            try:
+                total += os.path.getsize(os.path.join(dir_path, name))
+            except OSError:
+                pass
+    return total
+
+
+def is_tmpfs(path: str) -> bool:
+    """path 所在的文件系统是否为内存盘 (按 /proc/mounts 中最长的挂载点匹配)"""
+    path = os.path.realpath(path)
+    mount_point, fs_type = "", ""
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3 and (path == fields[1] or path.startswith(fields[1].rstrip("/") + "/")) and len(fields[1]) > len(mount_point):
+                    mount_point, fs_type = fields[1], fields[2]
+    except OSError:
+        return False
+    return fs_type in ("tmpfs", "ramfs")
 
-    # 准备请求
-    method = 'PUT'
-    service = 's3'
-    region = 'auto'
-    host = f"{R2_ACCOUNT_ID}.r2.cloudflarestorage.com"
-    endpoint = f"{R2_ENDPOINT}/{R2_BUCKET}/{object_key}"
 
-    # 时间戳
-    t = datetime.now(timezone.utc)
-    amz_date = t.strftime('%Y%m%dT%H%M%SZ')
-    date_stamp = t.strftime('%Y%m%d')
+class WorkspaceManager:
+    """
+    FaceFusion 临时帧工作区的放置与配额
+    - 预估占用 (帧数 x 分辨率 x 每像素字节) 放得下内存盘预算时放在 tmpfs，临时帧优先用 bmp (不压缩)
+    - 否则放在磁盘 (任务目录下) 并使用 png；所有进行中任务的磁盘工作区受总配额约束
+    - 启动时清理上次进程遗留的任务目录 (崩溃的任务不会执行 cleanup_job)
+    """
 
-    # 确定 Content-Type
-    ext = os.path.splitext(file_path)[1].lower()
-    content_types = {
-        '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg',
-        '.png': 'image/png', '.webp': 'image/webp',
-        '.mp4': 'video/mp4', '.mov': 'video/quicktime',
-        '.avi': 'video/x-msvideo', '.mkv': 'video/x-matroska',
-    }
-    content_type = content_types.get(ext, 'application/octet-stream')
-
-    # 使用 UNSIGNED-PAYLOAD 避免计算大文件哈希
-    payload_hash = 'UNSIGNED-PAYLOAD'
-
-    # 规范请求
-    canonical_uri = f'/{R2_BUCKET}/{object_key}'
-    canonical_querystring = ''
-    canonical_headers = (
-        f'content-type:{content_type}\n'
-        f'host:{host}\n'
-        f'x-amz-content-sha256:{payload_hash}\n'
-        f'x-amz-date:{amz_date}\n'
-    )
-    signed_headers = 'content-type;host;x-amz-content-sha256;x-amz-date'
-    canonical_request = (
-        f'{method}\n{canonical_uri}\n{canonical_querystring}\n'
-        f'{canonical_headers}\n{signed_headers}\n{payload_hash}'
-    )
+    def __init__(self, ram_dir: str = WORKSPACE_RAM_DIR, ram_fraction: float = WORKSPACE_RAM_FRACTION, disk_quota: int = WORKSPACE_DISK_QUOTA):
+        self.ram_dir = ram_dir
+        self.ram_budget = 0
+        if ram_dir and is_tmpfs(os.path.dirname(ram_dir.rstrip("/"))):
+            self.ram_budget = int(shutil.disk_usage(os.path.dirname(ram_dir.rstrip("/"))).total * ram_fraction)
+        self.disk_quota = disk_quota
+        self.reserved = {"ram": 0, "disk": 0}
+        self.workspaces = {}
+        self.condition = threading.Condition()
+
+    def sweep(self) -> dict:
+        """删除任务目录根与内存盘工作区下的全部条目 (启动时调用，此时没有进行中的任务)"""
+        swept, freed = 0, 0
+        for root in filter(None, (TEMP_DIR, self.ram_dir)):
+            if not os.path.isdir(root):
+                continue
+            for name in os.listdir(root):
+                path = os.path.join(root, name)
+                try:
+                    freed += get_path_size(path)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                    swept += 1
+                except OSError as e:
+                    print(f"  Workspace sweep failed for {path}: {e}")
+        if swept:
+            print(f"Swept {swept} stale job directories ({freed / 1024 ** 2:.1f}MB)")
+        return {"swept": swept, "swept_bytes": freed}
+
+    def acquire(self, job_id: str, footprints: dict, job_dir: str) -> dict:
+        """
+        为任务放置工作区，footprints 为各临时帧格式的预估占用 {"bmp": bytes, "png": bytes}
+        返回 {"location", "path", "frame_format", "reserved_bytes"}
+        """
+        with self.condition:
+            if self.ram_budget:
+                free = shutil.disk_usage(os.path.dirname(self.ram_dir.rstrip("/"))).free
+                for frame_format in ("bmp", "png"):
+                    size = footprints[frame_format]
+                    if self.reserved["ram"] + size <= self.ram_budget and size < free:
+                        return self._place(job_id, "ram", os.path.join(self.ram_dir, job_id), frame_format, size)
+
+            # 超过总配额的任务按配额预留 (等其他任务释放后独占)，实际空间不足时由 FaceFusion 报错
+            size = min(footprints["png"], self.disk_quota)
+            if footprints["png"] > self.disk_quota:
+                print(f"  Workspace estimate ~{footprints['png'] / 1024 ** 3:.1f}GB exceeds WORKSPACE_DISK_QUOTA, reserving the whole quota")
+            if not self.condition.wait_for(lambda: self.reserved["disk"] + size <= self.disk_quota, timeout=JOB_TIMEOUT):
+                raise RuntimeError("Timed out waiting for workspace disk quota")
+            return self._place(job_id, "disk", os.path.join(job_dir, "frames"), "png", size)
+
+    def _place(self, job_id: str, location: str, path: str, frame_format: str, size: int) -> dict:
+        os.makedirs(path, exist_ok=True)
+        self.reserved[location] += size
+        self.workspaces[job_id] = {"location": location, "path": path, "frame_format": frame_format, "reserved_bytes": size}
+        return dict(self.workspaces[job_id])
+
+    def release(self, job_id: str) -> None:
+        """释放任务的工作区 (可重复调用)"""
+        with self.condition:
+            workspace = self.workspaces.pop(job_id, None)
+            if workspace is None:
+                return
+            self.reserved[workspace["location"]] -= workspace["reserved_bytes"]
+            self.condition.notify_all()
+        shutil.rmtree(workspace["path"], ignore_errors=True)
+
+
+workspace_manager = WorkspaceManager()
+
+
+def probe_keyframes(url: str, read_intervals: str = "") -> list:
+    """
+    视频流的关键帧时间 (秒，相对文件起点，升序)，只读取数据包不解码
+    read_intervals 限定读取范围 (ffprobe seek 后只读取索引与该范围，HTTP 输入按 Range 读取)
+    """
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0"]
+    if read_intervals:
+        cmd += ["-read_intervals", read_intervals]
+    cmd += ["-show_entries", "packet=pts_time,flags:format=start_time", "-print_format", "json", url]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe keyframe lookup failed: {result.stderr[-500:]}")
 
-    # 待签名字符串
-    algorithm = 'AWS4-HMAC-SHA256'
-    credential_scope = f'{date_stamp}/{region}/{service}/aws4_request'
-    string_to_sign = (
-        f'{algorithm}\n{amz_date}\n{credential_scope}\n'
-        f'{hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()}'
+    data = json.loads(result.stdout)
+    origin = float(data.get("format", {}).get("start_time") or 0)
+    return sorted(
+        float(packet["pts_time"]) - origin for packet in data.get("packets", [])
+        if "K" in packet.get("flags", "") and packet.get("pts_time") not in (None, "N/A")
     )
 
-    # 计算签名
-    signing_key = _get_signature_key(R2_SECRET_ACCESS_KEY, date_stamp, region, service)
-    signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
 
-    # 授权头
-    authorization_header = (
-        f'{algorithm} Credential={R2_ACCESS_KEY_ID}/{credential_scope}, '
-        f'SignedHeaders={signed_headers}, Signature={signature}'
+def find_keyframe(url: str, position: float) -> float:
+    """position 之前 (含) 最近的关键帧时间 (秒，相对文件起点)，只读取 position 附近的数据包"""
+    if position <= 0:
+        return 0.0
+    keyframes = probe_keyframes(url, f"{position:.3f}%{position + 1:.3f}")
+    # seek 落在 position 之后时 (索引不完整) 从头读取
+    return max((t for t in keyframes if t <= position + 0.001), default=0.0)
+
+
+def download_window(url: str, dest_path: str, start: float, end: float = None, trace: JobTrace = None, stage: str = "download") -> tuple:
+    """
+    只获取 [start, end] 区间，返回 (路径, 片段在原视频中的起点 (秒))
+    yt-dlp 链接使用 --download-sections；其余输入由 ffmpeg 经 HTTP seek 读取所需字节范围
+    (流复制，片段从 start 之前最近的关键帧开始)
+    """
+    with trace_stage(trace, stage, method="window") as record:
+        if is_ytdlp_url(url):
+            dest_path = download_with_ytdlp(url, dest_path, section=(start, end))
+            origin = start
+        else:
+            media_url = object_storage.url(url[len(R2_KEY_SCHEME):]) if is_r2_key(url) else url
+            origin = find_keyframe(media_url, start)
+            print(f"Fetching {origin:.2f}s-{'end' if end is None else f'{end:.2f}s'}: {url}")
+            cmd = ["ffmpeg", "-y", "-v", "error", "-ss", f"{origin:.3f}"]
+            if end is not None:
+                cmd += ["-to", f"{end:.3f}"]
+            cmd += ["-i", media_url, "-map", "0:v:0", "-map", "0:a:0?", "-c", "copy", dest_path]
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=JOB_TIMEOUT)
+            if result.returncode != 0:
+                raise RuntimeError(f"ffmpeg partial fetch failed: {result.stderr[-1000:]}")
+            print(f"Downloaded to: {dest_path}")
+        record["bytes"] = os.path.getsize(dest_path)
+    return dest_path, origin
+
+
+def fetch_input(url: str, dest_path: str, trace: JobTrace = None, stage: str = "download") -> tuple:
+    """
+    获取输入文件，优先使用缓存
+    返回 (实际路径, 缓存状态: hit / miss / bypass, 内容哈希 (未知时为空))
+    """
+    if input_cache is None:
+        return download_file(url, dest_path, trace=trace, stage=stage), "bypass", ""
+
+    probe = probe_input(url)
+    key = input_cache.make_key(url, probe)
+    if not key:
+        return download_file(url, dest_path, probe, trace, stage), "bypass", ""
+
+    with trace_stage(trace, stage, method="cache") as record:
+        cached_path, content_hash = input_cache.get(key, dest_path)
+        if cached_path:
+            record["bytes"] = os.path.getsize(cached_path)
+    if cached_path:
+        print(f"Input cache hit: {url}")
+        return cached_path, "hit", content_hash
+
+    path = download_file(url, dest_path, probe, trace, stage)
+    content_hash = ""
+    try:
+        content_hash = input_cache.put(key, path)
+    except OSError as e:
+        print(f"  Input cache store failed: {e}")
+    return path, "miss", content_hash
+
+
+# 输入下载与结果上传共用的连接池 (keep-alive，省去每个请求的 TLS 握手)
+http_session = create_session(max(DOWNLOAD_CONNECTIONS, R2_UPLOAD_CONCURRENCY, BATCH_DOWNLOAD_CONCURRENCY) * 2)
+
+
+def create_object_storage():
+    """按 STORAGE_BACKEND 创建存储客户端"""
+    if STORAGE_BACKEND == "local":
+        return LocalStorage(STORAGE_LOCAL_DIR)
+    if STORAGE_BACKEND != "r2":
+        raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND} (available: r2, local)")
+    return R2Storage(
+        R2_ENDPOINT, R2_BUCKET, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY,
+        session=http_session,
+        multipart_threshold=R2_MULTIPART_THRESHOLD,
+        part_size=R2_PART_SIZE,
+        upload_concurrency=R2_UPLOAD_CONCURRENCY,
+        part_retries=R2_PART_RETRIES,
+        download_connections=DOWNLOAD_CONNECTIONS,
+        ranged_min_size=RANGED_DOWNLOAD_MIN_SIZE,
     )
 
-    # 发送请求（流式上传）
-    headers = {
-        'Content-Type': content_type,
-        'Host': host,
-        'x-amz-content-sha256': payload_hash,
-        'x-amz-date': amz_date,
-        'Authorization': authorization_header,
-        'Content-Length': str(file_size),
-    }
 
-    with open(file_path, 'rb') as f:
-        response = requests.put(endpoint, data=f, headers=headers, timeout=3600)
+# 全局存储客户端实例
+object_storage = create_object_storage()
 
-    if response.status_code not in [200, 201]:
-        raise Exception(f"R2 upload failed: {response.status_code} - {response.text}")
 
+def upload_to_storage(file_path: str, job_id: str, object_key: str = None, trace: JobTrace = None) -> str:
+    """
+    上传结果文件到对象存储并返回下载 URL (R2 为 24 小时有效的预签名 URL)
+    未指定 object_key 时使用带时间戳的 Key
+    """
+    file_size = os.path.getsize(file_path)
+    ext = os.path.splitext(file_path)[1].lower()
+    if not object_key:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        object_key = f"facefusion/output/{job_id}_{timestamp}{ext}"
+
+    print(f"Uploading to storage: {object_key}")
+    print(f"  File size: {file_size / (1024 * 1024):.1f} MB")
+    with trace_stage(trace, "upload", bytes=file_size) as record:
+        record["method"] = object_storage.put(file_path, object_key)
     print(f"  Upload successful!")
-    return object_key
-
-
-def generate_presigned_url(object_key: str, expires_in: int = 3600) -> str:
-    """生成 R2 预签名下载 URL"""
-    method = 'GET'
-    service = 's3'
-    region = 'auto'
-    host = f"{R2_ACCOUNT_ID}.r2.cloudflarestorage.com"
-
-    # 时间戳
-    t = datetime.now(timezone.utc)
-    amz_date = t.strftime('%Y%m%dT%H%M%SZ')
-    date_stamp = t.strftime('%Y%m%d')
-
-    # URL encode the object key (keep slashes for canonical URI)
-    encoded_key_for_uri = quote(object_key, safe='/')
-    encoded_key_for_url = quote(object_key, safe='')
-    canonical_uri = f'/{R2_BUCKET}/{encoded_key_for_uri}'
-
-    credential_scope = f'{date_stamp}/{region}/{service}/aws4_request'
-    credential = f'{R2_ACCESS_KEY_ID}/{credential_scope}'
-
-    canonical_querystring = (
-        f'X-Amz-Algorithm=AWS4-HMAC-SHA256'
-        f'&X-Amz-Credential={quote(credential, safe="")}'
-        f'&X-Amz-Date={amz_date}'
-        f'&X-Amz-Expires={expires_in}'
-        f'&X-Amz-SignedHeaders=host'
-    )
 
-    canonical_headers = f'host:{host}\n'
-    signed_headers = 'host'
-    payload_hash = 'UNSIGNED-PAYLOAD'
+    return get_output_url(object_key)
 
-    canonical_request = (
-        f'{method}\n{canonical_uri}\n{canonical_querystring}\n'
-        f'{canonical_headers}\n{signed_headers}\n{payload_hash}'
-    )
 
-    # 待签名字符串
-    algorithm = 'AWS4-HMAC-SHA256'
-    string_to_sign = (
-        f'{algorithm}\n{amz_date}\n{credential_scope}\n'
-        f'{hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()}'
-    )
+def get_output_url(object_key: str) -> str:
+    """结果文件的下载 URL"""
+    return object_storage.url(object_key, expires_in=86400)
 
-    # 计算签名
-    signing_key = _get_signature_key(R2_SECRET_ACCESS_KEY, date_stamp, region, service)
-    signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
 
-    # 完整 URL (use encoded key for URL path)
-    presigned_url = f'{R2_ENDPOINT}/{R2_BUCKET}/{encoded_key_for_url}?{canonical_querystring}&X-Amz-Signature={signature}'
-    return presigned_url
+def is_r2_key(url: str) -> bool:
+    """输入是否为对象存储中的对象键 (r2://{object_key})"""
+    return url.startswith(R2_KEY_SCHEME)
 
 
-def upload_to_storage(file_path: str, job_id: str) -> str:
+def probe_input(url: str) -> dict:
+    """探测输入文件: 对象键由存储客户端 HEAD，普通 URL 用 HEAD，yt-dlp 链接返回 None"""
+    if is_ytdlp_url(url):
+        return None
+    if is_r2_key(url):
+        object_key = url[len(R2_KEY_SCHEME):]
+        info = object_storage.head(object_key)
+        if info is None:
+            raise FileNotFoundError(f"Storage object not found: {object_key}")
+        return dict(info, accept_ranges=info["size"] > 0)
+    return probe_http(url)
+
+
+def fetch_head_bytes(url: str, length: int = PREFLIGHT_SNIFF_BYTES) -> dict:
     """
-    上传结果文件到 R2 并返回预签名 URL
+    读取文件头 (Range GET，服务端不支持 Range 时读取前 length 字节后断开)
+    同时从 Content-Range / Content-Length 获取总大小
+    """
+    if url.startswith("file://"):
+        path = unquote(urlparse(url).path)
+        if not os.path.isfile(path):
+            return {"status": 404, "head": b"", "size": 0, "content_type": ""}
+        with open(path, "rb") as f:
+            head = f.read(length)
+        return {"status": 200, "head": head, "size": os.path.getsize(path), "content_type": ""}
+
+    headers = {"Range": f"bytes=0-{length - 1}"}
+    with http_session.get(url, headers=headers, stream=True, allow_redirects=True, timeout=PREFLIGHT_TIMEOUT) as response:
+        head = next(response.iter_content(length), b"") if response.status_code < 400 else b""
+        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        if response.status_code == 206:
+            size = int(total) if total.isdigit() else 0
+        else:
+            size = int(response.headers.get("Content-Length") or 0)
+        return {
+            "status": response.status_code,
+            "head": head,
+            "size": size,
+            "content_type": response.headers.get("Content-Type", ""),
+        }
+
+
+def sniff_media_type(head: bytes, content_type: str = "") -> tuple:
+    """
+    按文件头识别输入类型，返回 (video | image | other | unknown, 扩展名)
+    不依赖 URL 后缀；other 表示网页、JSON 等明显不是媒体文件的内容
+    """
+    for checks, kind, ext in MEDIA_SIGNATURES:
+        if all(head[offset:offset + len(magic)] == magic for offset, magic in checks):
+            if ext == ".mkv" and b"webm" in head[:64]:
+                ext = ".webm"
+            return kind, ext
+    mime = content_type.split(";")[0].strip().lower()
+    if mime.startswith("text/") or mime.endswith(("json", "xml")) or head.lstrip()[:1] in (b"<", b"{", b"["):
+        return "other", ""
+    if mime.startswith(("video/", "image/")):
+        return mime.partition("/")[0], ""
+    return "unknown", ""
+
+
+def sniff_input(url: str, name: str = "input") -> dict:
+    """
+    预检: 一次 Range GET 识别输入的类型、扩展名与大小，无法访问时拒绝
+    返回的 media_url 可直接交给 ffprobe (对象键为预签名 URL)
+    """
+    if is_ytdlp_url(url):
+        return {"kind": "video", "ext": "", "size": 0, "media_url": url}
+    media_url = object_storage.url(url[len(R2_KEY_SCHEME):]) if is_r2_key(url) else url
+    try:
+        response = fetch_head_bytes(media_url)
+    except requests.RequestException as e:
+        # 网络错误可能是暂时的，留给下载阶段重试
+        return {"kind": "unknown", "ext": "", "size": 0, "media_url": media_url, "error": str(e)[:200]}
+    if response["status"] >= 400:
+        raise PreflightRejected(f"{name} is not accessible (HTTP {response['status']}): {url}")
+
+    kind, ext = sniff_media_type(response["head"], response["content_type"])
+    return {
+        "kind": kind,
+        "ext": ext,
+        "size": response["size"],
+        "content_type": response["content_type"],
+        "media_url": media_url,
+    }
+
+
+def resolve_extension(url: str, sniffed: dict = None) -> str:
+    """本地文件扩展名: URL 没有后缀、或后缀与文件头识别的类型不符时使用识别结果"""
+    ext = get_file_extension(url, default="")
+    sniffed_ext = (sniffed or {}).get("ext", "")
+    if not sniffed_ext:
+        return ext or ".mp4"
+    if not ext or (ext in IMAGE_EXTENSIONS) != (sniffed_ext in IMAGE_EXTENSIONS):
+        return sniffed_ext
+    return ext
+
+
+def sign_webhook(body: bytes, timestamp: str, secret: str = WEBHOOK_SECRET) -> str:
+    """回调签名: HMAC-SHA256("{timestamp}.{body}")"""
+    message = timestamp.encode("utf-8") + b"." + body
+    return "sha256=" + hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+class WebhookSender:
+    """
+    推送任务结果到 webhook_url
+    - 与"投递不阻塞任务"的要求有意偏离: 第一次投递在返回响应前同步进行
+      (RunPod 可能在任务返回后很快回收 Worker，后台线程来不及发出)，
+      但只等待 WEBHOOK_INLINE_TIMEOUT 秒，最多让下一个任务延迟这么久
+    - 失败或超时的投递转入后台线程，按指数退避以完整的 WEBHOOK_TIMEOUT 重试，只在 Worker 存活期间有效 (尽力而为)；
+      超时的请求可能已被接收方处理，接收方应按 X-FaceFusion-Job-Id 去重
+    - 2xx 视为成功，4xx (408/429 除外) 不重试
     """
-    file_size = os.path.getsize(file_path)
-    ext = os.path.splitext(file_path)[1].lower()
 
-    print(f"File size {file_size} bytes, uploading to R2")
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    object_key = f"facefusion/output/{job_id}_{timestamp}{ext}"
+    def __init__(self, max_attempts: int = WEBHOOK_MAX_ATTEMPTS, backoff: float = WEBHOOK_BACKOFF):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.pending = []  # 堆: (到期时间, 序号, 投递)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.session = requests.Session()
+
+    def send(self, url: str, job_id: str, payload: dict) -> None:
+        """同步投递一次 (最长 WEBHOOK_INLINE_TIMEOUT 秒)，需要重试时交给后台线程"""
+        body = json.dumps(payload, default=str).encode("utf-8")
+        delivery = {"url": url, "job_id": job_id, "body": body, "attempt": 1}
+        if WEBHOOK_INLINE_TIMEOUT <= 0:
+            self._schedule(delivery, 0)
+        elif self.deliver(delivery, WEBHOOK_INLINE_TIMEOUT):
+            self._retry(delivery)
+
+    def _retry(self, delivery: dict) -> None:
+        if delivery["attempt"] >= self.max_attempts:
+            print(f"Webhook for {delivery['job_id']} gave up after {delivery['attempt']} attempts")
+            return
+        delay = min(self.backoff * 2 ** (delivery["attempt"] - 1), WEBHOOK_MAX_BACKOFF)
+        delivery["attempt"] += 1
+        print(f"Webhook for {delivery['job_id']} will retry in {delay:.0f}s")
+        self._schedule(delivery, delay)
+
+    def _schedule(self, delivery: dict, delay: float) -> None:
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.pending, (time.time() + delay, self.sequence, delivery))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def _next_due(self) -> dict:
+        with self.condition:
+            while True:
+                if self.pending:
+                    due_time = self.pending[0][0]
+                    if due_time <= time.time():
+                        return heapq.heappop(self.pending)[2]
+                    self.condition.wait(due_time - time.time())
+                else:
+                    self.condition.wait()
+
+    def _run(self) -> None:
+        while True:
+            delivery = self._next_due()
+            if self.deliver(delivery):
+                self._retry(delivery)
+
+    def deliver(self, delivery: dict, timeout: float = WEBHOOK_TIMEOUT) -> bool:
+        """投递一次，返回是否需要重试"""
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            "X-FaceFusion-Job-Id": delivery["job_id"],
+            "X-FaceFusion-Attempt": str(delivery["attempt"]),
+            "X-FaceFusion-Timestamp": timestamp,
+        }
+        if WEBHOOK_SECRET:
+            headers["X-FaceFusion-Signature"] = sign_webhook(delivery["body"], timestamp)
+
+        try:
+            response = self.session.post(delivery["url"], data=delivery["body"], headers=headers, timeout=timeout)
+        except requests.RequestException as e:
+            print(f"Webhook for {delivery['job_id']} failed: {e}")
+            return True
+
+        if 200 <= response.status_code < 300:
+            print(f"Webhook for {delivery['job_id']} delivered (attempt {delivery['attempt']})")
+            return False
+        print(f"Webhook for {delivery['job_id']} returned {response.status_code}")
+        return response.status_code >= 500 or response.status_code in (408, 429)
 
-    upload_to_r2(file_path, object_key)
 
-    # 生成 24 小时有效的预签名 URL
-    presigned_url = generate_presigned_url(object_key, expires_in=86400)
-    return presigned_url
+# 全局回调发送器 (首次重试时启动后台线程)
+webhook_sender = WebhookSender()
 
 
-def get_file_extension(url: str) -> str:
+def get_file_extension(url: str, default: str = '.mp4') -> str:
     """从 URL 获取文件扩展名"""
     parsed = urlparse(url)
-    path = parsed.path
+    path = url[len(R2_KEY_SCHEME):] if is_r2_key(url) else parsed.path
     ext = os.path.splitext(path)[1].lower()
-    return ext if ext else '.mp4'
+    return ext if ext else default
 
 
-def run_facefusion(job_dir: str, source_path: str, target_path: str, output_path: str, params: dict) -> bool:
-    """运行 FaceFusion headless 命令"""
+class WorkerError(Exception):
+    """常驻 Worker 崩溃或通信失败 (可回退到子进程模式)"""
 
-    # 确保临时目录存在
-    os.makedirs("/tmp", exist_ok=True)
-    os.makedirs("/var/tmp", exist_ok=True)
 
-    # 设置 CUDA 内存分配策略，避免碎片化
-    os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
-    os.environ["ORT_CUDA_ARENA_EXTEND_STRATEGY"] = "kSameAsRequested"
+class PreflightRejected(Exception):
+    """预检拒绝的任务 (输入无法访问、不是媒体文件或超出上限)"""
 
-    # 打印 GPU 状态
-    try:
-        gpu_info = subprocess.run(["nvidia-smi", "--query-gpu=name,memory.total,memory.free,memory.used", "--format=csv"],
-                                   capture_output=True, text=True, timeout=10)
-        print(f"GPU Status:\n{gpu_info.stdout}")
-    except Exception as e:
-        print(f"nvidia-smi failed: {e}")
 
-    # 打印调试信息
-    print(f"Python: {sys.executable}")
-    print(f"CWD: {os.getcwd()}")
-    print(f"Source exists: {os.path.exists(source_path)}, size: {os.path.getsize(source_path) if os.path.exists(source_path) else 0}")
-    print(f"Target exists: {os.path.exists(target_path)}, size: {os.path.getsize(target_path) if os.path.exists(target_path) else 0}")
+def parse_progress(line: str) -> dict:
+    """
+    解析 FaceFusion (tqdm) 的帧进度行，例如:
+    processing:  12%|█▏   | 120/1000 [00:05<00:37, 23.45frame/s, ...]
+    """
+    match = PROGRESS_PATTERN.search(line)
+    if not match:
+        return {}
+    frames = int(match.group(1))
+    total = int(match.group(2))
+    rate = float(match.group(3))
+    # 慢于 1 帧/秒时 tqdm 显示 s/frame
+    fps = rate if match.group(4) == "frame/s" else (1 / rate if rate > 0 else 0.0)
+    # 进度条描述: extracting / processing / merging
+    description = re.match(r"\s*(\w+):", line)
+    return {
+        "stage": description.group(1).lower() if description else "processing",
+        "frames_processed": frames,
+        "frames_total": total,
+        "percent": round(frames * 100 / total, 1) if total else 0.0,
+        "fps": round(fps, 2),
+        "eta_seconds": round((total - frames) / fps, 1) if fps > 0 else None,
+    }
 
-    # 检查 facefusion.py 是否存在
-    facefusion_script = os.path.join(FACEFUSION_PATH, "facefusion.py")
-    print(f"FaceFusion script exists: {os.path.exists(facefusion_script)}")
 
-    # 先测试 FaceFusion 是否能正常导入
-    test_cmd = [sys.executable, "-c", "import facefusion; print('FaceFusion OK')"]
-    test_result = subprocess.run(test_cmd, cwd=FACEFUSION_PATH, capture_output=True, text=True)
-    print(f"Import test: {test_result.stdout} {test_result.stderr}")
+class OutputMonitor:
+    """
+    逐行消费 FaceFusion 输出 (stdout/stderr)
+    进度行交给 progress 回调，其余行打印并只保留有限的日志尾部
+    """
 
-    # 构建命令 - 使用简化参数
-    cmd = [
-        sys.executable, "facefusion.py", "headless-run",
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.tail = collections.deque(maxlen=LOG_TAIL_LINES)
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.sync_tokens = set()
+
+    def reset(self, progress=None) -> None:
+        with self.lock:
+            self.progress = progress
+            self.tail.clear()
+            self.sync_tokens.clear()
+
+    def wait_sync(self, token: str, timeout: float = WORKER_OUTPUT_SYNC_TIMEOUT) -> bool:
+        """等待读到 Worker 的输出同步标记 (此前的输出都已进入日志尾部)"""
+        with self.synced:
+            return self.synced.wait_for(lambda: token in self.sync_tokens, timeout)
+
+    def feed(self, line: str) -> None:
+        line = line.rstrip()
+        if not line:
+            return
+        if line.startswith(WORKER_OUTPUT_SYNC_PREFIX):
+            with self.synced:
+                self.sync_tokens.add(line[len(WORKER_OUTPUT_SYNC_PREFIX):])
+                self.synced.notify_all()
+            return
+        update = parse_progress(line)
+        with self.lock:
+            if update:
+                if self.progress is not None:
+                    self.progress(update)
+                return
+            self.tail.append(line)
+            # FaceFusion 阶段日志 (info 级别，与预设的 log_level 无关) 用于拆分处理耗时
+            if self.progress is not None and hasattr(self.progress, "mark"):
+                for phase, marker in FACEFUSION_PHASES:
+                    if marker in line:
+                        self.progress.mark(phase)
+        print(line)
+
+    def pump(self, stream) -> None:
+        """在后台线程中读取输出流 (tqdm 使用 \r 刷新，需按 \r 和 \n 分行)"""
+        buffer = b""
+        while True:
+            chunk = stream.read1(65536) if hasattr(stream, "read1") else stream.read(65536)
+            if not chunk:
+                break
+            buffer += chunk
+            lines = re.split(rb"[\r\n]", buffer)
+            buffer = lines.pop()
+            for line in lines:
+                self.feed(line.decode("utf-8", errors="replace"))
+        if buffer:
+            self.feed(buffer.decode("utf-8", errors="replace"))
+
+    def tail_text(self) -> str:
+        with self.lock:
+            return "\n".join(self.tail)
+
+
+def start_pump(monitor: OutputMonitor, stream) -> threading.Thread:
+    """启动读取输出流的后台线程"""
+    thread = threading.Thread(target=monitor.pump, args=(stream,), daemon=True)
+    thread.start()
+    return thread
+
+
+class ProgressReporter:
+    """按固定间隔节流，通过 RunPod progress_update 推送任务进度"""
+
+    def __init__(self, job: dict, interval: float = PROGRESS_INTERVAL, extra: dict = None):
+        self.job = job
+        self.interval = interval
+        self.extra = extra or {}
+        self.last_sent = 0.0
+        self.last_progress = {}
+        self.phases = []
+
+    def mark(self, phase: str) -> None:
+        """记录 FaceFusion 进入某个阶段的时间"""
+        if not self.phases or self.phases[-1][0] != phase:
+            self.phases.append((phase, time.time()))
+
+    def phase_timings(self, end_time: float) -> dict:
+        """各阶段耗时: 每个阶段持续到下一个阶段开始"""
+        timings = {}
+        for index, (phase, start_time) in enumerate(self.phases):
+            next_time = self.phases[index + 1][1] if index + 1 < len(self.phases) else end_time
+            timings[phase] = timings.get(phase, 0.0) + next_time - start_time
+        return timings
+
+    def __call__(self, progress: dict) -> None:
+        stage = progress.get("stage", "processing")
+        self.mark(PROGRESS_STAGE_PHASES.get(stage, stage))
+        if stage == "processing":
+            self.last_progress = progress
+        now = time.time()
+        if now - self.last_sent < self.interval:
+            return
+        self.last_sent = now
+        self.send(progress)
+
+    def send(self, progress: dict) -> None:
+        """立即推送 (不节流)，用于播放地址等不能延迟的消息"""
+        progress = dict(progress, **self.extra)
+        print(f"Progress: {progress}")
+        # 只有在 RunPod 环境中才推送
+        if self.job and os.environ.get("RUNPOD_WEBHOOK_POST_OUTPUT"):
+            try:
+                runpod.serverless.progress_update(self.job, progress)
+            except Exception as e:
+                print(f"  Progress update failed: {e}")
+
+
+class FaceFusionWorker:
+    """
+    常驻 FaceFusion Worker 的进程管理与 IPC 客户端
+    Worker 只导入一次 FaceFusion，推理会话在任务之间保持常驻
+    """
+
+    def __init__(self, backend: str = WORKER_BACKEND, address: str = WORKER_SOCKET):
+        self.backend = backend
+        self.address = address
+        self.authkey = secrets.token_hex(16)
+        self.process = None
+        self.conn = None
+        self.starts = 0
+        self.monitor = OutputMonitor()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None and self.conn is not None
+
+    def start(self) -> None:
+        """启动 Worker 进程并等待其就绪"""
+        self.stop()
+        print(f"Starting FaceFusion worker (backend: {self.backend})")
+        start_time = time.time()
+        self.starts += 1
+
+        # 清理上一个 Worker 遗留的 socket
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+        env = dict(os.environ, FACEFUSION_WORKER_AUTHKEY=self.authkey)
+        self.process = subprocess.Popen(
+            [sys.executable, WORKER_SCRIPT, "--address", self.address, "--backend", self.backend],
+            cwd=FACEFUSION_PATH if os.path.isdir(FACEFUSION_PATH) else None,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        start_pump(self.monitor, self.process.stdout)
+
+        # Worker 加载 FaceFusion 期间 socket 还不存在，轮询等待
+        while time.time() - start_time < WORKER_START_TIMEOUT:
+            if self.process.poll() is not None:
+                raise WorkerError(f"Worker exited during startup with code {self.process.returncode}")
+            if os.path.exists(self.address):
+                try:
+                    self.conn = Client(self.address, family="AF_UNIX", authkey=self.authkey.encode("utf-8"))
+                    self.conn.send({"type": "ping"})
+                    print(f"  Worker ready in {time.time() - start_time:.2f}s: {self.conn.recv()}")
+                    return
+                except (OSError, EOFError):
+                    self.conn = None
+            time.sleep(0.2)
+
+        self.stop()
+        raise WorkerError(f"Worker did not become ready within {WORKER_START_TIMEOUT}s")
+
+    def stop(self) -> None:
+        """关闭连接并终止 Worker 进程"""
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+            self.conn = None
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def ensure_started(self) -> None:
+        if self.is_alive():
+            return
+        if self.starts > WORKER_MAX_RESTARTS:
+            raise WorkerError(f"Worker restarted too many times ({WORKER_MAX_RESTARTS})")
+        self.start()
+
+    def run(self, args: list, timeout: int = JOB_TIMEOUT, progress=None) -> dict:
+        """把一个任务发送给 Worker 并等待结果"""
+        return self.request({"type": "run", "args": args}, timeout, progress)
+
+    def request(self, message: dict, timeout: int = JOB_TIMEOUT, progress=None) -> dict:
+        """发送一条消息 (run / scan) 并等待 Worker 的响应"""
+        self.ensure_started()
+        self.monitor.reset(progress)
+        token = secrets.token_hex(8)
+        try:
+            self.conn.send(dict(message, sync=token))
+            if not self.conn.poll(timeout):
+                # Worker 卡死，杀掉后下个任务会重新拉起
+                self.stop()
+                raise RuntimeError(f"FaceFusion worker timed out after {timeout}s\n{self.monitor.tail_text()}")
+            response = self.conn.recv()
+            # 回复可能先于输出到达: 等输出线程读完本次输出，日志尾部 (错误信息、detector fallback 判断) 才完整
+            if not self.monitor.wait_sync(token):
+                print(f"  Worker output not drained within {WORKER_OUTPUT_SYNC_TIMEOUT}s")
+            return response
+        except (OSError, EOFError) as e:
+            self.stop()
+            raise WorkerError(f"Worker connection lost: {e}")
+        finally:
+            self.monitor.progress = None
+
+
+# 全局 Worker 实例 (常驻于 RunPod worker 进程中)
+facefusion_worker = FaceFusionWorker() if WORKER_ENABLED else None
+
+
+def build_facefusion_args(source_path: str, target_path: str, output_path: str, params: dict) -> list:
+    """
+    构建 FaceFusion headless-run 参数 (子进程与常驻 Worker 共用)
+    预设 ini 通过 --config-path 提供其余默认值，params 中的有效参数显式传入
+    """
+    args = [
+        "headless-run",
         "-s", source_path,
         "-t", target_path,
         "-o", output_path,
-        "--processors", "face_swapper", "face_enhancer", "expression_restorer",
-        "--face-swapper-model", params.get("face_swapper_model", DEFAULT_PARAMS["face_swapper_model"]),
-        "--face-swapper-pixel-boost", params.get("pixel_boost", DEFAULT_PARAMS["pixel_boost"]),
-        "--face-swapper-weight", "0.85",
-        "--face-enhancer-model", params.get("face_enhancer_model", DEFAULT_PARAMS["face_enhancer_model"]),
-        "--face-enhancer-blend", str(params.get("face_enhancer_blend", DEFAULT_PARAMS["face_enhancer_blend"])),
-        "--expression-restorer-model", "live_portrait",
-        "--expression-restorer-factor", "80",
-        "--face-selector-mode", "one",
-        "--face-detector-model", "many",
-        "--face-detector-score", "0.35",
-        "--face-landmarker-model", "many",
-        "--face-mask-types", "box", "occlusion",
-        "--face-occluder-model", "xseg_3",
-        "--face-mask-blur", "0.3",
-        "--output-video-quality", str(params.get("output_video_quality", DEFAULT_PARAMS["output_video_quality"])),
-        "--execution-providers", "cuda",
-        "--log-level", "debug",
     ]
 
+    config_path = get_preset_path(params.get("preset", DEFAULT_PARAMS["preset"]))
+    if config_path:
+        args += ["--config-path", config_path]
+
+    # many: 每帧运行全部检测器
+    if params.get("face_detector_strategy") == "many":
+        params = dict(params, face_detector_model="many")
+    elif params.get("face_detector_model") in FACE_DETECTOR_ALIASES:
+        params = dict(params, face_detector_model=FACE_DETECTOR_ALIASES[params["face_detector_model"]])
+    # 进度推送依赖进度条输出，预设或任务中的 warn/error 级别提升为 info
+    if params.get("log_level") not in PROGRESS_LOG_LEVELS:
+        params = dict(params, log_level="info")
+    is_image = os.path.splitext(target_path)[1].lower() in IMAGE_EXTENSIONS
+
+    for name, option in list(FACEFUSION_OPTIONS.items()) + list(RUNTIME_OPTIONS.items()):
+        value = params.get(name)
+        if value is None or value == "" or (is_image and name in VIDEO_ONLY_OPTIONS):
+            continue
+        args.append(option)
+        # 多值参数 (processors, face_mask_types) 以空格分隔
+        args += str(value).split() if name in MULTI_VALUE_OPTIONS else [str(value)]
+
+    return args
+
+
+def run_facefusion_worker(args: list, worker: FaceFusionWorker = None, progress=None) -> None:
+    """通过常驻 Worker 执行 FaceFusion，Worker 异常时抛出 WorkerError"""
+    worker = worker or facefusion_worker
+    result = worker.run(args, progress=progress)
+    if result.get("status") != "ok":
+        # Worker 存活但任务失败，与子进程失败同样处理
+        raise RuntimeError(f"FaceFusion failed:\n{result.get('error')}\n{result.get('traceback', '')[-2000:]}")
+    if result.get("code") != 0:
+        raise RuntimeError(f"FaceFusion failed:\nCode: {result.get('code')}\n{worker.monitor.tail_text()}")
+    source_face_cache = result.get("source_face_cache")
+    print(f"  Worker finished in {result.get('duration')}s" + (f" (source face cache: {source_face_cache})" if source_face_cache else ""))
+
+
+def run_facefusion_subprocess(args: list, progress=None) -> None:
+    """在独立子进程中运行 FaceFusion (回退路径)，输出由后台线程逐行消费"""
+    cmd = [sys.executable, "facefusion.py"] + args
+
     print(f"Running command: {' '.join(cmd)}")
 
     # 执行
-    result = subprocess.run(
+    process = subprocess.Popen(
         cmd,
         cwd=FACEFUSION_PATH,
-        capture_output=True,
-        text=True,
-        timeout=3600  # 1小时超时
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
     )
+    monitor = OutputMonitor(progress)
+    threads = [start_pump(monitor, process.stdout), start_pump(monitor, process.stderr)]
+
+    try:
+        returncode = process.wait(timeout=JOB_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        raise RuntimeError(f"FaceFusion timed out after {JOB_TIMEOUT}s\n{monitor.tail_text()}")
+    finally:
+        for thread in threads:
+            thread.join(timeout=10)
+
+    if returncode != 0:
+        # 包含最近的日志尾部
+        raise RuntimeError(f"FaceFusion failed:\nCode: {returncode}\n{monitor.tail_text()}")
+
+
+def run_with_detector_fallback(params: dict, run) -> bool:
+    """
+    fallback 策略: 先用所选的单个检测器运行，FaceFusion 报告找不到人脸时用全部检测器 (many) 重试一次
+    run(params) 执行一次 FaceFusion
+    """
+    try:
+        return run(params)
+    except RuntimeError as e:
+        if params.get("face_detector_strategy") != "fallback" or not NO_FACE_PATTERN.search(str(e)):
+            raise
+        print(f"No face found with {params.get('face_detector_model')}, retrying with all detectors")
+        return run(dict(params, face_detector_strategy="many"))
+
+
+def acquire_worker(trace: JobTrace = None):
+    """
+    返回可用的常驻 Worker (不可用时返回 None，使用子进程)
+    Worker 未就绪时 (冷启动或崩溃后) 加载模型的耗时单独计入
+    """
+    worker = facefusion_worker
+    if worker is not None and not worker.is_alive():
+        with trace_stage(trace, "model_loading"):
+            try:
+                worker.ensure_started()
+            except WorkerError as e:
+                print(f"FaceFusion worker unavailable, falling back to subprocess: {e}")
+                worker = None
+    return worker
+
+
+def run_facefusion(job_dir: str, source_path: str, target_path: str, output_path: str, params: dict, progress=None, trace: JobTrace = None) -> bool:
+    """运行 FaceFusion headless 命令"""
 
-    print(f"STDOUT: {result.stdout}")
-    if result.stderr:
-        print(f"STDERR: {result.stderr}")
+    # 打印调试信息
+    print(f"Source exists: {os.path.exists(source_path)}, size: {os.path.getsize(source_path) if os.path.exists(source_path) else 0}")
+    print(f"Target exists: {os.path.exists(target_path)}, size: {os.path.getsize(target_path) if os.path.exists(target_path) else 0}")
+
+    worker = acquire_worker(trace)
+    progress = progress or ProgressReporter(None)
+
+    def run(run_params: dict) -> bool:
+        record["detector_strategy"] = run_params.get("face_detector_strategy")
+        args = build_facefusion_args(source_path, target_path, output_path, run_params)
+        return run_facefusion_args(args, output_path, worker, progress)
+
+    with trace_stage(trace, "facefusion") as record:
+        success = run_with_detector_fallback(params, run)
+        record["frames"] = progress.last_progress.get("frames_total", 0)
+    record_phase_timings(trace, progress)
+    return success
+
+
+def record_phase_timings(trace: JobTrace, progress) -> None:
+    """把 FaceFusion 内部阶段 (抽帧/推理/合成/音频) 的耗时写入 trace"""
+    if trace is None or not getattr(progress, "phases", None):
+        return
+    for phase, seconds in progress.phase_timings(time.time()).items():
+        trace.add(f"facefusion.{phase}", seconds)
+
+
+def run_facefusion_args(args: list, output_path: str, worker: FaceFusionWorker = None, progress=None) -> bool:
+    """优先使用常驻 Worker，崩溃时回退到子进程"""
+    if worker is not None:
+        try:
+            run_facefusion_worker(args, worker, progress)
+            return os.path.exists(output_path)
+        except WorkerError as e:
+            print(f"FaceFusion worker unavailable, falling back to subprocess: {e}")
+
+    run_facefusion_subprocess(args, progress)
+    return os.path.exists(output_path)
 
+
+def probe_media(path: str, timeout: float = 60) -> dict:
+    """使用 ffprobe 读取媒体信息 (path 也可以是 URL，ffprobe 只读取所需的字节范围)"""
+    cmd = ["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", path]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe failed: {result.stderr[-500:]}")
+
+    data = json.loads(result.stdout)
+    video = next((st for st in data.get("streams", []) if st.get("codec_type") == "video"), {})
+    has_audio = any(st.get("codec_type") == "audio" for st in data.get("streams", []))
+    duration = float(data.get("format", {}).get("duration") or video.get("duration") or 0)
+
+    # 帧率形如 "30000/1001"
+    fps = 0.0
+    numerator, _, denominator = str(video.get("avg_frame_rate") or "0/1").partition("/")
+    if float(denominator or 1) > 0:
+        fps = float(numerator or 0) / float(denominator or 1)
+
+    is_image = os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS or duration == 0
+    frames = int(video.get("nb_frames") or 0) or int(duration * fps)
+    return {
+        "is_image": is_image,
+        "duration": round(duration, 3),
+        "fps": round(fps, 3),
+        "frames": 1 if is_image else frames,
+        "width": int(video.get("width") or 0),
+        "height": int(video.get("height") or 0),
+        "has_audio": has_audio,
+        "video_codec": video.get("codec_name", ""),
+    }
+
+
+def probe_ytdlp(url: str) -> dict:
+    """yt-dlp 只读取元数据不下载 (-J，与下载时相同的格式选择)，返回 probe_media 的字段与预估大小"""
+    cmd = ["yt-dlp", "-J", "-f", "best[ext=mp4]/best", "--no-playlist", "--no-warnings", url]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=PREFLIGHT_YTDLP_TIMEOUT)
     if result.returncode != 0:
-        # 包含更详细的错误信息
-        error_details = f"Code: {result.returncode}\n"
-        if result.stdout:
-            error_details += f"STDOUT: {result.stdout[-2000:]}\n"  # 最后2000字符
-        if result.stderr:
-            error_details += f"STDERR: {result.stderr[-2000:]}"
-        raise RuntimeError(f"FaceFusion failed:\n{error_details}")
+        raise RuntimeError(f"yt-dlp metadata failed: {result.stderr[-500:]}")
+
+    info = json.loads(result.stdout)
+    duration = float(info.get("duration") or 0)
+    fps = float(info.get("fps") or 0)
+    return {
+        "is_image": False,
+        "duration": round(duration, 3),
+        "fps": round(fps, 3),
+        "frames": int(duration * fps),
+        "width": int(info.get("width") or 0),
+        "height": int(info.get("height") or 0),
+        "has_audio": info.get("acodec", "none") != "none",
+        "video_codec": info.get("vcodec", ""),
+        "size": int(info.get("filesize") or info.get("filesize_approx") or 0),
+    }
+
+
+def split_video_timed(target_path: str, segment_dir: str, segment_time: float = 0.0, split_times: list = None) -> list:
+    """
+    在关键帧处把视频切分为多段 (流复制，不重新编码，去掉音频)
+    按 segment_time 等长切分，或在 split_times 各时间点之后的第一个关键帧处切分
+    返回 [{"path", "start", "duration"}]，时间取自 ffmpeg 的分段列表
+    """
+    os.makedirs(segment_dir, exist_ok=True)
+    ext = os.path.splitext(target_path)[1]
+    list_path = os.path.join(segment_dir, "segments.csv")
+    cmd = [
+        "ffmpeg", "-y", "-v", "error",
+        "-i", target_path,
+        "-map", "0:v:0", "-c", "copy", "-an",
+        "-f", "segment",
+        *(["-segment_times", ",".join(f"{t:.3f}" for t in split_times)] if split_times else ["-segment_time", f"{segment_time:.3f}"]),
+        "-segment_list", list_path, "-segment_list_type", "csv",
+        "-reset_timestamps", "1",
+        os.path.join(segment_dir, f"segment_%03d{ext}"),
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg split failed: {result.stderr[-1000:]}")
+
+    segments = []
+    with open(list_path) as f:
+        for line in f:
+            name, start, end = line.strip().rsplit(",", 2)
+            segments.append({
+                "path": os.path.join(segment_dir, name),
+                "start": float(start),
+                "duration": float(end) - float(start),
+            })
+    if not segments:
+        raise RuntimeError("ffmpeg split produced no segments")
+    return segments
+
+
+def split_video(target_path: str, segment_dir: str, segment_time: float) -> list:
+    """在关键帧处把视频切分为多段，返回各段路径"""
+    return [segment["path"] for segment in split_video_timed(target_path, segment_dir, segment_time)]
+
+
+def concat_segments(segment_paths: list, audio_source_path: str, output_path: str) -> None:
+    """流复制拼接各段输出，并重新混入原视频音轨"""
+    list_path = os.path.join(os.path.dirname(output_path), "segments.txt")
+    with open(list_path, 'w') as f:
+        for path in segment_paths:
+            f.write(f"file '{path}'\n")
+
+    cmd = [
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "concat", "-safe", "0", "-i", list_path,
+        "-i", audio_source_path,
+        "-map", "0:v:0", "-map", "1:a?",
+        "-c", "copy", "-shortest",
+        output_path,
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg concat failed: {result.stderr[-1000:]}")
+
+
+# 分段并行使用的额外 Worker (第一个复用 facefusion_worker)
+segment_workers = []
+
+
+def get_free_vram() -> int:
+    """GPU 空闲显存 (MB)，无法查询时 (无 GPU / stub 后端) 返回 None"""
+    try:
+        result = subprocess.run(["nvidia-smi", "--query-gpu=memory.free", "--format=csv,noheader,nounits"],
+                                capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0 or not result.stdout.strip():
+        return None
+    return int(result.stdout.split()[0])
+
+
+def get_segment_workers(count: int) -> list:
+    """
+    获取最多 count 个 Worker，未启用常驻 Worker 时返回 None (使用子进程)
+    每个额外的 Worker 都加载整套模型，新建前按空闲显存限制数量
+    """
+    started = len(segment_workers) if facefusion_worker is not None else 0
+    if count - 1 > started:
+        free_vram = get_free_vram()
+        if free_vram is not None:
+            affordable = 1 + started + free_vram // SEGMENT_WORKER_VRAM
+            if affordable < count:
+                print(f"Free VRAM {free_vram}MB allows {affordable} of {count} segment workers")
+                count = affordable
+    if facefusion_worker is None:
+        return [None] * count
+    while len(segment_workers) < count - 1:
+        address = f"{WORKER_SOCKET}.{len(segment_workers) + 1}"
+        segment_workers.append(FaceFusionWorker(address=address))
+    return [facefusion_worker] + segment_workers[:count - 1]
+
+
+def get_segment_output_path(segment_path: str) -> str:
+    """段的输出路径: 同一目录下，文件名前缀 segment_ 换为 output_ (不改动目录部分)"""
+    directory, name = os.path.split(segment_path)
+    return os.path.join(directory, "output_" + name.removeprefix("segment_"))
+
+
+def iter_processed_segments(source_path: str, segment_paths: list, params: dict, job: dict = None, frames: list = None):
+    """
+    用 Worker 池并行处理各段，按段的顺序产出输出路径
+    (第 i 段完成且之前的段都已产出后才产出第 i 段)；frames 收集每段处理的帧数
+    """
+    # Worker 池: 每段从队列中取一个空闲 Worker
+    workers = get_segment_workers(min(SEGMENT_WORKERS, len(segment_paths)))
+    worker_queue = queue.Queue()
+    for worker in workers:
+        worker_queue.put(worker)
+
+    def process_segment(index: int, segment_path: str) -> str:
+        segment_output = get_segment_output_path(segment_path)
+        progress = ProgressReporter(job, extra={"segment": index, "segments": len(segment_paths)})
+        worker = worker_queue.get()
+
+        def run(run_params: dict) -> bool:
+            args = build_facefusion_args(source_path, segment_path, segment_output, run_params)
+            return run_facefusion_args(args, segment_output, worker, progress)
+
+        try:
+            if not run_with_detector_fallback(params, run):
+                raise RuntimeError(f"Segment output not created: {segment_output}")
+        finally:
+            worker_queue.put(worker)
+        if frames is not None:
+            frames.append(progress.last_progress.get("frames_total", 0))
+        return segment_output
+
+    executor = ThreadPoolExecutor(max_workers=len(workers))
+    try:
+        yield from executor.map(process_segment, range(len(segment_paths)), segment_paths)
+    finally:
+        # 出错或调用方提前结束时不再处理剩余的段
+        executor.shutdown(wait=True, cancel_futures=True)
+
 
+def get_segment_count(duration: float, segments: int) -> int:
+    """实际段数: 不超过请求的段数，且每段不短于 SEGMENT_MIN_DURATION"""
+    return max(1, min(segments, int(duration // SEGMENT_MIN_DURATION)))
+
+
+def run_facefusion_segmented(job_dir: str, source_path: str, target_path: str, output_path: str, params: dict, segments: int, job: dict = None, trace: JobTrace = None) -> bool:
+    """
+    分段并行处理长视频:
+    关键帧切分 -> 多个本地 Worker 同时处理 -> 流复制拼接 + 混入原音轨
+    """
+    duration = probe_media(target_path)["duration"]
+    count = get_segment_count(duration, segments)
+    if count == 1:
+        print(f"Video too short for segmentation ({duration:.1f}s), processing as one")
+        return run_facefusion(job_dir, source_path, target_path, output_path, params, ProgressReporter(job), trace)
+
+    segment_dir = os.path.join(job_dir, "segments")
+    with trace_stage(trace, "split"):
+        segment_paths = split_video(target_path, segment_dir, duration / count)
+    print(f"Split into {len(segment_paths)} segments ({duration:.1f}s total)")
+
+    segment_frames = []
+    with trace_stage(trace, "facefusion", segments=len(segment_paths)) as record:
+        segment_outputs = list(iter_processed_segments(source_path, segment_paths, params, job, segment_frames))
+        record["frames"] = sum(segment_frames)
+
+    with trace_stage(trace, "concat"):
+        concat_segments(segment_outputs, target_path, output_path)
     return os.path.exists(output_path)
 
 
-def handler(job: dict) -> dict:
+def run_facefusion_spliced(job_dir: str, source_path: str, target_path: str, output_path: str, params: dict, trim: tuple, job: dict = None, trace: JobTrace = None) -> bool:
     """
-    RunPod Serverless Handler
+    区间处理后拼回原视频 (trim_output=splice):
+    在区间前后的关键帧处切分 (流复制) -> 只处理中间一段 -> 与前后未改动的部分流复制拼接 + 混入原音轨
+    处理范围扩展到区间前后最近的关键帧，区间外的帧不会重新编码
     """
+    start, end = trim
+    media = probe_media(target_path)
+    # 拼接为流复制，处理后的一段 (libx264) 须与原视频编码一致
+    if media["video_codec"] != "h264":
+        raise RuntimeError(f"trim_output=splice requires an H.264 target, got {media['video_codec'] or 'unknown'}")
+
+    keyframe = find_keyframe(target_path, start)
+    split_times = []
+    if keyframe > 0:
+        # 略早于关键帧，避免时间取整后错过该关键帧
+        split_times.append(max(0.0, keyframe - 0.001))
+    if end is not None and end < media["duration"]:
+        split_times.append(end)
+
+    segment_dir = os.path.join(job_dir, "segments")
+    with trace_stage(trace, "split"):
+        pieces = split_video_timed(target_path, segment_dir, split_times=split_times)
+    window_index = 1 if keyframe > 0 and len(pieces) > 1 else 0
+    window = pieces[window_index]
+    print(f"Splice: processing {window['start']:.2f}s-{window['start'] + window['duration']:.2f}s of {media['duration']:.1f}s")
+
+    window_output = get_segment_output_path(window["path"])
+    if not run_facefusion(job_dir, source_path, window["path"], window_output, params, ProgressReporter(job), trace):
+        return False
+
+    piece_paths = [piece["path"] for piece in pieces]
+    piece_paths[window_index] = window_output
+    with trace_stage(trace, "concat"):
+        concat_segments(piece_paths, target_path, output_path)
+    return os.path.exists(output_path)
+
+
+def scan_faces(target_path: str, media: dict, params: dict, worker: FaceFusionWorker) -> list:
+    """人脸预扫描: Worker 以 FACE_SCAN_FPS 解码目标视频 (缩小到 FACE_SCAN_SIZE) 并运行单个检测器，返回每个采样帧的人脸数"""
+    scale = min(1.0, FACE_SCAN_SIZE / max(media["width"], media["height"], 1))
+    width = max(2, int(media["width"] * scale) // 2 * 2)
+    height = max(2, int(media["height"] * scale) // 2 * 2)
+    args = [
+        "--face-detector-model", FACE_SCAN_DETECTOR,
+        "--face-detector-score", str(FACE_SCAN_SCORE),
+        "--execution-providers", *str(params.get("execution_providers", DEFAULT_PARAMS["execution_providers"])).split(),
+    ]
+    response = worker.request({
+        "type": "scan", "path": target_path, "fps": FACE_SCAN_FPS,
+        "width": width, "height": height, "duration": media["duration"], "args": args,
+    })
+    if response.get("status") != "ok":
+        raise RuntimeError(f"Face scan failed: {response.get('error')}")
+    return response["faces"]
+
+
+def get_face_ranges(faces: list, fps: float, duration: float) -> list:
+    """
+    采样结果 -> 需要处理的时间区间 [[start, end]]
+    有人脸的采样点覆盖前后一个采样间隔并扩展 FACE_SCAN_PADDING，短于 FACE_SCAN_MIN_GAP 的间隔合并
+    """
+    reach = 1 / fps + FACE_SCAN_PADDING
+    ranges = []
+    for index, count in enumerate(faces):
+        if not count:
+            continue
+        start, end = max(0.0, index / fps - reach), min(duration, index / fps + reach)
+        if ranges and start - ranges[-1][1] < FACE_SCAN_MIN_GAP:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def align_to_keyframes(ranges: list, keyframes: list, duration: float) -> list:
+    """区间起点扩展到之前最近的关键帧、终点扩展到之后第一个关键帧 (流复制只能在关键帧处切分)，合并重叠的区间"""
+    aligned = []
+    for start, end in ranges:
+        start = max((t for t in keyframes if t <= start + 0.001), default=0.0)
+        end = min((t for t in keyframes if t >= end - 0.001), default=duration)
+        if aligned and start <= aligned[-1][1]:
+            aligned[-1][1] = max(aligned[-1][1], end)
+        else:
+            aligned.append([start, end])
+    return aligned
+
+
+def run_facefusion_scanned(ctx: dict, output_path: str) -> bool:
+    """
+    人脸预扫描后只处理有人脸的区间:
+    低帧率检测 -> 区间对齐关键帧 -> 流复制切分 -> Worker 池处理有人脸的段 -> 与无人脸的段流复制拼接 + 混入原音轨
+    ctx["face_scan"] 记录跳过的帧比例
+    """
+    job_dir, source_path, target_path = ctx["job_dir"], ctx["source_path"], ctx["target_path"]
+    params, trace = ctx["params"], ctx["trace"]
+    media = probe_media(target_path)
+
+    def process_all(reason: str) -> bool:
+        print(f"Face scan: {reason}, processing all frames")
+        ctx["face_scan"] = dict(ctx.get("face_scan", {}), status=reason, skipped_fraction=0.0)
+        return run_facefusion(job_dir, source_path, target_path, output_path, params, ProgressReporter(ctx["job"]), trace)
+
+    worker = acquire_worker(trace)
+    if worker is None:
+        return process_all("worker_unavailable")
+    # 拼接为流复制，处理后的段 (libx264) 须与原视频编码一致
+    if media["video_codec"] != "h264":
+        return process_all("unsupported_codec")
+
+    with trace_stage(trace, "face_scan") as record:
+        faces = scan_faces(target_path, media, params, worker)
+        record["frames"] = len(faces)
+        ranges = align_to_keyframes(get_face_ranges(faces, FACE_SCAN_FPS, media["duration"]),
+                                    probe_keyframes(target_path), media["duration"])
+    ctx["face_scan"] = {"samples": len(faces), "face_samples": sum(1 for count in faces if count),
+                        "ranges": [[round(start, 3), round(end, 3)] for start, end in ranges]}
+
+    skipped = 1 - sum(end - start for start, end in ranges) / max(media["duration"], 0.001)
+    if skipped < FACE_SCAN_MIN_SKIP:
+        return process_all("mostly_faces")
+
+    if not ranges:
+        # 没有检测到人脸: 原样输出
+        print("Face scan: no faces found, returning the target unchanged")
+        link_or_copy(target_path, output_path)
+        ctx["face_scan"].update(status="no_faces", frames_total=media["frames"], frames_skipped=media["frames"], skipped_fraction=1.0)
+        return True
+
+    # 在区间边界 (均为关键帧) 略早处切分，避免时间取整后错过关键帧
+    split_times = sorted({max(0.0, t - 0.001) for span in ranges for t in span if 0 < t < media["duration"]})
+    with trace_stage(trace, "split"):
+        pieces = split_video_timed(target_path, os.path.join(job_dir, "segments"), split_times=split_times)
+
+    # 按段的中点判断是否有人脸 (分段列表的时间可能带有文件起始偏移)
+    origin = pieces[0]["start"]
+    face_paths = [
+        piece["path"] for piece in pieces
+        if any(start <= piece["start"] - origin + piece["duration"] / 2 <= end for start, end in ranges)
+    ]
+    skipped_seconds = sum(piece["duration"] for piece in pieces if piece["path"] not in face_paths)
+    print(f"Face scan: processing {len(face_paths)}/{len(pieces)} segments, skipping {skipped_seconds:.1f}s of {media['duration']:.1f}s")
+
+    segment_frames = []
     start_time = time.time()
-    job_input = job.get("input", {})
+    outputs = dict(zip(face_paths, iter_processed_segments(source_path, face_paths, params, ctx["job"], segment_frames)))
+    trace.add("facefusion", time.time() - start_time, frames=sum(segment_frames), segments=len(face_paths))
 
-    # 验证必需参数
-    source_url = job_input.get("source_url")
-    target_url = job_input.get("target_url")
+    with trace_stage(trace, "concat"):
+        concat_segments([outputs.get(piece["path"], piece["path"]) for piece in pieces], target_path, output_path)
+
+    frames_skipped = min(media["frames"], round(skipped_seconds * media["fps"]))
+    ctx["face_scan"].update(status="ok", frames_total=media["frames"], frames_skipped=frames_skipped,
+                            skipped_fraction=round(frames_skipped / max(media["frames"], 1), 3))
+    return os.path.exists(output_path)
+
+
+def mux_hls_segment(video_path: str, audio_source_path: str, start: float, duration: float, output_path: str) -> None:
+    """
+    把处理后的一段视频 (流复制) 与原视频对应时间段的音轨封装为 MPEG-TS 分段
+    时间戳偏移到该段在原视频中的起点，分段之间连续
+    """
+    cmd = [
+        "ffmpeg", "-y", "-v", "error",
+        "-i", video_path,
+        "-ss", f"{start:.3f}", "-t", f"{duration:.3f}", "-i", audio_source_path,
+        "-map", "0:v:0", "-map", "1:a:0?",
+        "-c:v", "copy", "-c:a", "aac", "-b:a", HLS_AUDIO_BITRATE,
+        "-output_ts_offset", f"{start:.3f}",
+        "-f", "mpegts", output_path,
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg HLS mux failed: {result.stderr[-1000:]}")
+
+
+class HlsPublisher:
+    """
+    渐进式 HLS 输出: 分段按顺序上传到对象存储，每次上传后更新 EVENT 播放列表
+    播放列表中的分段使用完整 URL (R2 为预签名 URL，相对路径无法通过签名校验)
+    """
+
+    def __init__(self, job_id: str, target_duration: float, trace: JobTrace = None):
+        self.prefix = f"facefusion/hls/{job_id}"
+        self.playlist_key = f"{self.prefix}/index.m3u8"
+        self.target_duration = max(1, int(-(-target_duration // 1)))  # 向上取整，不能小于任何分段时长
+        self.trace = trace
+        self.entries = []
+        self.ended = False
+        self.playlist_url = ""
+        self.first_segment_at = None
+
+    def render(self) -> str:
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            "#EXT-X-PLAYLIST-TYPE:EVENT",
+            f"#EXT-X-TARGETDURATION:{self.target_duration}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+        ]
+        for url, duration in self.entries:
+            lines += [f"#EXTINF:{duration:.3f},", url]
+        if self.ended:
+            lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def _upload(self, path: str, object_key: str) -> None:
+        start_time = time.time()
+        method = object_storage.put(path, object_key)
+        if self.trace is not None:
+            self.trace.add("upload", time.time() - start_time, bytes=os.path.getsize(path), method=method)
+
+    def _write_playlist(self, work_dir: str) -> None:
+        path = os.path.join(work_dir, "index.m3u8")
+        with open(path, "w") as f:
+            f.write(self.render())
+        self._upload(path, self.playlist_key)
+
+    def publish(self, segment_path: str, duration: float) -> None:
+        """上传一个分段并更新播放列表"""
+        object_key = f"{self.prefix}/segment_{len(self.entries):05d}.ts"
+        self._upload(segment_path, object_key)
+        self.entries.append((get_output_url(object_key), duration))
+        self._write_playlist(os.path.dirname(segment_path))
+        if not self.playlist_url:
+            self.playlist_url = get_output_url(self.playlist_key)
+            self.first_segment_at = time.time()
+
+    def finish(self, work_dir: str) -> None:
+        """追加 ENDLIST，播放器不再刷新播放列表"""
+        self.ended = True
+        self._write_playlist(work_dir)
+
+    def summary(self, start_time: float) -> dict:
+        return {
+            "playlist_url": self.playlist_url,
+            "segments": len(self.entries),
+            "duration": round(sum(duration for _, duration in self.entries), 3),
+            "first_segment_seconds": round(self.first_segment_at - start_time, 2) if self.first_segment_at else None,
+        }
+
+
+def run_facefusion_hls(ctx: dict) -> None:
+    """
+    渐进式处理: 关键帧切分 -> Worker 池按顺序处理 -> 每段完成后立即封装上传，
+    第一段上传后通过 progress_update 推送播放列表 URL
+    """
+    job_dir = ctx["job_dir"]
+    target_path = ctx["target_path"]
+    trace = ctx["trace"]
+    segment_time = float(ctx["input"].get("hls_segment_duration", HLS_SEGMENT_DURATION))
+
+    segment_dir = os.path.join(job_dir, "segments")
+    hls_dir = os.path.join(job_dir, "hls")
+    os.makedirs(hls_dir, exist_ok=True)
+    with trace_stage(trace, "split"):
+        segments = split_video_timed(target_path, segment_dir, segment_time)
+    print(f"HLS: {len(segments)} segments of ~{segment_time:g}s")
+
+    publisher = HlsPublisher(ctx["job_id"], max(segment["duration"] for segment in segments), trace)
+    reporter = ProgressReporter(ctx["job"])
+    ctx["hls"] = publisher
+
+    segment_frames = []
+    start_time = time.time()
+    outputs = iter_processed_segments(ctx["source_path"], [segment["path"] for segment in segments],
+                                      ctx["params"], ctx["job"], segment_frames)
+    # 封装与上传在当前线程进行，与 Worker 处理后续分段重叠
+    for index, (segment, output) in enumerate(zip(segments, outputs)):
+        ts_path = os.path.join(hls_dir, f"segment_{index:05d}.ts")
+        with trace_stage(trace, "mux"):
+            mux_hls_segment(output, target_path, segment["start"], segment["duration"], ts_path)
+        publisher.publish(ts_path, segment["duration"])
+        reporter.send({
+            "stage": "streaming",
+            "playlist_url": publisher.playlist_url,
+            "segments_ready": index + 1,
+            "segments": len(segments),
+        })
+    trace.add("facefusion", time.time() - start_time, frames=sum(segment_frames), segments=len(segments))
+
+
+# 启动探测结果 (每个 worker 进程只执行一次)
+BOOT_INFO = {}
+
+
+def probe_gpu() -> dict:
+    """查询 GPU 名称与显存"""
+    try:
+        result = subprocess.run(["nvidia-smi", "--query-gpu=name,memory.total,memory.free,memory.used", "--format=csv,noheader"],
+                                capture_output=True, text=True, timeout=10)
+        print(f"GPU Status:\n{result.stdout}")
+        return {"available": result.returncode == 0, "info": result.stdout.strip().splitlines()}
+    except Exception as e:
+        print(f"nvidia-smi failed: {e}")
+        return {"available": False, "error": str(e)}
+
+
+def get_required_models() -> list:
+    """所有预设 (含 auto 档位) 与默认参数需要的模型"""
+    preset_params = {preset: load_preset(preset) for preset in PRESET_CONFIGS}
+    return resolve_deployment_models(DEFAULT_PARAMS, preset_params, AUTO_TIERS)
+
+
+def verify_models() -> dict:
+    """
+    检查 MODELS_PATH 下必需的模型文件是否存在且非空
+    download_models.py 写入的 manifest.json 中记录了校验通过时的大小，大小不符视为损坏
+    """
+    try:
+        with open(os.path.join(MODELS_PATH, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    required_models = get_required_models()
+    missing = []
+    corrupt = []
+    for name in required_models:
+        for ext in (".onnx", ".hash"):
+            path = os.path.join(MODELS_PATH, name + ext)
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                missing.append(name + ext)
+            elif ext == ".onnx" and name + ext in manifest and manifest[name + ext]["size"] != os.path.getsize(path):
+                corrupt.append(name + ext)
+
+    if missing or corrupt:
+        print(f"Missing model files: {missing}, corrupt: {corrupt}")
+    else:
+        print(f"All {len(required_models)} required models present")
+    return {"required": len(required_models), "missing": missing, "corrupt": corrupt, "verified": bool(manifest)}
+
+
+def check_facefusion_import() -> dict:
+    """测试 FaceFusion 能否导入 (未启用常驻 Worker 时使用)"""
+    test_cmd = [sys.executable, "-c", "import facefusion; print('FaceFusion OK')"]
+    try:
+        result = subprocess.run(test_cmd, cwd=FACEFUSION_PATH, capture_output=True, text=True, timeout=120)
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+    print(f"Import test: {result.stdout} {result.stderr}")
+    return {"ok": result.returncode == 0, "error": result.stderr[-500:] if result.returncode != 0 else ""}
 
-    if not source_url or not target_url:
-        return {"error": "Missing required parameters: source_url and target_url"}
 
-    # 创建工作目录
+def boot() -> dict:
+    """
+    启动阶段: 环境探测、模型校验、预热 Worker
+    结果缓存在 BOOT_INFO 中，任务不再重复这些检查
+    """
+    if BOOT_INFO:
+        return BOOT_INFO
+
+    boot_start = time.time()
+    timings = {}
+    print("Booting FaceFusion handler...")
+
+    # 确保临时目录存在
+    os.makedirs("/tmp", exist_ok=True)
+    os.makedirs("/var/tmp", exist_ok=True)
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    # 清理上次进程崩溃时遗留的任务目录与内存盘工作区
+    workspace = workspace_manager.sweep()
+
+    # 设置 CUDA 内存分配策略，避免碎片化 (子进程与 Worker 都会继承)
+    os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
+    os.environ["ORT_CUDA_ARENA_EXTEND_STRATEGY"] = "kSameAsRequested"
+
+    print(f"Python: {sys.executable}")
+    facefusion_script = os.path.join(FACEFUSION_PATH, "facefusion.py")
+    print(f"FaceFusion script exists: {os.path.exists(facefusion_script)}")
+
+    step_start = time.time()
+    gpu = probe_gpu()
+    timings["gpu_probe"] = round(time.time() - step_start, 3)
+
+    step_start = time.time()
+    models = verify_models()
+    timings["model_check"] = round(time.time() - step_start, 3)
+
+    # 预热: 启动常驻 Worker (加载 FaceFusion)，否则只做一次导入测试
+    step_start = time.time()
+    warmup = {"worker": False}
+    if facefusion_worker is not None:
+        try:
+            facefusion_worker.ensure_started()
+            warmup["worker"] = True
+        except WorkerError as e:
+            print(f"Worker warmup failed, jobs will use subprocess: {e}")
+            warmup["error"] = str(e)
+    else:
+        warmup["import"] = check_facefusion_import()
+    timings["warmup"] = round(time.time() - step_start, 3)
+    timings["total"] = round(time.time() - boot_start, 3)
+
+    BOOT_INFO.update({
+        "boot_id": secrets.token_hex(4),
+        "booted_at": datetime.now(timezone.utc).isoformat(),
+        "facefusion_script": os.path.exists(facefusion_script),
+        "gpu": gpu,
+        "models": models,
+        "warmup": warmup,
+        "workspace": dict(workspace, ram_budget=workspace_manager.ram_budget, disk_quota=workspace_manager.disk_quota),
+        "timings": timings,
+        "jobs": 0,
+    })
+    print(f"Boot complete in {timings['total']}s: {timings}")
+    return BOOT_INFO
+
+
+def get_boot_summary() -> dict:
+    """任务响应中引用的冷启动信息"""
+    BOOT_INFO["jobs"] += 1
+    return {
+        "boot_id": BOOT_INFO["boot_id"],
+        "first_job": BOOT_INFO["jobs"] == 1,
+        "cold_start": BOOT_INFO["timings"],
+    }
+
+
+def validate_job_input(job_input: dict) -> str:
+    """校验任务输入，返回错误信息 (无错误时为空字符串)"""
+    preset = job_input.get("preset", DEFAULT_PARAMS["preset"])
+    if is_batch_job(job_input):
+        target_urls = job_input["target_urls"]
+        if not job_input.get("source_url"):
+            return "Missing required parameter: source_url"
+        if not isinstance(target_urls, list) or not target_urls or not all(isinstance(url, str) and url for url in target_urls):
+            return "target_urls must be a non-empty list of image URLs"
+        if len(target_urls) > BATCH_MAX_ITEMS:
+            return f"Too many target_urls: {len(target_urls)} (max {BATCH_MAX_ITEMS})"
+        if preset == "auto":
+            return "The auto preset is not supported with target_urls"
+        if job_input.get("preflight_only"):
+            return "preflight_only is not supported with target_urls"
+    elif not job_input.get("source_url") or not job_input.get("target_url"):
+        return "Missing required parameters: source_url and target_url"
+    if preset != "auto" and preset not in PRESET_CONFIGS:
+        return f"Unknown preset: {preset} (available: {', '.join(list(PRESET_CONFIGS) + ['auto'])})"
+    input_urls = [job_input.get("source_url"), job_input.get("target_url")] + list(job_input.get("target_urls") or [])
+    if any(is_r2_key(str(url)) for url in input_urls if url) and not object_storage.configured:
+        return f"{R2_KEY_SCHEME} inputs require R2 credentials (R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY)"
+    output_format = job_input.get("output_format", "mp4")
+    if output_format not in OUTPUT_FORMATS:
+        return f"Unknown output_format: {output_format} (available: {', '.join(OUTPUT_FORMATS)})"
+    if output_format == "hls" and is_batch_job(job_input):
+        return "output_format hls is not supported with target_urls"
+    try:
+        if float(job_input.get("hls_segment_duration", HLS_SEGMENT_DURATION)) <= 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        return f"Invalid hls_segment_duration: {job_input.get('hls_segment_duration')}"
+    try:
+        trim = get_trim(job_input)
+    except (TypeError, ValueError):
+        return f"Invalid trim_start/trim_end: {job_input.get('trim_start')}, {job_input.get('trim_end')}"
+    if trim:
+        start, end = trim
+        if start < 0 or (end is not None and end <= start):
+            return "trim_end must be greater than trim_start (seconds, >= 0)"
+        if is_batch_job(job_input):
+            return "trim_start/trim_end are not supported with target_urls"
+        if output_format == "hls":
+            return "trim_start/trim_end are not supported with output_format hls"
+    trim_output = job_input.get("trim_output", "window")
+    if trim_output not in TRIM_OUTPUTS:
+        return f"Unknown trim_output: {trim_output} (available: {', '.join(TRIM_OUTPUTS)})"
+    webhook_url = job_input.get("webhook_url")
+    if webhook_url and urlparse(str(webhook_url)).scheme not in ("http", "https"):
+        return f"Invalid webhook_url: {webhook_url}"
+    strategy = job_input.get("face_detector_strategy", DEFAULT_PARAMS["face_detector_strategy"])
+    if strategy not in DETECTOR_STRATEGIES:
+        return f"Unknown face_detector_strategy: {strategy} (available: {', '.join(DETECTOR_STRATEGIES)})"
+    return ""
+
+
+def create_job_context(job: dict) -> dict:
+    """创建任务上下文，在各处理阶段之间传递状态"""
     job_id = job.get("id", f"job_{int(time.time())}")
-    job_dir = os.path.join(TEMP_DIR, job_id)
+    return {
+        "job_id": job_id,
+        "job": job,
+        "input": job.get("input", {}),
+        "job_dir": os.path.join(TEMP_DIR, job_id),
+        "start_time": time.time(),
+        "boot": get_boot_summary(),
+        "params": build_params(job.get("input", {})),
+        "trace": JobTrace(),
+        "queue_wait_time": 0.0,
+        "gpu_time": 0.0,
+    }
+
+
+def get_trim(job_input: dict) -> tuple:
+    """处理区间 (开始秒, 结束秒或 None 表示到结尾)，未指定时返回 None"""
+    if job_input.get("trim_start") is None and job_input.get("trim_end") is None:
+        return None
+    end = job_input.get("trim_end")
+    return float(job_input.get("trim_start") or 0), None if end is None else float(end)
+
+
+def preflight_target(url: str) -> dict:
+    """预检目标: 识别类型后用 ffprobe (经 HTTP 只读取所需字节) 或 yt-dlp 元数据获取时长、分辨率与帧率"""
+    if is_ytdlp_url(url):
+        report = {"kind": "video", "ext": "", "size": 0, "method": "yt-dlp"}
+        try:
+            media = probe_ytdlp(url)
+            report["size"] = media.pop("size")
+        except (RuntimeError, ValueError, OSError, subprocess.TimeoutExpired) as e:
+            media = None
+            report["error"] = str(e)[:200]
+        report["media"] = media
+        return report
+
+    report = sniff_input(url, "target_url")
+    media_url = report.pop("media_url")
+    if report["kind"] == "other":
+        raise PreflightRejected(f"target_url is not a video or image ({report['content_type'] or 'unrecognized content'})")
+    report["method"] = "ffprobe"
+    try:
+        media = probe_media(media_url, timeout=PREFLIGHT_TIMEOUT)
+        if report["kind"] in ("video", "image"):
+            media["is_image"] = report["kind"] == "image"
+            media["frames"] = 1 if media["is_image"] else media["frames"]
+    except (RuntimeError, ValueError, OSError, subprocess.TimeoutExpired) as e:
+        # 探测失败不拒绝 (可能是服务端不支持 Range)，留给下载后的处理报错
+        media = None
+        report["error"] = str(e)[:200]
+    report["media"] = media
+    return report
+
+
+def estimate_job_cost(params: dict, media: dict, job_input: dict) -> dict:
+    """
+    预估任务的 GPU 耗时 (按 AUTO_TIERS 的每帧耗时)；区间任务只计区间内的帧
+    人脸预扫描可跳过的部分不扣除，结果偏保守
+    """
+    frames = media["frames"]
+    trim = get_trim(job_input)
+    if trim and not media["is_image"] and media["fps"]:
+        start, end = trim
+        end = media["duration"] if end is None else min(end, media["duration"])
+        frames = max(0, round((end - start) * media["fps"]))
+    processed = dict(media, frames=frames)
+
+    if params.get("preset") == "auto":
+        time_budget = float(job_input.get("time_budget", AUTO_TIME_BUDGET))
+        tier_name = tune_auto_params(params, processed, time_budget)["auto"]["tier"]
+        tier = next(tier for tier in AUTO_TIERS if tier["name"] == tier_name)
+    else:
+        tier = match_auto_tier(params)
+    return {
+        "frames": frames,
+        "duration": 0.0 if media["is_image"] or not media["fps"] else round(frames / media["fps"], 3),
+        "tier": tier["name"],
+        "frame_cost": tier["frame_cost"],
+        "gpu_seconds": round(estimate_gpu_seconds(tier["frame_cost"], processed), 1) if frames else 0.0,
+    }
+
+
+def check_preflight_limits(preflight: dict, job_input: dict) -> str:
+    """按预检结果校验上限，返回拒绝原因 (通过时为空字符串)"""
+    # 只输出区间的任务只获取区间，目标文件大小不影响下载
+    window_fetch = get_trim(job_input) and job_input.get("trim_output", "window") == "window"
+    for name in ("source", "target"):
+        size = preflight[name].get("size", 0)
+        if MAX_INPUT_SIZE and size > MAX_INPUT_SIZE and not (name == "target" and window_fetch):
+            return f"{name}_url is too large: {size / 1024 ** 2:.1f} MB (max {MAX_INPUT_SIZE / 1024 ** 2:.1f} MB)"
+
+    media = preflight["target"].get("media")
+    estimate = preflight.get("estimate")
+    if not media or not estimate:
+        return ""
+    if MAX_PIXELS and media["width"] * media["height"] > MAX_PIXELS:
+        return f"Target resolution {media['width']}x{media['height']} exceeds the limit ({MAX_PIXELS} pixels)"
+    if not estimate["frames"]:
+        # 帧率已知时区间帧数为 0 说明起点超出视频；帧数未知 (容器未记录) 时不按帧数校验
+        trim = get_trim(job_input)
+        if trim and media["fps"]:
+            return f"trim_start {trim[0]:g}s is beyond the end of the video ({media['duration']:g}s)"
+        return ""
+    if MAX_DURATION and estimate["duration"] > MAX_DURATION:
+        return f"Target is too long: {estimate['duration']:.0f}s to process (max {MAX_DURATION:g}s)"
+    if MAX_GPU_SECONDS and estimate["gpu_seconds"] > MAX_GPU_SECONDS:
+        return f"Estimated GPU time {estimate['gpu_seconds']:.0f}s exceeds the limit ({MAX_GPU_SECONDS:g}s)"
+    return ""
+
+
+def run_preflight(ctx: dict) -> bool:
+    """
+    阶段 0 (下载前): 识别输入类型、读取目标媒体信息并估算 GPU 耗时，不符合要求或超出上限时拒绝
+    结果写入 ctx["preflight"] 并随响应返回 (供调度方按预估耗时路由)；返回 True 表示只预检 (preflight_only)
+    """
+    job_input = ctx["input"]
+    preflight_only = bool(job_input.get("preflight_only"))
+    if is_batch_job(job_input) or not (PREFLIGHT_ENABLED or preflight_only):
+        return False
+
+    with trace_stage(ctx["trace"], "preflight"):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            source_future = executor.submit(sniff_input, job_input["source_url"], "source_url")
+            target = preflight_target(job_input["target_url"])
+            source = source_future.result()
+        source.pop("media_url")
+        if source["kind"] == "other":
+            raise PreflightRejected(f"source_url is not an image or video ({source['content_type'] or 'unrecognized content'})")
+
+        preflight = {"source": source, "target": target}
+        if target["media"]:
+            preflight["estimate"] = estimate_job_cost(ctx["params"], target["media"], job_input)
+        ctx["preflight"] = preflight
+
+    estimate = preflight.get("estimate")
+    if estimate:
+        print(f"Preflight: {target['kind']} {estimate['frames']} frames, tier {estimate['tier']}, "
+              f"estimated {estimate['gpu_seconds']}s GPU")
+    error = check_preflight_limits(preflight, job_input)
+    if error:
+        raise PreflightRejected(error)
+    return preflight_only
+
+
+def fetch_target(ctx: dict, url: str, dest_path: str) -> tuple:
+    """获取目标文件；只输出区间的任务只读取该区间 (不经过输入缓存)，失败时回退到完整下载"""
+    trim = get_trim(ctx["input"])
+    ctx["trim_origin"] = 0.0
+    is_video = os.path.splitext(dest_path)[1].lower() not in IMAGE_EXTENSIONS
+    if trim and is_video and ctx["input"].get("trim_output", "window") == "window":
+        try:
+            path, ctx["trim_origin"] = download_window(url, dest_path, *trim, ctx["trace"], "download_target")
+            return path, "bypass", ""
+        except Exception as e:
+            print(f"  Partial fetch failed ({e}), downloading the full target")
+    return fetch_input(url, dest_path, ctx["trace"], "download_target")
+
+
+def download_inputs(ctx: dict) -> None:
+    """阶段 1: 同时下载源文件与目标文件"""
+    job_input = ctx["input"]
+    source_url = job_input["source_url"]
+    target_url = job_input["target_url"]
+    job_dir = ctx["job_dir"]
     os.makedirs(job_dir, exist_ok=True)
 
+    preflight = ctx.get("preflight", {})
+    source_ext = resolve_extension(source_url, preflight.get("source"))
+    source_path = os.path.join(job_dir, f"source{source_ext}")
+    target_ext = resolve_extension(target_url, preflight.get("target"))
+    target_path = os.path.join(job_dir, f"target{target_ext}")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        source_future = executor.submit(fetch_input, source_url, source_path, ctx["trace"], "download_source")
+        target_future = executor.submit(fetch_target, ctx, target_url, target_path)
+        source_path, source_cache, source_hash = source_future.result()  # 使用实际下载路径
+        target_path, target_cache, target_hash = target_future.result()
+
+    cache_info = {"source": source_cache, "target": target_cache}
+    if input_cache is not None:
+        cache_info.update(input_cache.stats())
+
+    ctx["source_path"] = source_path
+    ctx["target_path"] = target_path
+    ctx["source_hash"] = source_hash or hash_file(source_path)
+    ctx["target_hash"] = target_hash or hash_file(target_path)
+    ctx["input_cache"] = cache_info
+
+
+def get_preset_path(preset: str) -> str:
+    """预设名 -> ini 文件路径 (auto 基于 serverless 预设)"""
+    filename = PRESET_CONFIGS.get("serverless" if preset == "auto" else preset)
+    if not filename:
+        return ""
+    for configs_dir in (CONFIGS_PATH, LOCAL_CONFIGS_PATH):
+        path = os.path.join(configs_dir, filename)
+        if os.path.exists(path):
+            return path
+    return ""
+
+
+@functools.lru_cache(maxsize=None)
+def load_preset(preset: str) -> dict:
+    """读取预设 ini 中的参数 (只保留 FACEFUSION_OPTIONS 中的键)"""
+    path = get_preset_path(preset)
+    if not path:
+        return {}
+    return {key: value for key, value in read_ini(path).items() if key in FACEFUSION_OPTIONS}
+
+
+def build_params(job_input: dict) -> dict:
+    """
+    从任务输入构建处理参数
+    优先级: 任务输入 > 预设 ini > DEFAULT_PARAMS
+    """
+    preset = job_input.get("preset", DEFAULT_PARAMS["preset"])
+    params = {k: v for k, v in DEFAULT_PARAMS.items() if k != "preset"}
+    params.update(load_preset(preset))
+    params.update({k: v for k, v in job_input.items() if k in FACEFUSION_OPTIONS})
+    params["face_detector_strategy"] = job_input.get("face_detector_strategy", params["face_detector_strategy"])
+    # 只在启用时写入，未启用的任务结果缓存 Key 不变
+    if job_input.get("face_scan", FACE_SCAN_ENABLED):
+        params["face_scan"] = True
+    params["preset"] = preset
+    return params
+
+
+def estimate_gpu_seconds(frame_cost: float, media: dict) -> float:
+    """预估 GPU 耗时: 每帧耗时 (1080p 基准) x 分辨率系数 x 帧数"""
+    # 分辨率越高，检测/增强/编解码耗时越高
+    scale = max(0.5, (media["width"] * media["height"]) / (1920 * 1080))
+    return frame_cost * scale * max(1, media["frames"])
+
+
+def match_auto_tier(params: dict) -> dict:
+    """
+    非 auto 预设按处理器与像素提升对应到 AUTO_TIERS 档位 (用其每帧耗时估算)
+    没有完全一致的档位时取包含全部处理器的最高档，偏保守
+    """
+    processors = set(str(params.get("processors", "")).split())
+    covering = [tier for tier in AUTO_TIERS if processors <= set(tier["params"]["processors"].split())]
+    if not covering:
+        return AUTO_TIERS[0]
+    matching = [tier for tier in covering if tier["params"]["pixel_boost"] == params.get("pixel_boost")]
+    return matching[-1] if matching else covering[0]
+
+
+def tune_auto_params(params: dict, media: dict, time_budget: float) -> dict:
+    """
+    auto 预设: 根据 ffprobe 结果选择线程数、显存策略、像素提升与检测器
+    返回调整后的参数 (包含所选档位与预估耗时)
+    """
+    tier = AUTO_TIERS[-1]
+    for candidate in AUTO_TIERS:
+        if estimate_gpu_seconds(candidate["frame_cost"], media) <= time_budget:
+            tier = candidate
+            break
+
+    tuned = dict(params)
+    tuned.update(tier["params"])
+    if media["is_image"]:
+        tuned["execution_thread_count"] = 1
+        tuned["video_memory_strategy"] = "tolerant"
+    else:
+        # 4K 以上降低线程数并释放部分显存，避免 OOM
+        high_res = media["width"] * media["height"] > 2560 * 1440
+        tuned["execution_thread_count"] = 4 if high_res else min(8, os.cpu_count() or 4)
+        tuned["video_memory_strategy"] = "moderate" if high_res else "tolerant"
+
+    tuned["auto"] = {
+        "tier": tier["name"],
+        "time_budget": time_budget,
+        "estimated_seconds": round(estimate_gpu_seconds(tier["frame_cost"], media), 1),
+        "media": media,
+    }
+    return tuned
+
+
+def apply_trim(ctx: dict, trim: tuple, media: dict) -> None:
+    """
+    区间任务: window 输出把区间换算为 FaceFusion 的 trim 帧号 (相对已获取片段的起点)；
+    splice 输出在处理阶段按关键帧切分。区间记入参数，参与结果缓存 Key
+    """
+    start, end = trim
+    params = ctx["params"]
+    output = ctx["input"].get("trim_output", "window")
+    params["trim"] = f"{start:g}-{'' if end is None else f'{end:g}'}:{output}"
+
+    origin = ctx.get("trim_origin", 0.0)
+    frame_start = max(0, round((start - origin) * media["fps"]))
+    frame_end = media["frames"] if end is None else min(media["frames"], round((end - origin) * media["fps"]))
+    if frame_start >= frame_end:
+        raise ValueError(f"trim_start {start:g}s is beyond the end of the video ({origin + media['duration']:g}s)")
+    if output == "window":
+        params["trim_frame_start"] = frame_start
+        if end is not None:
+            params["trim_frame_end"] = frame_end
+    # auto 预设按实际处理的帧数估算耗时
+    media["frames"] = frame_end - frame_start
+
+
+def resolve_params(ctx: dict) -> None:
+    """
+    下载后确定最终参数: 区间任务换算 trim 帧号；
+    auto 预设根据目标文件自动调优，显式传入的参数仍然优先
+    """
+    params = ctx["params"]
+    job_input = ctx["input"]
+    trim = get_trim(job_input)
+    if trim and os.path.splitext(ctx["target_path"])[1].lower() in IMAGE_EXTENSIONS:
+        print("trim_start/trim_end ignored for image target")
+        trim = None
+    if params.get("preset") != "auto" and not trim:
+        return
+
+    with trace_stage(ctx["trace"], "probe"):
+        media = probe_media(ctx["target_path"])
+    if trim:
+        apply_trim(ctx, trim, media)
+    if params.get("preset") != "auto":
+        return
+
+    time_budget = float(job_input.get("time_budget", AUTO_TIME_BUDGET))
+    tuned = tune_auto_params(params, media, time_budget)
+    tuned.update({k: v for k, v in job_input.items() if k in FACEFUSION_OPTIONS})
+    print(f"Auto preset: tier {tuned['auto']['tier']}, estimated {tuned['auto']['estimated_seconds']}s")
+    ctx["params"] = tuned
+
+
+def get_result_key(ctx: dict) -> str:
+    """
+    结果对象 Key: 由源/目标内容哈希与规范化参数确定
+    相同输入 + 相同参数总是得到同一个 Key
+    """
+    normalized = {k: str(v) for k, v in ctx["params"].items()}
+    raw = json.dumps({
+        "source": ctx["source_hash"],
+        "target": ctx["target_hash"],
+        "params": normalized,
+    }, sort_keys=True)
+    digest = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    ext = os.path.splitext(ctx["target_path"])[1].lower()
+    return f"facefusion/results/{digest}{ext}"
+
+
+def lookup_cached_result(ctx: dict) -> bool:
+    """处理前检查 R2 是否已有相同结果，命中时直接生成新的预签名 URL"""
+    ctx["result_key"] = get_result_key(ctx)
+    if not RESULT_CACHE_ENABLED or ctx["input"].get("force_reprocess"):
+        ctx["result_cache"] = "bypass"
+        return False
+
     try:
-        # 下载源文件
-        source_ext = get_file_extension(source_url)
-        source_path = os.path.join(job_dir, f"source{source_ext}")
-        source_path = download_file(source_url, source_path)  # 使用实际下载路径
-
-        # 下载目标文件
-        target_ext = get_file_extension(target_url)
-        target_path = os.path.join(job_dir, f"target{target_ext}")
-        target_path = download_file(target_url, target_path)  # 使用实际下载路径
-
-        # 输出路径 (使用目标文件的实际扩展名)
-        actual_target_ext = os.path.splitext(target_path)[1]
-        output_path = os.path.join(job_dir, f"output{actual_target_ext}")
-
-        # 运行换脸
-        params = {
-            "preset": job_input.get("preset", DEFAULT_PARAMS["preset"]),
-            "face_swapper_model": job_input.get("face_swapper_model", DEFAULT_PARAMS["face_swapper_model"]),
-            "face_enhancer_model": job_input.get("face_enhancer_model", DEFAULT_PARAMS["face_enhancer_model"]),
-            "face_enhancer_blend": job_input.get("face_enhancer_blend", DEFAULT_PARAMS["face_enhancer_blend"]),
-            "pixel_boost": job_input.get("pixel_boost", DEFAULT_PARAMS["pixel_boost"]),
-            "output_video_quality": job_input.get("output_video_quality", DEFAULT_PARAMS["output_video_quality"]),
-        }
+        with trace_stage(ctx["trace"], "result_lookup"):
+            exists = object_storage.head(ctx["result_key"]) is not None
+    except Exception as e:
+        print(f"  Result cache lookup failed: {e}")
+        exists = False
+
+    if not exists:
+        ctx["result_cache"] = "miss"
+        return False
+
+    print(f"Result cache hit: {ctx['result_key']}")
+    ctx["result_cache"] = "hit"
+    ctx["output_url"] = get_output_url(ctx["result_key"])
+    return True
+
+
+def estimate_workspace(ctx: dict) -> dict:
+    """
+    工作区预估占用 {临时帧格式: bytes}: 处理的帧数 x 分辨率 x 每像素字节，加上 FaceFusion 合成的临时视频
+    探测失败或帧数未知时按输入大小 x PIPELINE_DISK_FACTOR 估算 (与流水线磁盘预算一致)
+    """
+    video_size = os.path.getsize(ctx["target_path"])
+    try:
+        media = probe_media(ctx["target_path"])
+    except (RuntimeError, ValueError, OSError, subprocess.TimeoutExpired) as e:
+        print(f"  Workspace probe failed, estimating from input size: {e}")
+        media = {"frames": 0}
+    if not media["frames"]:
+        return dict.fromkeys(TEMP_FRAME_BYTES_PER_PIXEL, int(video_size * PIPELINE_DISK_FACTOR))
+
+    params = ctx["params"]
+    frames = media["frames"]
+    if "trim_frame_start" in params:
+        frames = params.get("trim_frame_end", frames) - params["trim_frame_start"]
+    pixels = max(0, frames) * media["width"] * media["height"]
+    return {frame_format: int(pixels * bytes_per_pixel) + 2 * video_size
+            for frame_format, bytes_per_pixel in TEMP_FRAME_BYTES_PER_PIXEL.items()}
+
+
+def acquire_workspace(ctx: dict) -> None:
+    """
+    阶段 2 之前: 放置临时帧工作区，通过 --temp-path / --temp-frame-format 传给 FaceFusion
+    在等待 GPU 之前执行，配额不足时的等待不占用 GPU 槽位；图片目标不抽帧，使用默认位置
+    """
+    if os.path.splitext(ctx["target_path"])[1].lower() in IMAGE_EXTENSIONS:
+        return
 
-        success = run_facefusion(job_dir, source_path, target_path, output_path, params)
+    with trace_stage(ctx["trace"], "workspace") as record:
+        workspace = workspace_manager.acquire(ctx["job_id"], estimate_workspace(ctx), ctx["job_dir"])
+        record["location"] = workspace["location"]
+    print(f"Workspace: {workspace['location']} ({workspace['reserved_bytes'] / 1024 ** 2:.0f}MB reserved, {workspace['frame_format']} frames)")
+    ctx["workspace"] = {key: workspace[key] for key in ("location", "frame_format", "reserved_bytes")}
+    ctx["params"].update(temp_path=workspace["path"], temp_frame_format=workspace["frame_format"])
 
-        if not success or not os.path.exists(output_path):
-            return {"error": "Face swap processing failed - output file not created"}
 
-        # 上传结果
-        output_url = upload_to_storage(output_path, job_id)
+def skip_workspace(ctx: dict) -> None:
+    """批量图片任务不抽帧，不需要工作区"""
+
+
+@contextlib.contextmanager
+def job_workspace(ctx: dict):
+    """处理结束即释放工作区 (结果文件在任务目录中)"""
+    try:
+        yield
+    finally:
+        ctx["params"].pop("temp_path", None)
+        ctx["params"].pop("temp_frame_format", None)
+        workspace_manager.release(ctx["job_id"])
+
+
+def process_job(ctx: dict) -> None:
+    """阶段 2: 运行换脸 (占用 GPU)"""
+    with job_workspace(ctx):
+        run_job(ctx)
+
+
+def run_job(ctx: dict) -> None:
+    """按任务类型选择处理方式: 区间拼接 / 人脸预扫描 / 分段并行 / 整段处理"""
+    params = ctx["params"]
+
+    # 输出路径 (使用目标文件的实际扩展名)
+    actual_target_ext = os.path.splitext(ctx["target_path"])[1]
+    output_path = os.path.join(ctx["job_dir"], f"output{actual_target_ext}")
+
+    # 分段并行 (仅视频)
+    segments = int(ctx["input"].get("segments", SEGMENT_COUNT))
+    is_video = actual_target_ext.lower() not in IMAGE_EXTENSIONS
+
+    trim = get_trim(ctx["input"]) if is_video else None
+
+    gpu_start = time.time()
+    if trim and ctx["input"].get("trim_output", "window") == "splice":
+        success = run_facefusion_spliced(ctx["job_dir"], ctx["source_path"], ctx["target_path"], output_path, params, trim, ctx["job"], ctx["trace"])
+    elif params.get("face_scan") and is_video and not trim:
+        success = run_facefusion_scanned(ctx, output_path)
+    elif segments > 1 and is_video and not trim:
+        # 只输出区间时由 FaceFusion 的 trim 帧号裁剪，整段处理
+        success = run_facefusion_segmented(ctx["job_dir"], ctx["source_path"], ctx["target_path"], output_path, params, segments, ctx["job"], ctx["trace"])
+    else:
+        success = run_facefusion(ctx["job_dir"], ctx["source_path"], ctx["target_path"], output_path, params, ProgressReporter(ctx["job"]), ctx["trace"])
+    ctx["gpu_time"] = time.time() - gpu_start
+
+    if not success or not os.path.exists(output_path):
+        raise RuntimeError("Face swap processing failed - output file not created")
+    ctx["output_path"] = output_path
+
+
+def upload_result(ctx: dict) -> None:
+    """阶段 3: 上传结果"""
+    ctx["output_url"] = upload_to_storage(ctx["output_path"], ctx["job_id"], ctx.get("result_key"), ctx["trace"])
+
+
+def is_hls_job(job_input: dict) -> bool:
+    return job_input.get("output_format") == "hls"
+
+
+def skip_result_cache(ctx: dict) -> bool:
+    """HLS 播放列表中是有时效的预签名 URL，不做结果缓存"""
+    ctx["result_cache"] = "bypass"
+    return False
+
+
+def process_hls_job(ctx: dict) -> None:
+    """阶段 2 (hls 输出): 边处理边上传分段；图片目标按普通方式处理"""
+    if os.path.splitext(ctx["target_path"])[1].lower() in IMAGE_EXTENSIONS:
+        print("output_format=hls ignored for image target")
+        process_job(ctx)
+        return
+
+    with job_workspace(ctx):
+        gpu_start = time.time()
+        run_facefusion_hls(ctx)
+        ctx["gpu_time"] = time.time() - gpu_start
+
+
+def finish_hls_output(ctx: dict) -> None:
+    """阶段 3 (hls 输出): 分段已在处理时上传，这里结束播放列表"""
+    if "hls" not in ctx:
+        upload_result(ctx)
+        return
+    ctx["hls"].finish(os.path.join(ctx["job_dir"], "hls"))
+    ctx["output_url"] = ctx["hls"].playlist_url
+
+
+def get_timings(ctx: dict) -> dict:
+    """结构化的阶段耗时 (含总耗时与排队时间)"""
+    timings = ctx["trace"].to_dict()
+    timings["queue_wait"] = {"seconds": round(ctx["queue_wait_time"], 3)}
+    timings["total"] = {"seconds": round(time.time() - ctx["start_time"], 3)}
+    return timings
+
+
+def finalize_response(ctx: dict, response: dict) -> dict:
+    """所有任务响应的出口: 输出 trace 日志，并在提供 webhook_url 时推送结果"""
+    log_job_trace(ctx, response)
+    webhook_url = ctx["input"].get("webhook_url")
+    if webhook_url:
+        webhook_sender.send(webhook_url, ctx["job_id"], {"id": ctx["job_id"], "status": response.get("status"), "output": response})
+    return response
+
+
+def log_job_trace(ctx: dict, response: dict) -> dict:
+    """每个任务输出一行 JSON 日志，便于聚合分析"""
+    print(json.dumps({
+        "event": "job_trace",
+        "job_id": ctx["job_id"],
+        "status": response.get("status"),
+        "result_cache": response.get("result_cache"),
+        "timings": response.get("timings"),
+    }))
+    return response
+
+
+def job_response(ctx: dict) -> dict:
+    """成功响应"""
+    response = {
+        "output_url": ctx["output_url"],
+        "status": "success",
+        "processing_time": round(time.time() - ctx["start_time"], 2),
+        "queue_wait_time": round(ctx["queue_wait_time"], 2),
+        "gpu_time": round(ctx["gpu_time"], 2),
+        "params_used": ctx["params"],
+        "result_cache": ctx.get("result_cache", "bypass"),
+        "input_cache": ctx["input_cache"],
+        "timings": get_timings(ctx),
+        "boot": ctx["boot"],
+    }
+    if "hls" in ctx:
+        response["output_format"] = "hls"
+        response["hls"] = ctx["hls"].summary(ctx["start_time"])
+    if "face_scan" in ctx:
+        response["face_scan"] = ctx["face_scan"]
+    if "workspace" in ctx:
+        response["workspace"] = ctx["workspace"]
+    if "preflight" in ctx:
+        response["preflight"] = ctx["preflight"]
+    return finalize_response(ctx, response)
+
+
+def preflight_response(ctx: dict) -> dict:
+    """只预检 (preflight_only) 的响应: 不下载、不处理"""
+    return finalize_response(ctx, {
+        "status": "preflight",
+        "preflight": ctx["preflight"],
+        "params_used": ctx["params"],
+        "processing_time": round(time.time() - ctx["start_time"], 2),
+        "timings": get_timings(ctx),
+        "boot": ctx["boot"],
+    })
+
+
+def job_error_response(ctx: dict, error: Exception) -> dict:
+    """失败响应 (预检拒绝时附带预检结果)"""
+    response = {
+        "error": str(error),
+        "status": "rejected" if isinstance(error, PreflightRejected) else "failed",
+        "processing_time": round(time.time() - ctx["start_time"], 2),
+        "queue_wait_time": round(ctx["queue_wait_time"], 2),
+        "timings": get_timings(ctx),
+        "boot": ctx["boot"],
+    }
+    if "preflight" in ctx:
+        response["preflight"] = ctx["preflight"]
+    return finalize_response(ctx, response)
 
-        processing_time = time.time() - start_time
 
+def is_batch_job(job_input: dict) -> bool:
+    """带 target_urls 的批量图片任务"""
+    return "target_urls" in job_input
+
+
+def fail_item(item: dict, error) -> None:
+    """单张图片失败只记录在该条目上，不影响批量中的其他图片"""
+    item["status"] = "failed"
+    item["error"] = str(error)
+    print(f"  Item {item['index']} failed: {error}")
+
+
+def pending_items(ctx: dict) -> list:
+    return [item for item in ctx["items"] if item["status"] == "pending"]
+
+
+def download_batch_inputs(ctx: dict) -> None:
+    """批量阶段 1: 源文件下载一次，目标图片并发下载"""
+    job_input = ctx["input"]
+    job_dir = ctx["job_dir"]
+    os.makedirs(job_dir, exist_ok=True)
+    ctx["items"] = [{"index": index, "target_url": url, "status": "pending", "trace": JobTrace()}
+                    for index, url in enumerate(job_input["target_urls"])]
+
+    def fetch_item(item: dict) -> None:
+        ext = get_file_extension(item["target_url"], default=".jpg")
+        target_path = os.path.join(job_dir, f"target_{item['index']}{ext}")
+        try:
+            target_path, cache, content_hash = fetch_input(item["target_url"], target_path, item["trace"])
+            item.update(target_path=target_path, target_hash=content_hash or hash_file(target_path), input_cache=cache)
+        except Exception as e:
+            fail_item(item, f"Download failed: {e}")
+
+    source_url = job_input["source_url"]
+    source_path = os.path.join(job_dir, f"source{get_file_extension(source_url)}")
+    with ThreadPoolExecutor(max_workers=BATCH_DOWNLOAD_CONCURRENCY + 1) as executor:
+        source_future = executor.submit(fetch_input, source_url, source_path, ctx["trace"], "download_source")
+        with trace_stage(ctx["trace"], "download_targets", items=len(ctx["items"])):
+            list(executor.map(fetch_item, ctx["items"]))
+        source_path, source_cache, source_hash = source_future.result()
+
+    ctx["source_path"] = source_path
+    ctx["source_hash"] = source_hash or hash_file(source_path)
+    ctx["input_cache"] = {"source": source_cache}
+    if input_cache is not None:
+        ctx["input_cache"].update(input_cache.stats())
+
+
+def lookup_batch_cached_results(ctx: dict) -> bool:
+    """每张图片独立查询结果缓存 (与单任务的结果 Key 相同)，全部命中时返回 True"""
+    items = pending_items(ctx)
+    for item in items:
+        item["result_key"] = get_result_key(dict(ctx, target_hash=item["target_hash"], target_path=item["target_path"]))
+        item["result_cache"] = "bypass"
+    if not RESULT_CACHE_ENABLED or ctx["input"].get("force_reprocess"):
+        return False
+
+    def lookup_item(item: dict) -> None:
+        try:
+            exists = object_storage.head(item["result_key"]) is not None
+        except Exception as e:
+            print(f"  Result cache lookup failed: {e}")
+            exists = False
+        item["result_cache"] = "hit" if exists else "miss"
+        if exists:
+            item["output_url"] = get_output_url(item["result_key"])
+            item["status"] = "success"
+
+    with trace_stage(ctx["trace"], "result_lookup", items=len(items)):
+        with ThreadPoolExecutor(max_workers=BATCH_DOWNLOAD_CONCURRENCY) as executor:
+            list(executor.map(lookup_item, items))
+    return not pending_items(ctx)
+
+
+def process_batch(ctx: dict) -> None:
+    """
+    批量阶段 2: 所有图片在同一个常驻 Worker 中依次处理
+    模型会话只加载一次，源脸分析由 FaceFusion 的人脸缓存在图片之间复用
+    """
+    items = pending_items(ctx)
+    worker = acquire_worker(ctx["trace"])
+    progress = ProgressReporter(ctx["job"])
+
+    gpu_start = time.time()
+    with trace_stage(ctx["trace"], "facefusion", items=len(items)):
+        for done, item in enumerate(items, 1):
+            output_path = os.path.join(ctx["job_dir"], f"output_{item['index']}{os.path.splitext(item['target_path'])[1]}")
+
+            def run(run_params: dict) -> bool:
+                args = build_facefusion_args(ctx["source_path"], item["target_path"], output_path, run_params)
+                return run_facefusion_args(args, output_path, worker, progress)
+
+            try:
+                with item["trace"].stage("facefusion"):
+                    success = run_with_detector_fallback(ctx["params"], run)
+                if not success or not os.path.exists(output_path):
+                    raise RuntimeError("Face swap processing failed - output file not created")
+                item["output_path"] = output_path
+            except Exception as e:
+                fail_item(item, e)
+            progress({"stage": "batch", "items_done": done, "items_total": len(items)})
+    ctx["gpu_time"] = time.time() - gpu_start
+
+
+def upload_batch_results(ctx: dict) -> None:
+    """批量阶段 3: 并发上传处理成功的图片"""
+    items = [item for item in pending_items(ctx) if item.get("output_path")]
+
+    def upload_item(item: dict) -> None:
+        try:
+            item["output_url"] = upload_to_storage(item["output_path"], f"{ctx['job_id']}_{item['index']}",
+                                                   item.get("result_key"), item["trace"])
+            item["status"] = "success"
+        except Exception as e:
+            fail_item(item, f"Upload failed: {e}")
+
+    with trace_stage(ctx["trace"], "upload", items=len(items)):
+        with ThreadPoolExecutor(max_workers=R2_UPLOAD_CONCURRENCY) as executor:
+            list(executor.map(upload_item, items))
+
+
+def batch_response(ctx: dict) -> dict:
+    """批量响应: 每张图片一条结果，部分失败时 status 为 partial"""
+    results = []
+    for item in ctx["items"]:
+        result = {"index": item["index"], "target_url": item["target_url"], "status": item["status"]}
+        if item["status"] == "success":
+            result["output_url"] = item["output_url"]
+            result["result_cache"] = item.get("result_cache", "bypass")
+        else:
+            result["error"] = item.get("error", "Not processed")
+        result["input_cache"] = item.get("input_cache", "bypass")
+        result["timings"] = item["trace"].to_dict()
+        results.append(result)
+
+    failed = sum(1 for result in results if result["status"] != "success")
+    if not failed:
+        status = "success"
+    elif failed == len(results):
+        status = "failed"
+    else:
+        status = "partial"
+
+    return finalize_response(ctx, {
+        "status": status,
+        "results": results,
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        "processing_time": round(time.time() - ctx["start_time"], 2),
+        "queue_wait_time": round(ctx["queue_wait_time"], 2),
+        "gpu_time": round(ctx["gpu_time"], 2),
+        "params_used": ctx["params"],
+        "input_cache": ctx["input_cache"],
+        "timings": get_timings(ctx),
+        "boot": ctx["boot"],
+    })
+
+
+def get_job_stages(job_input: dict) -> dict:
+    """单目标任务、批量图片任务与 HLS 输出走同一流程，各阶段的实现不同"""
+    if is_batch_job(job_input):
         return {
-            "output_url": output_url,
-            "status": "success",
-            "processing_time": round(processing_time, 2),
-            "params_used": params
+            "download": download_batch_inputs,
+            "lookup": lookup_batch_cached_results,
+            "workspace": skip_workspace,
+            "process": process_batch,
+            "upload": upload_batch_results,
+            "respond": batch_response,
         }
-
-    except Exception as e:
+    if is_hls_job(job_input):
         return {
-            "error": str(e),
-            "status": "failed",
-            "processing_time": round(time.time() - start_time, 2)
+            "download": download_inputs,
+            "lookup": skip_result_cache,
+            "workspace": acquire_workspace,
+            "process": process_hls_job,
+            "upload": finish_hls_output,
+            "respond": job_response,
         }
+    return {
+        "download": download_inputs,
+        "lookup": lookup_cached_result,
+        "workspace": acquire_workspace,
+        "process": process_job,
+        "upload": upload_result,
+        "respond": job_response,
+    }
+
+
+def cleanup_job(ctx: dict) -> None:
+    """清理临时文件"""
+    workspace_manager.release(ctx["job_id"])
+    if os.path.exists(ctx["job_dir"]):
+        shutil.rmtree(ctx["job_dir"], ignore_errors=True)
+
+
+def handler(job: dict) -> dict:
+    """
+    RunPod Serverless Handler
+    """
+    boot()
+    job_input = job.get("input", {})
+
+    # 验证必需参数
+    error = validate_job_input(job_input)
+    if error:
+        return {"error": error}
+
+    ctx = create_job_context(job)
+    stages = get_job_stages(job_input)
+    try:
+        if run_preflight(ctx):
+            return preflight_response(ctx)
+        stages["download"](ctx)
+        resolve_params(ctx)
+        if stages["lookup"](ctx):
+            return stages["respond"](ctx)
+        stages["workspace"](ctx)
+        stages["process"](ctx)
+        stages["upload"](ctx)
+        return stages["respond"](ctx)
+
+    except Exception as e:
+        return job_error_response(ctx, e)
 
     finally:
-        # 清理临时文件
-        if os.path.exists(job_dir):
-            shutil.rmtree(job_dir, ignore_errors=True)
+        cleanup_job(ctx)
+
+
+def estimate_job_disk(job_input: dict) -> int:
+    """估算任务占用的磁盘空间 (输入大小 x 系数，包含临时帧与输出)"""
+    def probe_size(url: str) -> int:
+        try:
+            size = (probe_input(url) or {}).get("size", 0)
+        except Exception:
+            # 探测失败留给下载阶段报错 (批量任务中只影响该图片)
+            size = 0
+        return size or PIPELINE_DEFAULT_INPUT_SIZE
+
+    urls = [job_input["source_url"]] + list(job_input.get("target_urls") or [job_input["target_url"]])
+    with ThreadPoolExecutor(max_workers=BATCH_DOWNLOAD_CONCURRENCY) as executor:
+        total = sum(executor.map(probe_size, urls))
+    return min(int(total * PIPELINE_DISK_FACTOR), PIPELINE_DISK_BUDGET)
+
+
+class JobPipeline:
+    """
+    并发模式下的任务流水线
+    - 下载/上传在线程中与其他任务的 GPU 处理重叠
+    - GPU 处理单槽串行
+    - 已下载、等待 GPU 的任务数受 prefetch 上限约束
+    - 所有进行中任务的预估磁盘占用受 disk budget 约束
+    """
+
+    def __init__(self, prefetch_limit: int = None, disk_budget: int = None):
+        self.gpu_slot = asyncio.Lock()
+        self.prefetch = asyncio.Semaphore(prefetch_limit or PIPELINE_PREFETCH)
+        self.disk_budget = disk_budget or PIPELINE_DISK_BUDGET
+        self.disk_reserved = 0
+        self.disk_condition = asyncio.Condition()
+
+    async def reserve_disk(self, size: int) -> None:
+        async with self.disk_condition:
+            await self.disk_condition.wait_for(lambda: self.disk_reserved + size <= self.disk_budget)
+            self.disk_reserved += size
+
+    async def release_disk(self, size: int) -> None:
+        async with self.disk_condition:
+            self.disk_reserved -= size
+            self.disk_condition.notify_all()
+
+    async def run(self, job: dict) -> dict:
+        boot()
+        job_input = job.get("input", {})
+
+        error = validate_job_input(job_input)
+        if error:
+            return {"error": error}
+
+        ctx = create_job_context(job)
+        stages = get_job_stages(job_input)
+        reserved = 0
+        prefetch_held = False
+        try:
+            # 预检在占用磁盘预算之前，被拒绝的任务不排队
+            if await asyncio.to_thread(run_preflight, ctx):
+                return await asyncio.to_thread(preflight_response, ctx)
+
+            # 磁盘预算与预取上限 (计入排队时间)
+            wait_start = time.time()
+            reserved = await asyncio.to_thread(estimate_job_disk, job_input)
+            await self.reserve_disk(reserved)
+            await self.prefetch.acquire()
+            prefetch_held = True
+            ctx["queue_wait_time"] += time.time() - wait_start
+
+            await asyncio.to_thread(stages["download"], ctx)
+            await asyncio.to_thread(resolve_params, ctx)
+            if await asyncio.to_thread(stages["lookup"], ctx):
+                return await asyncio.to_thread(stages["respond"], ctx)
+
+            # 工作区在 GPU 槽位之外放置，等待配额时不阻塞其他任务的 GPU 处理
+            await asyncio.to_thread(stages["workspace"], ctx)
+
+            # 等待 GPU 槽位
+            wait_start = time.time()
+            async with self.gpu_slot:
+                self.prefetch.release()
+                prefetch_held = False
+                ctx["queue_wait_time"] += time.time() - wait_start
+                await asyncio.to_thread(stages["process"], ctx)
+
+            await asyncio.to_thread(stages["upload"], ctx)
+            return await asyncio.to_thread(stages["respond"], ctx)
+
+        except Exception as e:
+            return await asyncio.to_thread(job_error_response, ctx, e)
+
+        finally:
+            if prefetch_held:
+                self.prefetch.release()
+            await asyncio.to_thread(cleanup_job, ctx)
+            if reserved:
+                await self.release_disk(reserved)
+
+
+# 并发模式流水线 (HANDLER_CONCURRENCY > 1 时使用)
+job_pipeline = None
+
+
+async def async_handler(job: dict) -> dict:
+    """
+    RunPod Serverless Handler (并发模式)
+    """
+    global job_pipeline
+    if job_pipeline is None:
+        job_pipeline = JobPipeline()
+    return await job_pipeline.run(job)
+
+
+def concurrency_modifier(current_concurrency: int) -> int:
+    """RunPod 并发度: 固定为 HANDLER_CONCURRENCY"""
+    return HANDLER_CONCURRENCY
 
 
 # RunPod 入口
-runpod.serverless.start({"handler": handler})
+if __name__ == "__main__":
+    boot()
+    if HANDLER_CONCURRENCY > 1:
+        runpod.serverless.start({"handler": async_handler, "concurrency_modifier": concurrency_modifier})
+    else:
+        runpod.serverless.start({"handler": handler})
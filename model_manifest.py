@@ -0,0 +1,181 @@
+"""
+模型清单解析
+=============
+根据预设 ini (configs/*.ini) 与 handler 的处理器/模型选择，计算实际需要的模型文件，
+供 download_models.py (构建镜像) 与 handler 启动校验共用。
+
+模型对应关系来自 FaceFusion 3.x 各模块的 collect_model_downloads():
+只下载所选模型，"many" 检测器/关键点模型才需要全部模型。
+"""
+
+import ast
+import configparser
+import os
+
+# 模型所在的 HuggingFace 仓库 (facefusion/{repo})，未列出的默认 models-3.0.0
+DEFAULT_MODEL_REPO = "models-3.0.0"
+MODEL_REPOS = {
+    "xseg_1": "models-3.1.0",
+    "xseg_2": "models-3.2.0",
+    "xseg_3": "models-3.2.0",
+    "hyperswap_1a_256": "models-3.3.0",
+    "hyperswap_1b_256": "models-3.3.0",
+    "hyperswap_1c_256": "models-3.3.0",
+    "yunet_2023_mar": "models-3.4.0",
+}
+
+# 人脸检测器 (旧名 yoloface 与 FaceFusion 3.x 的 yolo_face 等价)
+FACE_DETECTOR_MODELS = {
+    "retinaface": ["retinaface_10g"],
+    "scrfd": ["scrfd_2.5g"],
+    "yolo_face": ["yoloface_8n"],
+    "yoloface": ["yoloface_8n"],
+    "yunet": ["yunet_2023_mar"],
+}
+FACE_DETECTOR_MODELS["many"] = ["retinaface_10g", "scrfd_2.5g", "yoloface_8n", "yunet_2023_mar"]
+
+# 人脸关键点 (fan_68_5 用于 5 点 -> 68 点，总是需要)
+FACE_LANDMARKER_MODELS = {
+    "2dfan4": ["2dfan4"],
+    "peppa_wutz": ["peppa_wutz"],
+    "many": ["2dfan4", "peppa_wutz"],
+}
+
+# 每个任务都会加载的模型: 关键点转换、人脸识别、人脸分类、人脸解析
+BASE_MODELS = ["fan_68_5", "arcface_w600k_r50", "fairface", "bisenet_resnet_34"]
+
+# 处理器 -> (模型参数名, {模型名: 额外依赖的模型})
+PROCESSOR_MODELS = {
+    "face_swapper": ("face_swapper_model", {
+        "ghost_1_256": ["arcface_converter_ghost"],
+        "ghost_2_256": ["arcface_converter_ghost"],
+        "ghost_3_256": ["arcface_converter_ghost"],
+        "simswap_256": ["arcface_converter_simswap"],
+        "simswap_unofficial_512": ["arcface_converter_simswap"],
+    }),
+    "face_enhancer": ("face_enhancer_model", {}),
+    "expression_restorer": ("expression_restorer_model", {}),
+}
+
+# 一个模型名对应多个文件的情况
+MODEL_FILES = {
+    "live_portrait": ["live_portrait_feature_extractor", "live_portrait_generator", "live_portrait_motion_extractor"],
+}
+
+# 参数未指定时 FaceFusion 使用的默认值
+FACEFUSION_DEFAULTS = {
+    "face_detector_model": "yolo_face",
+    "face_landmarker_model": "2dfan4",
+    "face_occluder_model": "xseg_1",
+    "processors": "face_swapper",
+    "face_swapper_model": "inswapper_128_fp16",
+    "face_enhancer_model": "gfpgan_1.4",
+    "expression_restorer_model": "live_portrait",
+}
+
+# 检测器策略: single 只用所选检测器; many 每帧用全部检测器; fallback 找不到人脸时用全部检测器重试
+DETECTOR_STRATEGIES = ("single", "many", "fallback")
+
+# 预设 ini 中与参数名不同的键
+PRESET_KEY_ALIASES = {
+    "face_swapper_pixel_boost": "pixel_boost",
+}
+
+
+def read_ini(path: str) -> dict:
+    """读取 FaceFusion ini，展开为 {参数名: 值} (不区分 section)"""
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    values = {}
+    for section in parser.sections():
+        for key, value in parser.items(section):
+            values[PRESET_KEY_ALIASES.get(key, key)] = value
+    return values
+
+
+def model_repo(name: str) -> str:
+    return MODEL_REPOS.get(name, DEFAULT_MODEL_REPO)
+
+
+def resolve_models(params: dict) -> set:
+    """一组处理参数实际需要的模型名 (不含扩展名)"""
+    def get(key):
+        value = params.get(key)
+        return str(value) if value not in (None, "") else FACEFUSION_DEFAULTS[key]
+
+    models = set(BASE_MODELS)
+
+    detector = get("face_detector_model")
+    models.update(FACE_DETECTOR_MODELS.get(detector, [detector]))
+    if params.get("face_detector_strategy") in ("many", "fallback"):
+        models.update(FACE_DETECTOR_MODELS["many"])
+
+    landmarker = get("face_landmarker_model")
+    models.update(FACE_LANDMARKER_MODELS.get(landmarker, [landmarker]))
+
+    if "occlusion" in str(params.get("face_mask_types", "")).split() or params.get("face_occluder_model"):
+        models.add(get("face_occluder_model"))
+
+    for processor in get("processors").split():
+        if processor not in PROCESSOR_MODELS:
+            continue
+        option, dependencies = PROCESSOR_MODELS[processor]
+        model = get(option)
+        models.update(MODEL_FILES.get(model, [model]))
+        models.update(dependencies.get(model, []))
+
+    return models
+
+
+def resolve_deployment_models(default_params: dict, preset_params: dict, auto_tiers: list) -> list:
+    """
+    部署需要的全部模型: 每个预设 (叠加在默认参数之上)，以及 auto 预设的每个档位
+    preset_params: {预设名: ini 参数}
+    """
+    models = set()
+    for preset, values in preset_params.items():
+        params = dict(default_params, **values)
+        models |= resolve_models(params)
+        # auto 预设基于 serverless，可能切换到任一档位
+        if preset == "serverless":
+            for tier in auto_tiers:
+                models |= resolve_models(dict(params, **tier["params"]))
+    return sorted(models)
+
+
+def load_handler_selection(handler_path: str) -> dict:
+    """
+    不导入 handler (构建镜像时没有运行环境)，直接从源码中读取字面量常量:
+    DEFAULT_PARAMS, AUTO_TIERS, PRESET_CONFIGS
+    """
+    with open(handler_path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), handler_path)
+
+    names = {"DEFAULT_PARAMS", "AUTO_TIERS", "PRESET_CONFIGS"}
+    selection = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name in names:
+                selection[name] = ast.literal_eval(node.value)
+
+    missing = names - selection.keys()
+    if missing:
+        raise ValueError(f"Constants not found in {handler_path}: {sorted(missing)}")
+    return selection
+
+
+def resolve_from_sources(handler_path: str, configs_dir: str) -> list:
+    """从 handler.py 与 configs/ 目录解析部署需要的模型"""
+    selection = load_handler_selection(handler_path)
+    preset_params = {}
+    for preset, filename in selection["PRESET_CONFIGS"].items():
+        path = os.path.join(configs_dir, filename)
+        preset_params[preset] = read_ini(path) if os.path.exists(path) else {}
+    return resolve_deployment_models(selection["DEFAULT_PARAMS"], preset_params, selection["AUTO_TIERS"])
+
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    for model in resolve_from_sources(os.path.join(here, "handler.py"), os.path.join(here, "configs")):
+        print(f"{model_repo(model)}/{model}")
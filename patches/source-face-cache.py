@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Source Face Cache Hook for FaceFusion
+=====================================
+This script adds a hook to FaceFusion's face analyser so the persistent
+worker can serve source face analysis (bounding box, landmarks, embedding)
+from its cache instead of re-running detection and recognition per job.
+
+The hook wraps get_many_faces(): when SOURCE_FACE_HOOK is set it is called
+with the frames and the original function, and may return cached faces
+(or None to fall through). Without a hook FaceFusion behaves as before.
+
+Usage: python source-face-cache.py [facefusion_dir]
+"""
+
+import sys
+from pathlib import Path
+
+PATCH_MARKER = "# Source face cache hook (patched)"
+
+HOOK_CODE = '''
+
+''' + PATCH_MARKER + '''
+SOURCE_FACE_HOOK = None
+_uncached_get_many_faces = get_many_faces
+
+
+def get_many_faces(vision_frames):
+	if SOURCE_FACE_HOOK:
+		faces = SOURCE_FACE_HOOK(vision_frames, _uncached_get_many_faces)
+		if faces is not None:
+			return faces
+	return _uncached_get_many_faces(vision_frames)
+'''
+
+
+def patch_face_analyser(file_path: Path) -> None:
+    """Append the get_many_faces() wrapper to face_analyser.py."""
+    content = file_path.read_text()
+
+    if PATCH_MARKER in content:
+        print(f"  Already patched: {file_path}")
+        return
+
+    if "def get_many_faces(" not in content:
+        print(f"ERROR: get_many_faces() not found in {file_path}")
+        sys.exit(1)
+
+    # Appended at module level so processors importing get_many_faces get the wrapper
+    file_path.write_text(content.rstrip("\n") + "\n" + HOOK_CODE)
+    print(f"  Patched: {file_path}")
+
+
+def main():
+    facefusion_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else Path("/facefusion")
+
+    print("Adding source face cache hook to FaceFusion...")
+    print(f"  Directory: {facefusion_dir}")
+
+    face_analyser_path = facefusion_dir / "facefusion" / "face_analyser.py"
+
+    if not face_analyser_path.exists():
+        print(f"ERROR: {face_analyser_path} not found!")
+        sys.exit(1)
+
+    patch_face_analyser(face_analyser_path)
+
+    print("Source face cache hook added successfully!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+"""
+统计辅助函数 (客户端批量统计与基准测试共用)
+"""
+
+import math
+
+
+def percentile(values: list, q: float) -> float:
+    """最近秩百分位: 排序后第 ceil(q / 100 * n) 个值"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered), math.ceil(q / 100 * len(ordered))) - 1)
+    return ordered[index]
@@ -0,0 +1,61 @@
+"""
+测试环境
+handler 在导入时读取配置，必须在 import handler 之前设置环境变量:
+本地存储、关闭输入/结果缓存、CPU 桩 Worker，临时文件都放在独立的临时目录中
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+TEST_DIR = tempfile.mkdtemp(prefix="facefusion_tests_")
+os.environ.update({
+    "STORAGE_BACKEND": "local",
+    "STORAGE_LOCAL_DIR": os.path.join(TEST_DIR, "storage"),
+    "INPUT_CACHE": "0",
+    "RESULT_CACHE": "0",
+    "WORKSPACE_RAM_DIR": "",
+    "FACEFUSION_WORKER_BACKEND": "stub",
+    "FACEFUSION_WORKER_SOCKET": os.path.join(TEST_DIR, "worker.sock"),
+})
+# 进度推送只在 RunPod 环境中发出
+os.environ.pop("RUNPOD_WEBHOOK_POST_OUTPUT", None)
+
+requires_ffmpeg = pytest.mark.skipif(not (shutil.which("ffmpeg") and shutil.which("ffprobe")),
+                                     reason="ffmpeg/ffprobe not installed")
+
+
+@pytest.fixture(scope="session")
+def handler():
+    import handler as module
+    module.TEMP_DIR = os.path.join(TEST_DIR, "jobs")
+    yield module
+    if module.facefusion_worker is not None:
+        module.facefusion_worker.stop()
+    for worker in module.segment_workers:
+        worker.stop()
+
+
+@pytest.fixture
+def job_ctx(handler, tmp_path):
+    """最小的任务上下文 (只含纯函数需要的字段)"""
+    def make(job_input: dict = None, target_path: str = "target.mp4") -> dict:
+        return {
+            "job_id": "test_job",
+            "input": job_input or {},
+            "job_dir": str(tmp_path),
+            "target_path": os.path.join(str(tmp_path), target_path),
+            "params": handler.build_params(job_input or {}),
+            "trace": handler.JobTrace(),
+        }
+    return make
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
@@ -0,0 +1,81 @@
+"""输入下载: HEAD 探测、Range 分段并发下载与单连接回退"""
+
+import functools
+import os
+from http.server import SimpleHTTPRequestHandler
+
+import pytest
+
+from benchmarks.servers import InputServer, LocalServer
+
+FILE_SIZE = 3 * 1024 * 1024 + 123
+
+
+class QuietFileHandler(SimpleHTTPRequestHandler):
+    """不支持 Range 的静态文件服务器 (忽略 Range 头，始终返回 200)"""
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def input_dir(tmp_path_factory):
+    root = tmp_path_factory.mktemp("inputs")
+    (root / "target.mp4").write_bytes(os.urandom(FILE_SIZE))
+    return root
+
+
+@pytest.fixture(scope="module")
+def input_server(input_dir):
+    server = InputServer(str(input_dir)).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope="module")
+def plain_server(input_dir):
+    server = LocalServer(functools.partial(QuietFileHandler, directory=str(input_dir))).start()
+    yield server
+    server.stop()
+
+
+def test_probe_http_reports_size_and_ranges(handler, input_server):
+    probe = handler.probe_http(f"{input_server.url}/target.mp4")
+    assert probe["size"] == FILE_SIZE
+    assert probe["accept_ranges"] is True
+    assert probe["etag"]
+
+
+def test_probe_http_missing_file(handler, input_server):
+    assert handler.probe_http(f"{input_server.url}/missing.mp4") == {
+        "size": 0, "accept_ranges": False, "etag": "", "last_modified": ""}
+
+
+def test_download_file_ranged(handler, input_dir, input_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(handler, "RANGED_DOWNLOAD_MIN_SIZE", 1024 * 1024)
+    trace = handler.JobTrace()
+    dest = tmp_path / "target.mp4"
+    handler.download_file(f"{input_server.url}/target.mp4", str(dest), trace=trace)
+    assert dest.read_bytes() == (input_dir / "target.mp4").read_bytes()
+    record = trace.to_dict()["download"]
+    assert record["method"] == "ranged"
+    assert record["bytes"] == FILE_SIZE
+
+
+def test_download_file_small_file_streams(handler, input_dir, input_server, tmp_path):
+    trace = handler.JobTrace()
+    dest = tmp_path / "target.mp4"
+    handler.download_file(f"{input_server.url}/target.mp4", str(dest), trace=trace)
+    assert dest.read_bytes() == (input_dir / "target.mp4").read_bytes()
+    assert trace.to_dict()["download"]["method"] == "stream"
+
+
+def test_download_file_falls_back_when_range_is_ignored(handler, input_dir, plain_server, tmp_path, monkeypatch):
+    """服务端声明支持 Range 却返回 200 时回退为单连接，结果不受影响"""
+    monkeypatch.setattr(handler, "RANGED_DOWNLOAD_MIN_SIZE", 1024 * 1024)
+    trace = handler.JobTrace()
+    dest = tmp_path / "target.mp4"
+    probe = {"size": FILE_SIZE, "accept_ranges": True, "etag": "", "last_modified": ""}
+    handler.download_file(f"{plain_server.url}/target.mp4", str(dest), probe=probe, trace=trace)
+    assert dest.read_bytes() == (input_dir / "target.mp4").read_bytes()
+    assert trace.to_dict()["download"]["method"] == "stream"
@@ -0,0 +1,87 @@
+"""预检: 文件头类型识别、上限校验与探测失败的处理"""
+
+import pytest
+
+MP4_HEAD = b"\x00\x00\x00\x20ftypisom\x00\x00\x02\x00isomiso2avc1mp41"
+
+
+@pytest.mark.parametrize("head, content_type, expected", [
+    (b"\xff\xd8\xff\xe0\x00\x10JFIF", "", ("image", ".jpg")),
+    (b"\x89PNG\r\n\x1a\n\x00\x00", "", ("image", ".png")),
+    (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "", ("image", ".webp")),
+    (MP4_HEAD, "application/octet-stream", ("video", ".mp4")),
+    (b"\x00\x00\x00\x14ftypqt  ", "", ("video", ".mov")),
+    (b"RIFF\x00\x00\x00\x00AVI LIST", "", ("video", ".avi")),
+    (b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01\x42\xf7\x81\x01webm", "", ("video", ".webm")),
+    (b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01matroska", "", ("video", ".mkv")),
+    (b"<!DOCTYPE html><html>", "text/html; charset=utf-8", ("other", "")),
+    (b'{"error": "not found"}', "", ("other", "")),
+    (b"\x00\x01\x02\x03", "video/mp2t", ("video", "")),
+    (b"\x00\x01\x02\x03", "", ("unknown", "")),
+])
+def test_sniff_media_type(handler, head, content_type, expected):
+    assert handler.sniff_media_type(head, content_type) == expected
+
+
+def make_preflight(frames: int = 250, fps: float = 25.0, duration: float = 10.0, size: int = 1024, width: int = 1920, height: int = 1080) -> dict:
+    media = {"is_image": False, "fps": fps, "frames": frames, "duration": duration, "width": width, "height": height}
+    return {
+        "source": {"size": 1024},
+        "target": {"size": size, "media": media},
+        "estimate": {"frames": frames, "duration": frames / fps if fps else 0.0, "gpu_seconds": frames * 0.1},
+    }
+
+
+@pytest.fixture
+def limits(handler, monkeypatch):
+    def set_limits(**values):
+        for name in ("MAX_INPUT_SIZE", "MAX_DURATION", "MAX_PIXELS", "MAX_GPU_SECONDS"):
+            monkeypatch.setattr(handler, name, values.get(name, 0))
+    set_limits()
+    return set_limits
+
+
+def test_limits_pass_by_default(handler, limits):
+    assert handler.check_preflight_limits(make_preflight(size=10 ** 12), {}) == ""
+
+
+def test_limits_reject_each_bound(handler, limits):
+    limits(MAX_INPUT_SIZE=10 * 1024 ** 2)
+    assert "target_url is too large: 20.0 MB" in handler.check_preflight_limits(make_preflight(size=20 * 1024 ** 2), {})
+    # 只获取区间的任务不按目标文件大小拒绝
+    assert handler.check_preflight_limits(make_preflight(size=20 * 1024 ** 2), {"trim_start": 1}) == ""
+
+    limits(MAX_PIXELS=1280 * 720)
+    assert "exceeds the limit" in handler.check_preflight_limits(make_preflight(), {})
+
+    limits(MAX_DURATION=5)
+    assert "too long" in handler.check_preflight_limits(make_preflight(), {})
+
+    limits(MAX_GPU_SECONDS=10)
+    assert "Estimated GPU time" in handler.check_preflight_limits(make_preflight(), {})
+
+
+def test_trim_beyond_the_end_is_rejected(handler, limits):
+    preflight = make_preflight(frames=0)
+    assert "beyond the end" in handler.check_preflight_limits(preflight, {"trim_start": 20})
+
+
+def test_unknown_frame_count_skips_frame_limits(handler, limits):
+    """帧率/帧数未知 (容器未记录) 时不拒绝，也不因为没有区间而出错"""
+    limits(MAX_DURATION=5, MAX_GPU_SECONDS=10)
+    assert handler.check_preflight_limits(make_preflight(frames=0, fps=0.0, duration=0.0), {}) == ""
+    assert handler.check_preflight_limits(make_preflight(frames=0, fps=0.0, duration=0.0), {"trim_start": 20}) == ""
+
+
+def test_preflight_target_records_missing_ffprobe(handler, tmp_path, monkeypatch):
+    target = tmp_path / "target.mp4"
+    target.write_bytes(MP4_HEAD + bytes(1000))
+
+    def missing_ffprobe(*args, **kwargs):
+        raise FileNotFoundError("[Errno 2] No such file or directory: 'ffprobe'")
+
+    monkeypatch.setattr(handler, "probe_media", missing_ffprobe)
+    report = handler.preflight_target(target.as_uri())
+    assert report["kind"] == "video"
+    assert report["media"] is None
+    assert "ffprobe" in report["error"]
@@ -0,0 +1,52 @@
+"""FaceFusion 输出解析: tqdm 进度行、日志尾部与进度所需的日志级别"""
+
+
+def test_parse_progress_frame_rate(handler):
+    update = handler.parse_progress("processing:  12%|█▏   | 120/1000 [00:05<00:37, 23.45frame/s, execution_providers=['cuda']]")
+    assert update == {
+        "stage": "processing",
+        "frames_processed": 120,
+        "frames_total": 1000,
+        "percent": 12.0,
+        "fps": 23.45,
+        "eta_seconds": 37.5,
+    }
+
+
+def test_parse_progress_slow_rate_is_inverted(handler):
+    update = handler.parse_progress("extracting:   0%|          | 1/400 [00:04<26:36, 4.00s/frame]")
+    assert update["stage"] == "extracting"
+    assert update["fps"] == 0.25
+    assert update["eta_seconds"] == 1596.0
+
+
+def test_parse_progress_without_description_or_rate(handler):
+    update = handler.parse_progress("  5/10 [00:00<?, 0.00frame/s]")
+    assert update["stage"] == "processing"
+    assert update["percent"] == 50.0
+    assert update["fps"] == 0.0
+    assert update["eta_seconds"] is None
+
+
+def test_parse_progress_ignores_log_lines(handler):
+    assert handler.parse_progress("[FACEFUSION.CORE] Processing to video succeed in 12.3 seconds") == {}
+    assert handler.parse_progress("") == {}
+
+
+def test_output_monitor_keeps_a_bounded_tail_and_forwards_progress(handler):
+    updates = []
+    monitor = handler.OutputMonitor(progress=updates.append)
+    for index in range(handler.LOG_TAIL_LINES + 10):
+        monitor.feed(f"line {index}")
+    monitor.feed("processing:  50%|█████     | 5/10 [00:01<00:01, 5.00frame/s]")
+    tail = monitor.tail_text().splitlines()
+    assert len(tail) == handler.LOG_TAIL_LINES
+    assert tail[-1] == f"line {handler.LOG_TAIL_LINES + 9}"
+    assert updates and updates[-1]["frames_processed"] == 5
+
+
+def test_facefusion_args_raise_quiet_log_levels_to_info(handler):
+    args = handler.build_facefusion_args("s.jpg", "t.mp4", "o.mp4", dict(handler.build_params({}), log_level="warn"))
+    assert args[args.index("--log-level") + 1] == "info"
+    args = handler.build_facefusion_args("s.jpg", "t.mp4", "o.mp4", dict(handler.build_params({}), log_level="debug"))
+    assert args[args.index("--log-level") + 1] == "debug"
@@ -0,0 +1,33 @@
+"""结果缓存 Key: 由输入内容哈希与规范化参数确定"""
+
+
+def make_ctx(job_ctx, job_input: dict = None, target_path: str = "target.mp4", source_hash: str = "s" * 64, target_hash: str = "t" * 64) -> dict:
+    ctx = job_ctx(job_input, target_path)
+    ctx.update(source_hash=source_hash, target_hash=target_hash)
+    return ctx
+
+
+def test_same_inputs_and_params_give_the_same_key(job_ctx, handler):
+    first = handler.get_result_key(make_ctx(job_ctx, {"face_swapper_model": "inswapper_128"}))
+    second = handler.get_result_key(make_ctx(job_ctx, {"face_swapper_model": "inswapper_128"}))
+    assert first == second
+    assert first.startswith("facefusion/results/") and first.endswith(".mp4")
+
+
+def test_key_changes_with_content_and_params(job_ctx, handler):
+    base = handler.get_result_key(make_ctx(job_ctx))
+    assert handler.get_result_key(make_ctx(job_ctx, source_hash="x" * 64)) != base
+    assert handler.get_result_key(make_ctx(job_ctx, target_hash="x" * 64)) != base
+    assert handler.get_result_key(make_ctx(job_ctx, {"face_swapper_model": "simswap_256"})) != base
+
+
+def test_key_is_independent_of_param_order_and_value_types(job_ctx, handler):
+    ctx = make_ctx(job_ctx)
+    ctx["params"] = {"output_video_quality": 80, "face_detector_score": 0.5}
+    reordered = make_ctx(job_ctx)
+    reordered["params"] = {"face_detector_score": "0.5", "output_video_quality": "80"}
+    assert handler.get_result_key(ctx) == handler.get_result_key(reordered)
+
+
+def test_key_uses_the_target_extension(job_ctx, handler):
+    assert handler.get_result_key(make_ctx(job_ctx, target_path="target.PNG")).endswith(".png")
@@ -0,0 +1,51 @@
+"""分段并行: 段数规划、段输出路径、Worker 数量的显存限制与关键帧切分"""
+
+import subprocess
+
+import pytest
+
+from conftest import requires_ffmpeg
+
+
+@pytest.mark.parametrize("duration, segments, expected", [
+    (120.0, 4, 4),
+    (120.0, 8, 4),   # 每段不短于 SEGMENT_MIN_DURATION (30s)
+    (59.0, 4, 1),
+    (10.0, 4, 1),
+    (0.0, 4, 1),
+    (300.0, 1, 1),
+])
+def test_get_segment_count(handler, duration, segments, expected):
+    assert handler.get_segment_count(duration, segments) == expected
+
+
+def test_segment_output_path_only_renames_the_file(handler):
+    path = "/tmp/segment_jobs/job_1/segments/segment_003.mp4"
+    assert handler.get_segment_output_path(path) == "/tmp/segment_jobs/job_1/segments/output_003.mp4"
+
+
+def test_segment_workers_are_limited_by_free_vram(handler, monkeypatch):
+    monkeypatch.setattr(handler, "facefusion_worker", None)
+    monkeypatch.setattr(handler, "get_free_vram", lambda: handler.SEGMENT_WORKER_VRAM * 2 + 100)
+    assert handler.get_segment_workers(8) == [None] * 3
+    monkeypatch.setattr(handler, "get_free_vram", lambda: None)
+    assert handler.get_segment_workers(4) == [None] * 4
+
+
+@requires_ffmpeg
+def test_split_video_timed_cuts_on_keyframes(handler, tmp_path):
+    target = tmp_path / "target.mp4"
+    subprocess.run([
+        "ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "testsrc=duration=6:size=160x120:rate=10",
+        "-c:v", "libx264", "-g", "10", "-bf", "0", "-pix_fmt", "yuv420p", str(target),
+    ], check=True, timeout=120)
+
+    segments = handler.split_video_timed(str(target), str(tmp_path / "segments"), segment_time=2.0)
+    assert len(segments) == 3
+    assert [round(segment["start"], 1) for segment in segments] == [0.0, 2.0, 4.0]
+    assert sum(segment["duration"] for segment in segments) == pytest.approx(6.0, abs=0.2)
+    assert all(handler.probe_media(segment["path"])["frames"] > 0 for segment in segments)
+
+    split = handler.split_video_timed(str(target), str(tmp_path / "split"), split_times=[2.5])
+    # 在 2.5s 之后的第一个关键帧 (3s) 处切分
+    assert [round(segment["start"], 1) for segment in split] == [0.0, 3.0]
@@ -0,0 +1,31 @@
+"""最近秩百分位与批量统计"""
+
+import pytest
+
+from stats import percentile
+
+
+@pytest.mark.parametrize("n, q, expected", [
+    (10, 50, 5),
+    (10, 90, 9),
+    (10, 99, 10),
+    (20, 95, 19),
+    (100, 99, 99),
+    (100, 100, 100),
+    (3, 50, 2),
+    (1, 99, 1),
+])
+def test_percentile_nearest_rank(n, q, expected):
+    assert percentile(list(range(n, 0, -1)), q) == expected
+
+
+def test_percentile_edges():
+    assert percentile([], 50) == 0.0
+    assert percentile([4.0, 2.0], 0) == 2.0
+
+
+def test_batch_stats_latency_percentiles():
+    client = pytest.importorskip("client")
+    results = [{"status": "success", "latency": float(i)} for i in range(1, 11)]
+    latency = client.batch_stats(results)["latency"]
+    assert (latency["p50"], latency["p90"], latency["p99"], latency["max"]) == (5.0, 9.0, 10.0, 10.0)
@@ -0,0 +1,84 @@
+"""R2Storage 对本地 S3 兼容服务器的单次/分片上传、分片重试与中止、Range 下载"""
+
+import os
+
+import pytest
+
+import storage
+from benchmarks.servers import LocalServer, S3RequestHandler
+
+PART_SIZE = 5 * 1024 * 1024
+
+
+class FlakyS3RequestHandler(S3RequestHandler):
+    """分片上传请求按 server.part_failures 中的次数返回 500"""
+
+    def do_PUT(self):
+        query = self._query()
+        number = int(query.get("partNumber", 0))
+        if number and self.server.part_failures.get(number, 0) > 0:
+            self.server.part_failures[number] -= 1
+            self._read_body()
+            self._respond(500, b"<Error><Code>InternalError</Code></Error>")
+            return
+        super().do_PUT()
+
+
+@pytest.fixture
+def s3_server():
+    server = LocalServer(FlakyS3RequestHandler, objects={}, uploads={}, part_failures={}).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def r2(s3_server, monkeypatch):
+    monkeypatch.setattr(storage.time, "sleep", lambda seconds: None)
+    return storage.R2Storage(s3_server.url, "bucket", "key-id", "secret", multipart_threshold=PART_SIZE,
+                             part_size=PART_SIZE, upload_concurrency=4, part_retries=3,
+                             download_connections=4, ranged_min_size=1024 * 1024)
+
+
+def write_file(path, size: int) -> bytes:
+    data = os.urandom(size)
+    path.write_bytes(data)
+    return data
+
+
+def test_small_file_uses_single_put(r2, s3_server, tmp_path):
+    data = write_file(tmp_path / "small.jpg", 1024)
+    assert r2.put(str(tmp_path / "small.jpg"), "results/small.jpg") == "single"
+    assert s3_server.httpd.objects["/bucket/results/small.jpg"] == data
+
+
+def test_multipart_upload_reassembles_parts_in_order(r2, s3_server, tmp_path):
+    data = write_file(tmp_path / "large.mp4", 2 * PART_SIZE + 4321)
+    assert r2.put(str(tmp_path / "large.mp4"), "results/large.mp4") == "multipart"
+    assert s3_server.httpd.objects["/bucket/results/large.mp4"] == data
+    assert s3_server.httpd.uploads == {}
+
+
+def test_multipart_upload_retries_failed_parts(r2, s3_server, tmp_path):
+    data = write_file(tmp_path / "large.mp4", 2 * PART_SIZE + 1)
+    s3_server.httpd.part_failures.update({2: 2})
+    assert r2.put(str(tmp_path / "large.mp4"), "results/large.mp4") == "multipart"
+    assert s3_server.httpd.objects["/bucket/results/large.mp4"] == data
+    assert s3_server.httpd.part_failures[2] == 0
+
+
+def test_multipart_upload_aborts_after_retries(r2, s3_server, tmp_path):
+    write_file(tmp_path / "large.mp4", 2 * PART_SIZE + 1)
+    s3_server.httpd.part_failures.update({3: r2.part_retries})
+    with pytest.raises(Exception, match="part 3 upload failed"):
+        r2.put(str(tmp_path / "large.mp4"), "results/large.mp4")
+    assert "/bucket/results/large.mp4" not in s3_server.httpd.objects
+    assert s3_server.httpd.uploads == {}
+
+
+def test_get_uses_ranged_download_for_large_objects(r2, s3_server, tmp_path):
+    data = os.urandom(3 * 1024 * 1024)
+    s3_server.httpd.objects["/bucket/inputs/target.mp4"] = data
+    assert r2.head("inputs/target.mp4")["size"] == len(data)
+    assert r2.get("inputs/target.mp4", str(tmp_path / "target.mp4")) == "ranged"
+    assert (tmp_path / "target.mp4").read_bytes() == data
+    assert r2.head("inputs/missing.mp4") is None
@@ -0,0 +1,55 @@
+"""区间任务: trim 参数解析与帧号换算"""
+
+import pytest
+
+MEDIA = {"fps": 25.0, "frames": 825, "duration": 33.0}
+
+
+def test_get_trim(handler):
+    assert handler.get_trim({}) is None
+    assert handler.get_trim({"trim_start": 5}) == (5.0, None)
+    assert handler.get_trim({"trim_end": "12.5"}) == (0.0, 12.5)
+    assert handler.get_trim({"trim_start": 0, "trim_end": 3}) == (0.0, 3.0)
+
+
+def test_apply_trim_window(handler, job_ctx):
+    ctx = job_ctx({"trim_start": 4, "trim_end": 10})
+    media = dict(MEDIA)
+    handler.apply_trim(ctx, (4.0, 10.0), media)
+    assert ctx["params"]["trim"] == "4-10:window"
+    assert (ctx["params"]["trim_frame_start"], ctx["params"]["trim_frame_end"]) == (100, 250)
+    assert media["frames"] == 150
+
+
+def test_apply_trim_open_end_and_fetched_window(handler, job_ctx):
+    """只获取了区间片段时，帧号相对片段起点 (trim_origin)"""
+    ctx = job_ctx({"trim_start": 20})
+    ctx["trim_origin"] = 18.0
+    media = {"fps": 25.0, "frames": 375, "duration": 15.0}
+    handler.apply_trim(ctx, (20.0, None), media)
+    assert ctx["params"]["trim"] == "20-:window"
+    assert ctx["params"]["trim_frame_start"] == 50
+    assert "trim_frame_end" not in ctx["params"]
+    assert media["frames"] == 325
+
+
+def test_apply_trim_splice_keeps_full_frames(handler, job_ctx):
+    ctx = job_ctx({"trim_start": 4, "trim_end": 10, "trim_output": "splice"})
+    handler.apply_trim(ctx, (4.0, 10.0), dict(MEDIA))
+    assert ctx["params"]["trim"] == "4-10:splice"
+    assert "trim_frame_start" not in ctx["params"]
+
+
+def test_trim_changes_the_result_key(handler, job_ctx):
+    keys = set()
+    for trim in ((4.0, 10.0), (4.0, 11.0)):
+        ctx = job_ctx({"trim_start": trim[0], "trim_end": trim[1]})
+        ctx.update(source_hash="s", target_hash="t")
+        handler.apply_trim(ctx, trim, dict(MEDIA))
+        keys.add(handler.get_result_key(ctx))
+    assert len(keys) == 2
+
+
+def test_apply_trim_beyond_the_end(handler, job_ctx):
+    with pytest.raises(ValueError, match="beyond the end"):
+        handler.apply_trim(job_ctx({"trim_start": 40}), (40.0, None), dict(MEDIA))
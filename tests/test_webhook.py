@@ -0,0 +1,67 @@
+"""webhook 推送: 首次投递的短超时与后台重试"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from benchmarks.servers import LocalServer
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """记录收到的投递；server.delays 中的秒数依次用于前几个请求 (模拟慢接收方)"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        with self.server.lock:
+            delay = self.server.delays.pop(0) if self.server.delays else 0
+        time.sleep(delay)
+        with self.server.lock:
+            self.server.attempts.append(self.headers["X-FaceFusion-Attempt"])
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@pytest.fixture
+def receiver():
+    server = LocalServer(WebhookRequestHandler, delays=[], attempts=[], lock=threading.Lock()).start()
+    yield server
+    server.stop()
+
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_first_attempt_is_delivered_before_send_returns(handler, receiver):
+    handler.WebhookSender().send(f"{receiver.url}/hook", "job_1", {"status": "success"})
+    assert receiver.httpd.attempts == ["1"]
+
+
+def test_slow_receiver_does_not_block_send(handler, receiver, monkeypatch):
+    monkeypatch.setattr(handler, "WEBHOOK_INLINE_TIMEOUT", 0.3)
+    receiver.httpd.delays.append(2.0)
+    sender = handler.WebhookSender(backoff=0.1)
+
+    start = time.time()
+    sender.send(f"{receiver.url}/hook", "job_1", {"status": "success"})
+    assert time.time() - start < 1.5
+    # 超时的首次请求也可能被接收方处理，重试在后台以完整超时进行
+    assert wait_for(lambda: "2" in receiver.httpd.attempts)
+
+
+def test_inline_attempt_can_be_disabled(handler, receiver, monkeypatch):
+    monkeypatch.setattr(handler, "WEBHOOK_INLINE_TIMEOUT", 0)
+    handler.WebhookSender().send(f"{receiver.url}/hook", "job_1", {"status": "success"})
+    assert wait_for(lambda: receiver.httpd.attempts == ["1"])
@@ -0,0 +1,80 @@
+"""常驻 Worker 的 IPC 协议 (CPU 桩后端)"""
+
+import os
+
+import worker
+
+
+def test_get_arg_value_accepts_short_and_long_names():
+    args = ["headless-run", "-t", "in.mp4", "--output-path", "out.mp4"]
+    assert worker.get_arg_value(args, "-t", "--target-path") == "in.mp4"
+    assert worker.get_arg_value(args, "-o", "--output-path") == "out.mp4"
+    assert worker.get_arg_value(args, "--face-detector-model") == ""
+
+
+def test_handle_message_ping_and_unknown_type():
+    backend = worker.StubBackend()
+    assert worker.handle_message(backend, {"type": "ping"})["backend"] == "stub"
+    assert worker.handle_message(backend, {"type": "bogus"})["status"] == "error"
+
+
+def test_handle_message_reports_backend_errors():
+    response = worker.handle_message(worker.StubBackend(), {"type": "run", "args": ["headless-run"]})
+    assert response["status"] == "error"
+    assert "Missing target or output path" in response["error"]
+
+
+def test_stub_no_face_only_succeeds_with_many(tmp_path, monkeypatch):
+    target = tmp_path / "target.jpg"
+    target.write_bytes(b"image")
+    args = ["headless-run", "-t", str(target), "-o", str(tmp_path / "out.jpg")]
+    monkeypatch.setenv("FACEFUSION_STUB_NO_FACE", "1")
+    backend = worker.StubBackend()
+    assert backend.run(args) == 1
+    assert backend.run(args + ["--face-detector-model", "many"]) == 0
+    assert (tmp_path / "out.jpg").read_bytes() == b"image"
+
+
+def test_worker_round_trip_and_restart(handler, tmp_path):
+    client = handler.FaceFusionWorker(backend="stub", address=str(tmp_path / "worker.sock"))
+    try:
+        target = tmp_path / "target.jpg"
+        target.write_bytes(b"image")
+        output = tmp_path / "output.jpg"
+        result = client.run(["headless-run", "-t", str(target), "-o", str(output)])
+        assert result["status"] == "ok" and result["code"] == 0
+        assert output.read_bytes() == b"image"
+
+        # Worker 进程退出后下一个请求重新拉起
+        client.process.kill()
+        client.process.wait()
+        output.unlink()
+        assert client.run(["headless-run", "-t", str(target), "-o", str(output)])["code"] == 0
+        assert client.starts == 2
+        assert os.path.exists(output)
+    finally:
+        client.stop()
+
+
+def test_worker_output_is_drained_before_the_response(handler, tmp_path, monkeypatch):
+    """日志尾部在返回时已包含本次请求的输出 (detector fallback 依赖它)"""
+    monkeypatch.setenv("FACEFUSION_STUB_NO_FACE", "1")
+    client = handler.FaceFusionWorker(backend="stub", address=str(tmp_path / "worker.sock"))
+    try:
+        target = tmp_path / "target.jpg"
+        target.write_bytes(b"image")
+        for _ in range(3):
+            result = client.run(["headless-run", "-t", str(target), "-o", str(tmp_path / "output.jpg")])
+            assert result["code"] == 1
+            assert "No source face detected" in client.monitor.tail_text()
+    finally:
+        client.stop()
+
+
+def test_output_monitor_consumes_sync_markers(handler):
+    monitor = handler.OutputMonitor()
+    monitor.feed("[FACEFUSION.CORE] done")
+    monitor.feed(f"{handler.WORKER_OUTPUT_SYNC_PREFIX}abc")
+    assert monitor.wait_sync("abc", timeout=0)
+    assert not monitor.wait_sync("other", timeout=0)
+    assert monitor.tail_text() == "[FACEFUSION.CORE] done"
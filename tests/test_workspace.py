@@ -0,0 +1,57 @@
+"""任务工作区: 预估占用与磁盘配额"""
+
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def manager(handler):
+    return handler.WorkspaceManager(ram_dir="", disk_quota=1000)
+
+
+def test_disk_reservation_is_capped_at_the_quota(manager, tmp_path):
+    workspace = manager.acquire("big", {"bmp": 5000, "png": 4000}, str(tmp_path))
+    assert workspace["location"] == "disk" and workspace["frame_format"] == "png"
+    assert workspace["reserved_bytes"] == 1000
+    manager.release("big")
+    assert manager.reserved == {"ram": 0, "disk": 0}
+
+
+def test_waits_for_quota_released_by_other_jobs(manager, tmp_path):
+    manager.acquire("first", {"bmp": 900, "png": 600}, str(tmp_path / "first"))
+    acquired = threading.Event()
+
+    def acquire_second():
+        manager.acquire("second", {"bmp": 900, "png": 600}, str(tmp_path / "second"))
+        acquired.set()
+
+    thread = threading.Thread(target=acquire_second)
+    thread.start()
+    assert not acquired.wait(0.2)
+    manager.release("first")
+    assert acquired.wait(5)
+    thread.join()
+    assert manager.reserved["disk"] == 600
+
+
+def test_estimate_falls_back_to_input_size(handler, job_ctx, monkeypatch):
+    ctx = job_ctx()
+    with open(ctx["target_path"], "wb") as f:
+        f.write(bytes(1000))
+
+    def missing_ffprobe(*args, **kwargs):
+        raise FileNotFoundError("ffprobe")
+
+    monkeypatch.setattr(handler, "probe_media", missing_ffprobe)
+    expected = int(1000 * handler.PIPELINE_DISK_FACTOR)
+    assert handler.estimate_workspace(ctx) == {"bmp": expected, "png": expected}
+
+
+def test_estimate_counts_trimmed_frames(handler, job_ctx, monkeypatch):
+    ctx = job_ctx()
+    with open(ctx["target_path"], "wb") as f:
+        f.write(bytes(1000))
+    ctx["params"].update(trim_frame_start=10, trim_frame_end=20)
+    monkeypatch.setattr(handler, "probe_media", lambda path: {"frames": 100, "width": 10, "height": 10})
+    assert handler.estimate_workspace(ctx) == {"bmp": 10 * 100 * 3 + 2000, "png": 10 * 100 * 2 + 2000}
@@ -0,0 +1,408 @@
+"""
+FaceFusion 常驻 Worker
+=======================
+只导入一次 FaceFusion，推理会话 (ONNX Runtime session) 在任务之间常驻显存，
+通过本地 IPC (multiprocessing.connection, Unix socket) 接收 handler 的任务。
+
+协议 (每条消息是一个 dict):
+    {"type": "ping"}                          -> {"status": "ok", "backend": "..."}
+    {"type": "run", "args": [...]}            -> {"status": "ok", "code": 0, "duration": 1.23}
+                                              -> {"status": "error", "error": "...", "traceback": "..."}
+    {"type": "scan", "path": "...", "fps": 2, "width": 640, "height": 360, "duration": 60.0, "args": [...]}
+                                              -> {"status": "ok", "faces": [0, 1, ...], "duration": 1.23}
+    {"type": "shutdown"}                      -> {"status": "ok"} 然后退出
+
+消息带 "sync" 时，Worker 在回复前向 stdout 输出一行 "[worker] output-sync {sync}"，
+handler 读到该行即可确认本次请求的输出已全部读取。
+
+args 与 `facefusion.py` 的命令行参数相同 (以 "headless-run" 开头)。
+scan 是人脸预扫描: 以低帧率解码视频并运行检测器，faces 为每个采样帧的人脸数；
+其 args 只包含检测器相关选项 (--face-detector-model 等)。
+
+Usage: python worker.py --address /tmp/facefusion_worker.sock [--backend facefusion|stub]
+鉴权密钥通过环境变量 FACEFUSION_WORKER_AUTHKEY 传入。
+"""
+
+import argparse
+import collections
+import hashlib
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import time
+import traceback
+from multiprocessing.connection import Listener
+
+FACEFUSION_PATH = "/facefusion"
+
+# 输出同步标记的前缀 (与 handler.py 一致)
+OUTPUT_SYNC_PREFIX = "[worker] output-sync "
+
+# 图片扩展名 (桩后端用来判断帧数)
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+# 源脸分析缓存 (需要 patches/source-face-cache.py)
+SOURCE_FACE_CACHE_SIZE = int(os.environ.get("SOURCE_FACE_CACHE_SIZE", "256"))  # 内存中保留的条目数
+SOURCE_FACE_CACHE_DIR = os.environ.get("SOURCE_FACE_CACHE_DIR", "")  # 非空时持久化到该目录
+
+# 影响源脸检测结果的参数，与内容哈希一起组成缓存键
+SOURCE_FACE_KEY_ITEMS = ("face_detector_model", "face_detector_size", "face_detector_score",
+                         "face_landmarker_model", "face_landmarker_score")
+
+
+def get_arg_value(args: list, *names: str) -> str:
+    """从命令行参数列表中取出某个选项的值"""
+    for name in names:
+        if name in args:
+            index = args.index(name)
+            if index + 1 < len(args):
+                return args[index + 1]
+    return ""
+
+
+class SourceFaceCache:
+    """
+    源脸分析结果 (检测框、关键点、embedding 等 Face 对象) 的缓存
+    - 键: 源文件内容 SHA-256 + 检测参数
+    - 内存 LRU，可选以 pickle 持久化到磁盘 (Worker 重启后仍可命中)
+    """
+
+    def __init__(self, max_items: int = SOURCE_FACE_CACHE_SIZE, cache_dir: str = SOURCE_FACE_CACHE_DIR):
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.entries = collections.OrderedDict()
+        # (路径, 大小, mtime) -> 内容哈希，批量任务与分段任务复用同一个源文件
+        self.file_hashes = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def hash_file(self, path: str) -> str:
+        stat = os.stat(path)
+        file_id = (path, stat.st_size, stat.st_mtime_ns)
+        if file_id not in self.file_hashes:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            self.file_hashes[file_id] = digest.hexdigest()
+        return self.file_hashes[file_id]
+
+    def make_key(self, path: str, options: dict) -> str:
+        raw = self.hash_file(path) + "|" + "|".join(f"{k}={options.get(k)}" for k in SOURCE_FACE_KEY_ITEMS)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def get(self, key: str):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.cache_dir and os.path.exists(self._disk_path(key)):
+            try:
+                with open(self._disk_path(key), "rb") as f:
+                    faces = pickle.load(f)
+            except (OSError, pickle.PickleError, EOFError, AttributeError) as e:
+                print(f"[worker] Source face cache read failed: {e}", flush=True)
+                return None
+            self._remember(key, faces)
+            return faces
+        return None
+
+    def put(self, key: str, faces) -> None:
+        self._remember(key, faces)
+        if self.cache_dir:
+            tmp_path = self._disk_path(key) + ".tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(faces, f)
+                os.replace(tmp_path, self._disk_path(key))
+            except OSError as e:
+                print(f"[worker] Source face cache write failed: {e}", flush=True)
+
+    def _remember(self, key: str, faces) -> None:
+        self.entries[key] = faces
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_items:
+            self.entries.popitem(last=False)
+
+
+class StubBackend:
+    """
+    CPU 桩后端: 不做推理，直接把 target 复制为 output
+    用于在没有 GPU 的环境下测试任务协议
+    """
+    name = "stub"
+
+    def __init__(self):
+        self.last_run_info = {}
+        # 每帧模拟耗时 (秒)
+        self.frame_cost = float(os.environ.get("FACEFUSION_STUB_FRAME_COST", "0"))
+        # 视频的模拟帧数
+        self.video_frames = int(os.environ.get("FACEFUSION_STUB_VIDEO_FRAMES", "30"))
+
+    def warmup(self):
+        pass
+
+    def run(self, args: list) -> int:
+        target_path = get_arg_value(args, "-t", "--target-path")
+        output_path = get_arg_value(args, "-o", "--output-path")
+        if not target_path or not output_path:
+            raise ValueError("Missing target or output path")
+
+        # 模拟 FaceFusion 找不到源人脸 (只有 many 检测器能找到)，用于测试 detector fallback
+        if os.environ.get("FACEFUSION_STUB_NO_FACE") == "1" and get_arg_value(args, "--face-detector-model") != "many":
+            print("[FACEFUSION.CORE] No source face detected", file=sys.stderr, flush=True)
+            return 1
+
+        ext = os.path.splitext(target_path)[1].lower()
+        frames = 1 if ext in IMAGE_EXTENSIONS else self.video_frames
+        # 与 FaceFusion 一致: warn/error 日志级别不输出进度条
+        show_progress = get_arg_value(args, "--log-level") not in ("warn", "error")
+        if self.frame_cost > 0 and show_progress:
+            # 输出与 FaceFusion (tqdm) 相同格式的进度，便于测试进度解析
+            for frame in range(1, frames + 1):
+                time.sleep(self.frame_cost)
+                percent = frame * 100 // frames
+                print(f"processing: {percent}%| | {frame}/{frames} [00:00<00:00, {1 / self.frame_cost:.2f}frame/s]",
+                      end="\r", file=sys.stderr, flush=True)
+            print(file=sys.stderr, flush=True)
+
+        shutil.copyfile(target_path, output_path)
+        return 0
+
+    def scan(self, message: dict) -> list:
+        """按 FACEFUSION_STUB_FACES (如 "0-8,20-24"，单位秒) 模拟人脸时间线，未设置时每个采样帧都有人脸"""
+        self.last_run_info = {}
+        ranges = []
+        for item in filter(None, os.environ.get("FACEFUSION_STUB_FACES", "").split(",")):
+            start, _, end = item.partition("-")
+            ranges.append((float(start), float(end)))
+        fps = float(message["fps"])
+        samples = int(float(message["duration"]) * fps) + 1
+        return [int(not ranges or any(start <= index / fps <= end for start, end in ranges)) for index in range(samples)]
+
+
+class FaceFusionBackend:
+    """真实后端: 在当前进程内运行 FaceFusion headless 流程"""
+    name = "facefusion"
+
+    def __init__(self, facefusion_path: str):
+        os.chdir(facefusion_path)
+        sys.path.insert(0, facefusion_path)
+
+        from facefusion import core, face_analyser, face_detector, logger, state_manager, vision
+        from facefusion.args import apply_args
+        from facefusion.jobs import job_manager
+        from facefusion.program import create_program
+
+        self.core = core
+        self.face_detector = face_detector
+        self.logger = logger
+        self.state_manager = state_manager
+        self.apply_args = apply_args
+        self.job_manager = job_manager
+        self.create_program = create_program
+        self.vision = vision
+        # 已经通过 pre_check 的处理器组合
+        self.checked_processors = set()
+        self.last_run_info = {}
+
+        # 源脸分析缓存: FaceFusion 打过 source-face-cache 补丁时才可用
+        self.source_face_cache = None
+        self.source_key = None
+        self.source_frame = None
+        if hasattr(face_analyser, "SOURCE_FACE_HOOK"):
+            self.source_face_cache = SourceFaceCache()
+            face_analyser.SOURCE_FACE_HOOK = self.lookup_source_faces
+        else:
+            print("[worker] face_analyser is not patched, source face cache disabled", flush=True)
+
+    def lookup_source_faces(self, vision_frames: list, compute):
+        """
+        get_many_faces() 的钩子: 只处理当前任务的源图片 (与 read_static_image 缓存的帧是同一对象)，
+        其他帧返回 None 交给 FaceFusion 正常检测
+        """
+        if self.source_key is None or len(vision_frames) != 1 or vision_frames[0] is not self.source_frame:
+            return None
+
+        faces = self.source_face_cache.get(self.source_key)
+        if faces is not None:
+            self.last_run_info["source_face_cache"] = "hit"
+            return faces
+
+        faces = compute(vision_frames)
+        if faces:
+            self.source_face_cache.put(self.source_key, faces)
+        self.last_run_info["source_face_cache"] = "miss"
+        return faces
+
+    def prepare_source_faces(self) -> None:
+        """单个源图片时计算缓存键，并通过 read_static_image (lru_cache) 取得 FaceFusion 将使用的同一帧对象"""
+        self.source_key = None
+        self.source_frame = None
+        source_paths = self.state_manager.get_item("source_paths") or []
+        if self.source_face_cache is None or len(source_paths) != 1:
+            return
+        options = {name: self.state_manager.get_item(name) for name in SOURCE_FACE_KEY_ITEMS}
+        self.source_key = self.source_face_cache.make_key(source_paths[0], options)
+        self.source_frame = self.vision.read_static_image(source_paths[0])
+
+    def warmup(self):
+        if not self.core.common_pre_check():
+            raise RuntimeError("FaceFusion common pre-check failed")
+
+    def parse_args(self, args: list) -> dict:
+        # 常驻模式下推理会话必须跨任务保留
+        if "--video-memory-strategy" not in args:
+            args = args + ["--video-memory-strategy", "tolerant"]
+
+        program = self.create_program()
+        try:
+            return vars(program.parse_args(args))
+        except SystemExit as e:
+            raise ValueError(f"Invalid FaceFusion arguments (exit code {e.code})")
+
+    def run(self, args: list) -> int:
+        self.last_run_info = {}
+        parsed_args = self.parse_args(args)
+        self.apply_args(parsed_args, self.state_manager.init_item)
+        self.logger.init(self.state_manager.get_item("log_level"))
+
+        if not self.job_manager.init_jobs(self.state_manager.get_item("jobs_path")):
+            raise RuntimeError("FaceFusion job manager init failed")
+
+        # 处理器 pre_check 会校验/下载模型，同一组合只做一次
+        processors = tuple(self.state_manager.get_item("processors") or [])
+        if processors not in self.checked_processors:
+            if not self.core.processors_pre_check():
+                raise RuntimeError(f"FaceFusion processors pre-check failed: {processors}")
+            self.checked_processors.add(processors)
+
+        self.prepare_source_faces()
+        try:
+            return self.core.process_headless(parsed_args)
+        finally:
+            # 不在任务之间持有源图片
+            self.source_frame = None
+
+    def scan(self, message: dict) -> list:
+        """
+        人脸预扫描: ffmpeg 以 fps 解码并缩放到 width x height (原始 BGR 帧经管道读取)，
+        每帧只运行所选的单个检测器，返回每帧检测到的人脸数
+        """
+        import numpy
+
+        self.last_run_info = {}
+        path = message["path"]
+        parsed_args = self.parse_args(["headless-run", "-t", path, "-o", path] + list(message.get("args", [])))
+        self.apply_args(parsed_args, self.state_manager.init_item)
+        if not self.face_detector.pre_check():
+            raise RuntimeError("FaceFusion face detector pre-check failed")
+
+        width, height = int(message["width"]), int(message["height"])
+        frame_size = width * height * 3
+        cmd = [
+            "ffmpeg", "-v", "error", "-i", path, "-map", "0:v:0",
+            "-vf", f"fps={message['fps']},scale={width}:{height}",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-",
+        ]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        faces = []
+        try:
+            while True:
+                data = process.stdout.read(frame_size)
+                if len(data) < frame_size:
+                    break
+                frame = numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width, 3)
+                bounding_boxes, _, _ = self.face_detector.detect_faces(frame)
+                faces.append(len(bounding_boxes))
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read().decode("utf-8", "replace")
+            process.wait()
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg decode failed: {stderr[-500:]}")
+        return faces
+
+
+def create_backend(name: str):
+    """根据名称创建后端"""
+    if name == "stub":
+        return StubBackend()
+    return FaceFusionBackend(FACEFUSION_PATH)
+
+
+def handle_message(backend, message: dict) -> dict:
+    """处理一条 IPC 消息"""
+    message_type = message.get("type")
+
+    if message_type == "ping":
+        return {"status": "ok", "backend": backend.name, "pid": os.getpid()}
+
+    if message_type in ("run", "scan"):
+        start_time = time.time()
+        try:
+            if message_type == "run":
+                result = {"code": backend.run(list(message.get("args", [])))}
+            else:
+                result = {"faces": backend.scan(message)}
+        except Exception as e:
+            return {
+                "status": "error",
+                "error": str(e),
+                "traceback": traceback.format_exc(),
+                "duration": round(time.time() - start_time, 2),
+            }
+        return dict(backend.last_run_info, status="ok", duration=round(time.time() - start_time, 2), **result)
+
+    return {"status": "error", "error": f"Unknown message type: {message_type}"}
+
+
+def serve(address: str, backend) -> None:
+    """监听 Unix socket，依次处理 handler 的连接"""
+    authkey = os.environ.get("FACEFUSION_WORKER_AUTHKEY", "").encode("utf-8") or None
+
+    if os.path.exists(address):
+        os.remove(address)
+
+    with Listener(address, family="AF_UNIX", authkey=authkey) as listener:
+        print(f"[worker] Listening on {address} (backend: {backend.name})", flush=True)
+        while True:
+            with listener.accept() as conn:
+                while True:
+                    try:
+                        message = conn.recv()
+                    except EOFError:
+                        break
+
+                    if message.get("type") == "shutdown":
+                        conn.send({"status": "ok"})
+                        return
+
+                    response = handle_message(backend, message)
+                    if message.get("sync"):
+                        # 输出同步标记: handler 读到这一行即说明本次请求的输出已全部读取
+                        sys.stderr.flush()
+                        print(f"\n{OUTPUT_SYNC_PREFIX}{message['sync']}", flush=True)
+                    conn.send(response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FaceFusion persistent worker")
+    parser.add_argument("--address", required=True, help="Unix socket path")
+    parser.add_argument("--backend", default="facefusion", choices=["facefusion", "stub"])
+    args = parser.parse_args()
+
+    start_time = time.time()
+    backend = create_backend(args.backend)
+    backend.warmup()
+    print(f"[worker] Backend ready in {time.time() - start_time:.2f}s", flush=True)
+
+    serve(args.address, backend)
+
+
+if __name__ == "__main__":
+    main()